@@ -21,6 +21,9 @@ if __name__ == '__main__':
         'test_tags',
         'test_gevent',
         'test_asyncio',
+        'test_monitoring',
+        'test_module_filter',
+        'test_sampling',
     ]
     # TODO: make these auto-skip if cannot be imported
     if sys.version_info >= (3, 7):
@@ -75,7 +75,7 @@ setup(
             sources=[
                 "yappi/_yappi.c", "yappi/callstack.c", "yappi/hashtab.c",
                 "yappi/mem.c", "yappi/freelist.c", "yappi/timing.c",
-                "yappi/tls.c"
+                "yappi/tls.c", "yappi/histogram.c", "yappi/tracebuf.c"
             ],
             define_macros=user_macros,
             libraries=user_libraries,
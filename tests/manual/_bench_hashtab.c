@@ -0,0 +1,313 @@
+/*
+*    Microbenchmark of the hash table (yappi/hashtab.c) against the previous
+*    separately chained implementation which is kept below as legacy_*.
+*
+*    Build & run from the repository root (POSIX only):
+*
+*    cc -O2 -Iyappi $(python3-config --includes) tests/manual/_bench_hashtab.c \
+*       yappi/hashtab.c yappi/mem.c $(python3-config --embed --ldflags) \
+*       -o /tmp/bench_hashtab && /tmp/bench_hashtab [nkeys]
+*/
+
+#include <time.h>
+#include "hashtab.h"
+#include "mem.h"
+
+/* previous implementation */
+
+#define LHLOADFACTOR 0.75
+
+struct _lhitem {
+    uintptr_t key;
+    uintptr_t val;
+    int free;
+    struct _lhitem *next;
+};
+typedef struct _lhitem _lhitem;
+
+typedef struct {
+    int realsize;
+    int logsize;
+    int count;
+    int mask;
+    int freecount;
+    _lhitem ** _table;
+} _lhtab;
+
+static unsigned int
+LHHASH(_lhtab *ht, uintptr_t a)
+{
+    a = (a ^ 61) ^ (a >> 16);
+    a = a + (a << 3);
+    a = a ^ (a >> 4);
+    a = a * 0x27d4eb2d;
+    a = a ^ (a >> 15);
+    return (a & ht->mask);
+}
+
+static _lhtab *
+legacy_htcreate(int logsize)
+{
+    int i;
+    _lhtab *ht;
+
+    ht = (_lhtab *)ymalloc(sizeof(_lhtab));
+    ht->logsize = logsize;
+    ht->realsize = HSIZE(logsize);
+    ht->mask = HMASK(logsize);
+    ht->count = 0;
+    ht->freecount = 0;
+    ht->_table = (_lhitem **)ymalloc(ht->realsize * sizeof(_lhitem *));
+    for(i=0; i<ht->realsize; i++)
+        ht->_table[i] = NULL;
+    return ht;
+}
+
+static void
+legacy_htdestroy(_lhtab *ht)
+{
+    int i;
+    _lhitem *p, *next;
+
+    for(i=0; i<ht->realsize; i++) {
+        p = ht->_table[i];
+        while(p) {
+            next = p->next;
+            yfree(p);
+            p = next;
+        }
+    }
+    yfree(ht->_table);
+    yfree(ht);
+}
+
+static int legacy_hadd(_lhtab *ht, uintptr_t key, uintptr_t val);
+
+static _lhitem *
+legacy_hfind(_lhtab *ht, uintptr_t key)
+{
+    _lhitem *p;
+
+    p = ht->_table[LHHASH(ht, key)];
+    while(p) {
+        if ((p->key == key) && (!p->free))
+            return p;
+        p = p->next;
+    }
+    return NULL;
+}
+
+static int
+legacy_hgrow(_lhtab *ht)
+{
+    int i;
+    _lhtab *dummy;
+    _lhitem *p, *next, *it;
+
+    dummy = legacy_htcreate(ht->logsize+1);
+    for(i=0; i<ht->realsize; i++) {
+        p = ht->_table[i];
+        while(p) {
+            next = p->next;
+            legacy_hadd(dummy, p->key, p->val);
+            it = legacy_hfind(dummy, p->key);
+            it->free = p->free;
+            yfree(p);
+            p = next;
+        }
+    }
+    yfree(ht->_table);
+    ht->_table = dummy->_table;
+    ht->logsize = dummy->logsize;
+    ht->realsize = dummy->realsize;
+    ht->mask = dummy->mask;
+    yfree(dummy);
+    return 1;
+}
+
+static int
+legacy_hadd(_lhtab *ht, uintptr_t key, uintptr_t val)
+{
+    unsigned int h;
+    _lhitem *new, *p;
+
+    h = LHHASH(ht, key);
+    p = ht->_table[h];
+    new = NULL;
+    while(p) {
+        if ((p->key == key) && (!p->free))
+            return 0;
+        if (p->free)
+            new = p;
+        p = p->next;
+    }
+    if (new) {
+        new->key = key;
+        new->val = val;
+        new->free = 0;
+        ht->freecount--;
+    } else {
+        new = (_lhitem *)ymalloc(sizeof(_lhitem));
+        new->key = key;
+        new->val = val;
+        new->next = ht->_table[h];
+        new->free = 0;
+        ht->_table[h] = new;
+        ht->count++;
+    }
+    if (((ht->count - ht->freecount) / (double)ht->realsize) >= LHLOADFACTOR)
+        return legacy_hgrow(ht);
+    return 1;
+}
+
+static void
+legacy_hfree(_lhtab *ht, _lhitem *item)
+{
+    if (!item->free) {
+        item->free = 1;
+        ht->freecount++;
+    }
+}
+
+/* benchmark */
+
+static long long
+now_ns(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000000000LL + ts.tv_nsec;
+}
+
+// keys look like the pointers yappi hashes: aligned heap addresses
+#define KEY(i) ((uintptr_t)0x7f0000000000ULL + (uintptr_t)(i) * 64)
+#define LOOKUP_ROUNDS 20
+#define CHURN_OPS 1000000
+
+static void
+report(const char *table, const char *op, long long total, long long n)
+{
+    printf("%-8s %-8s %8.1f ns/op\n", table, op, total / (double)n);
+}
+
+static int
+cmp_latency(const void *a, const void *b)
+{
+    long long x = *(const long long *)a, y = *(const long long *)b;
+    return (x > y) - (x < y);
+}
+
+// the latencies of the individual hadd() calls while the table grows. The
+// tail shows the stalls caused by resizing.
+static void
+report_grow(const char *table, long long *latencies, int n)
+{
+    long long total;
+    int i;
+
+    total = 0;
+    for (i = 0; i < n; i++)
+        total += latencies[i];
+    qsort(latencies, n, sizeof(long long), cmp_latency);
+    printf("%-8s %-8s %8.1f ns/op  p99.9 %8.1f us  max %8.1f us\n", table,
+           "grow", total / (double)n, latencies[n - 1 - n / 1000] / 1000.0,
+           latencies[n - 1] / 1000.0);
+}
+
+static void
+bench_new(int nkeys, long long *latencies)
+{
+    _htab *ht;
+    _hitem *it;
+    long long t0;
+    int i, r;
+
+    ht = htcreate(2);
+    for (i = 0; i < nkeys; i++) {
+        t0 = now_ns();
+        hadd(ht, KEY(i), i);
+        latencies[i] = now_ns() - t0;
+    }
+    report_grow("open", latencies, nkeys);
+
+    t0 = now_ns();
+    for (r = 0; r < LOOKUP_ROUNDS; r++) {
+        for (i = 0; i < nkeys; i++) {
+            it = hfind(ht, KEY(i));
+            if (!it || it->val != (uintptr_t)i) {
+                printf("lookup failed\n");
+                exit(1);
+            }
+        }
+    }
+    report("open", "lookup", now_ns() - t0, (long long)nkeys * LOOKUP_ROUNDS);
+    htdestroy(ht);
+
+    // keys are added and freed repeatedly
+    ht = htcreate(10);
+    t0 = now_ns();
+    for (i = 0; i < CHURN_OPS; i++) {
+        hadd(ht, KEY(i % 64), 1);
+        hfree(ht, hfind(ht, KEY(i % 64)));
+    }
+    report("open", "churn", now_ns() - t0, CHURN_OPS);
+    htdestroy(ht);
+}
+
+static void
+bench_legacy(int nkeys, long long *latencies)
+{
+    _lhtab *ht;
+    _lhitem *it;
+    long long t0;
+    int i, r;
+
+    ht = legacy_htcreate(2);
+    for (i = 0; i < nkeys; i++) {
+        t0 = now_ns();
+        legacy_hadd(ht, KEY(i), i);
+        latencies[i] = now_ns() - t0;
+    }
+    report_grow("chained", latencies, nkeys);
+
+    t0 = now_ns();
+    for (r = 0; r < LOOKUP_ROUNDS; r++) {
+        for (i = 0; i < nkeys; i++) {
+            it = legacy_hfind(ht, KEY(i));
+            if (!it || it->val != (uintptr_t)i) {
+                printf("lookup failed\n");
+                exit(1);
+            }
+        }
+    }
+    report("chained", "lookup", now_ns() - t0, (long long)nkeys * LOOKUP_ROUNDS);
+    legacy_htdestroy(ht);
+
+    ht = legacy_htcreate(10);
+    t0 = now_ns();
+    for (i = 0; i < CHURN_OPS; i++) {
+        legacy_hadd(ht, KEY(i % 64), 1);
+        legacy_hfree(ht, legacy_hfind(ht, KEY(i % 64)));
+    }
+    report("chained", "churn", now_ns() - t0, CHURN_OPS);
+    legacy_htdestroy(ht);
+}
+
+int
+main(int argc, char **argv)
+{
+    int nkeys;
+    long long *latencies;
+
+    nkeys = argc > 1 ? atoi(argv[1]) : 100000;
+    latencies = malloc(nkeys * sizeof(long long));
+
+    Py_Initialize(); // ymalloc uses PyMem_Malloc
+    printf("%d keys\n", nkeys);
+    bench_legacy(nkeys, latencies);
+    bench_new(nkeys, latencies);
+    Py_Finalize();
+    free(latencies);
+    return 0;
+}
@@ -1,6 +1,11 @@
 import os
 import re
+import json
+import gzip
+import pickle
+import mmap
 import sys
+import tempfile
 import time
 import threading
 import unittest
@@ -10,6 +15,11 @@ import utils
 import multiprocessing
 import subprocess
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _counter = 0
 
 
@@ -275,6 +285,660 @@ class BasicUsage(utils.YappiUnitTestCase):
         duration = yappi.get_clock_time() - t0
         self.assertTrue(0.05 < duration < 0.3)
 
+    def test_monotonic_clocks(self):
+        yappi.set_clock_type('monotonic')
+        self.assertEqual('monotonic', yappi.get_clock_type())
+        self.assertNotEqual('gettimeofday', yappi.get_clock_info()['api'])
+
+        for clock_type in ('monotonic', 'tsc'):
+            try:
+                yappi.set_clock_type(clock_type)
+            except _yappi.error:
+                self.assertEqual('tsc', clock_type)
+                continue
+            self.assertTrue(yappi.get_clock_info()['resolution'].endswith('ns'))
+            t0 = yappi.get_clock_time()
+            time.sleep(0.1)
+            duration = yappi.get_clock_time() - t0
+            self.assertTrue(0.05 < duration < 0.3)
+
+            yappi.start()
+            utils.burn_io(0.1)
+            yappi.stop()
+            stats = yappi.get_func_stats()
+            fs = utils.find_stat_by_name(stats, 'burn_io')
+            self.assertTrue(0.05 < fs.ttot < 0.3)
+            yappi.clear_stats()
+
+    def test_dual_clock(self):
+
+        def a():
+            utils.burn_io(0.1)
+            utils.burn_cpu(0.1)
+
+        def b():
+            a()
+
+        yappi.set_clock_type('dual')
+        self.assertEqual('dual', yappi.get_clock_type())
+        self.assertRaises(yappi.YappiError, yappi.start, mode="sampling")
+        yappi.start(builtins=True)
+        b()
+        yappi.stop()
+        stats = yappi.get_func_stats()
+        fsa = utils.find_stat_by_name(stats, 'a')
+        fsb = utils.find_stat_by_name(stats, 'b')
+        self.assert_almost_equal(0.2, fsa.ttot)
+        self.assert_almost_equal(0.1, fsa.ttot_cpu)
+        self.assert_almost_equal(0.2, fsb.ttot)
+        self.assert_almost_equal(0.1, fsb.ttot_cpu)
+        self.assertTrue(fsb.tsub_cpu < 0.01)
+        self.assertTrue(fsb.tsub_off < 0.01)
+
+        fssleep = utils.find_stat_by_name(stats, 'sleep')
+        self.assert_almost_equal(0.1, fssleep.tsub_off)
+        self.assertTrue(fssleep.tsub_cpu < 0.01)
+        self.assertEqual(next(iter(stats.sort('tsub_off'))), fssleep)
+        cfsa = fsb.children[fsa]
+        self.assert_almost_equal(0.1, cfsa.ttot_cpu)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stats.save(path, type="callgrind")
+            with open(path) as f:
+                self.assertIn("events: Ticks CpuTicks", f.read())
+        finally:
+            os.remove(path)
+
+    def test_histograms(self):
+
+        def a(slow):
+            if slow:
+                time.sleep(0.01)
+
+        yappi.set_clock_type('wall')
+        yappi.start()
+        a(False)
+        yappi.stop()
+        fsa = utils.find_stat_by_name(yappi.get_func_stats(), 'a')
+        self.assertEqual({}, fsa.hist)
+        self.assertEqual(0, fsa.p99)
+        yappi.clear_stats()
+
+        yappi.start(histograms=True)
+        for i in range(100):
+            a(i % 10 == 0)
+        yappi.stop()
+        self.assertEqual(1, _yappi._get_start_flags()["histograms"])
+        stats = yappi.get_func_stats()
+        fsa = utils.find_stat_by_name(stats, 'a')
+        self.assertEqual(100, sum(fsa.hist.values()))
+        self.assertTrue(fsa.p50 < 0.001)
+        self.assert_almost_equal(0.01, fsa.p99)
+        self.assertTrue(fsa.p99 <= fsa.tmax)
+        self.assertTrue(fsa.tavg < fsa.p99)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stats.save(path)
+            merged = yappi.YFuncStats([path, path])
+        finally:
+            os.remove(path)
+        fsa2 = utils.find_stat_by_name(merged, 'a')
+        self.assertEqual(200, sum(fsa2.hist.values()))
+        self.assertEqual(fsa.p99, fsa2.p99)
+        self.assertEqual(fsa.tmax, fsa2.tmax)
+
+    def test_trace_buffer(self):
+
+        def a():
+            b()
+
+        def b():
+            pass
+
+        yappi.set_clock_type('monotonic')
+        self.assertRaises(_yappi.error, yappi.start, trace_buffer=-1)
+        yappi.start(trace_buffer=1000)
+        a()
+        yappi.stop()
+        events = [
+            (ev.event, ev.name) for ev in yappi.get_trace()
+            if ev.name in ('a', 'b')
+        ]
+        self.assertEqual(
+            [('call', 'a'), ('call', 'b'), ('return', 'b'), ('return', 'a')],
+            events
+        )
+        trace = yappi.get_trace()
+        self.assertTrue(
+            all(e1.timestamp <= e2.timestamp for e1, e2 in zip(trace, trace[1:]))
+        )
+        yappi.clear_stats()
+
+        # only the last events are kept
+        yappi.start(trace_buffer=4)
+        for _ in range(10):
+            a()
+        yappi.stop()
+        trace = yappi.get_trace()
+        self.assertEqual(4, len(trace))
+        self.assertEqual(('return', 'a'), (trace[-2].event, trace[-2].name))
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            yappi.save_trace(path)
+            with open(path) as f:
+                trace_events = json.load(f)["traceEvents"]
+        finally:
+            os.remove(path)
+        # the returns whose calls are overwritten are dropped
+        self.assertEqual(
+            [], [e["ph"] for e in trace_events if e["name"].endswith(" a")]
+        )
+        self.assertEqual(
+            ['B', 'E'],
+            [e["ph"] for e in trace_events if e["name"].endswith(" b")]
+        )
+        depth = 0
+        for e in trace_events:
+            depth += 1 if e["ph"] == "B" else -1
+            self.assertTrue(depth >= 0)
+
+    def test_trace_file(self):
+
+        def a(n):
+            for _ in range(n):
+                b()
+
+        def b():
+            pass
+
+        def tag_cbk():
+            return 2 if threading.current_thread().name == "t" else 1
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            yappi.set_clock_type('monotonic')
+            yappi.set_tag_callback(tag_cbk)
+            # more events than a chunk holds
+            yappi.start(trace_file=path)
+            writer_tid = yappi._trace_writer[0].ident
+            a(5000)
+            t = threading.Thread(target=a, args=(3, ), name="t")
+            t.start()
+            t.join()
+            # the writer flushes meanwhile
+            time.sleep(yappi.TRACE_FLUSH_INTERVAL * 2)
+            yappi.stop()
+            yappi.set_tag_callback(None)
+            trace = yappi.load_trace(path)
+        finally:
+            os.remove(path)
+
+        stats = yappi.get_func_stats()
+        replayed = trace.get_func_stats()
+        # the writer thread is not profiled
+        self.assertNotIn(
+            writer_tid, [tstat.tid for tstat in yappi.get_thread_stats()]
+        )
+        self.assertIsNone(utils.find_stat_by_name(stats, '_run'))
+        self.assertIsNone(utils.find_stat_by_name(replayed, '_run'))
+        for name in ('a', 'b'):
+            stat = utils.find_stat_by_name(stats, name)
+            rstat = utils.find_stat_by_name(replayed, name)
+            self.assertEqual(stat.ncall, rstat.ncall)
+            self.assertEqual(stat.nactualcall, rstat.nactualcall)
+        rstat = utils.find_stat_by_name(replayed, 'a')
+        child = utils.find_stat_by_name(rstat.children, 'b')
+        self.assertEqual(5003, child.ncall)
+        self.assertTrue(rstat.ttot >= rstat.tsub + child.ttot)
+
+        tstats = trace.get_func_stats(tag=2)
+        self.assertEqual(3, utils.find_stat_by_name(tstats, 'b').ncall)
+        ctx_id = utils.find_stat_by_name(tstats, 'b').ctx_id
+        tstats = trace.get_func_stats(ctx_id=ctx_id)
+        self.assertEqual(3, utils.find_stat_by_name(tstats, 'b').ncall)
+
+        # the first 10 calls of b and the first call of a start before
+        events = [ev for ev in trace.get_events() if ev.name == 'b']
+        tstats = trace.get_func_stats(start=events[19].timestamp)
+        self.assertEqual(4993, utils.find_stat_by_name(tstats, 'b').ncall)
+        self.assertEqual(1, utils.find_stat_by_name(tstats, 'a').ncall)
+
+    def test_trace_file_calibration(self):
+        # a fresh interpreter, the clock type is calibrated by the first start()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            p = subprocess.Popen(
+                [
+                    sys.executable, '-c', 'import sys, yappi\n'
+                    'def f(): pass\n'
+                    'yappi.set_clock_type("wall")\n'
+                    'yappi.start(trace_file=sys.argv[1])\n'
+                    'for _ in range(10): f()\n'
+                    'yappi.stop()\n', path
+                ]
+            )
+            p.communicate()
+            self.assertEqual(p.returncode, 0)
+            trace = yappi.load_trace(path)
+        finally:
+            os.remove(path)
+
+        # the calls of the calibration are not recorded
+        events = [ev for evs in trace._events.values() for ev in evs]
+        self.assertTrue(len(events) < 30)
+        self.assertEqual('f', trace._functions[events[0][1]][0])
+        self.assertEqual(20, len([
+            ev for ev in trace.get_events() if ev.name == 'f'
+        ]))
+
+    def test_call_paths(self):
+
+        def helper():
+            for _ in range(10000):
+                pass
+
+        def fast():
+            helper()
+
+        def slow():
+            helper()
+            helper()
+
+        def rec(n):
+            if n:
+                rec(n - 1)
+
+        yappi.start(call_paths=True)
+        fast()
+        slow()
+        slow()
+        rec(300)
+        yappi.stop()
+
+        paths = {
+            tuple(name.split()[-1] for name in p.path): p
+            for p in yappi.get_call_paths()
+        }
+        self.assertEqual(1, paths[('fast', 'helper')].ncall)
+        self.assertEqual(4, paths[('slow', 'helper')].ncall)
+        self.assertEqual(2, paths[('slow', )].ncall)
+        slow = paths[('slow', )]
+        self.assertAlmostEqual(
+            slow.ttot, slow.tsub + paths[('slow', 'helper')].ttot
+        )
+        # every level of a recursion is a different path
+        self.assertEqual(301, len([p for p in paths if p[0] == 'rec']))
+        self.assertEqual(1, paths[('rec', ) * 301].ncall)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            yappi.save_call_paths(path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            yappi.save_call_paths(path, type="speedscope")
+            with open(path) as f:
+                speedscope = json.load(f)
+        finally:
+            os.remove(path)
+        stack = ";".join(paths[('slow', 'helper')].path)
+        self.assertTrue(any(line.startswith(stack + " ") for line in lines))
+        frames = [frame["name"] for frame in speedscope["shared"]["frames"]]
+        samples = [
+            [frames[i] for i in sample]
+            for sample in speedscope["profiles"][0]["samples"]
+        ]
+        self.assertIn(['slow', 'helper'], samples)
+        self.assertRaises(yappi.YappiError, yappi.save_call_paths, path, "x")
+
+    def test_func_stats_arrays(self):
+
+        def a():
+            b()
+            b()
+
+        def b():
+            pass
+
+        yappi.start()
+        a()
+        yappi.stop()
+
+        functions, edges, strings = yappi.get_func_stats_arrays()
+        rows = {
+            strings[functions["name"][i]]: i
+            for i in range(len(functions["index"]))
+        }
+        stats = yappi.get_func_stats()
+        for name in ('a', 'b'):
+            stat = utils.find_stat_by_name(stats, name)
+            i = rows[name]
+            self.assertEqual(stat.index, functions["index"][i])
+            self.assertEqual(stat.module, strings[functions["module"][i]])
+            self.assertEqual(stat.lineno, functions["lineno"][i])
+            self.assertEqual(stat.ncall, functions["ncall"][i])
+            self.assertEqual(stat.ttot, functions["ttot"][i])
+            self.assertEqual(stat.tsub, functions["tsub"][i])
+        self.assertEqual(
+            [2], [
+                edges["ncall"][i] for i in range(len(edges["parent"]))
+                if edges["parent"][i] == functions["index"][rows['a']]
+                and edges["child"][i] == functions["index"][rows['b']]
+            ]
+        )
+
+        functions, edges, strings = yappi.get_func_stats_arrays(ctx_id=-1)
+        self.assertEqual(0, len(functions["index"]))
+        self.assertEqual([], strings)
+
+    def test_func_stats_arrays_filtered(self):
+
+        def a():
+            len([])
+
+        # the builtins recorded first are not shown by the session below
+        yappi.start(builtins=True)
+        a()
+        yappi.stop()
+        yappi.start(builtins=False)
+        yappi.stop()
+
+        functions, edges, strings = yappi.get_func_stats_arrays()
+        names = [strings[name] for name in functions["name"]]
+        self.assertIn('a', names)
+        self.assertNotIn('len', names)
+        # the functions of yappi are not shown either
+        self.assertFalse(
+            any(
+                os.path.basename(strings[module]) == "yappi.py"
+                for module in functions["module"]
+            )
+        )
+        indexes = set(functions["index"])
+        self.assertTrue(all(child in indexes for child in edges["child"]))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_func_stats_arrays_numpy(self):
+
+        def a():
+            pass
+
+        yappi.start()
+        a()
+        a()
+        yappi.stop()
+
+        functions, edges, strings = yappi.get_func_stats_arrays()
+        self.assertIsInstance(functions, numpy.ndarray)
+        self.assertIsInstance(edges, numpy.ndarray)
+        self.assertEqual(
+            [name for name, _ in yappi.FUNC_ARRAY_COLUMNS],
+            list(functions.dtype.names)
+        )
+        self.assertEqual(
+            [name for name, _ in yappi.EDGE_ARRAY_COLUMNS],
+            list(edges.dtype.names)
+        )
+        row = functions[functions["name"] == strings.index('a')][0]
+        stat = utils.find_stat_by_name(yappi.get_func_stats(), 'a')
+        self.assertEqual(stat.index, row["index"])
+        self.assertEqual(2, row["ncall"])
+        self.assertEqual(stat.ttot, row["ttot"])
+
+    def test_func_stats_limit(self):
+
+        def a():
+            for _ in range(3):
+                b()
+            c()
+
+        def b():
+            c()
+
+        def c():
+            pass
+
+        def d():
+            pass
+
+        yappi.start()
+        for _ in range(2):
+            a()
+        t = threading.Thread(target=a)
+        t.start()
+        t.join()
+        d()
+        yappi.stop()
+
+        stats = yappi.get_func_stats(sort_type="callcount", limit=2)
+        self.assertEqual(
+            [('c', 12), ('b', 9)], [(stat.name, stat.ncall) for stat in stats]
+        )
+        fsb = utils.find_stat_by_name(stats, 'b')
+        self.assertEqual(9, utils.find_stat_by_name(fsb.children, 'c').ncall)
+
+        for sort_type in ("ncall", "ttot", "tsub", "tavg", "tmax", "name"):
+            for sort_order in ("asc", "desc"):
+                expected = yappi.get_func_stats().sort(sort_type, sort_order)
+                stats = yappi.get_func_stats(
+                    sort_type=sort_type, sort_order=sort_order, limit=3
+                )
+                self.assertEqual(
+                    [getattr(stat, sort_type) for stat in expected][:3],
+                    [getattr(stat, sort_type) for stat in stats]
+                )
+
+        stats = yappi.get_func_stats(
+            sort_type="ncall",
+            limit=2,
+            filter_callback=lambda stat: stat.name != 'c'
+        )
+        self.assertEqual(['b', 'a'], [stat.name for stat in stats])
+        self.assertEqual(0, len(yappi.get_func_stats(limit=0)))
+        self.assertRaises(
+            yappi.YappiError, yappi.get_func_stats, sort_type="x", limit=1
+        )
+
+    def test_func_stats_limit_same_full_name(self):
+        # two functions of the same full_name are merged into a single stat
+        f, g = (lambda: a()), (lambda: None)
+
+        def a():
+            pass
+
+        def b():
+            f()
+            f()
+            g()
+
+        yappi.start()
+        b()
+        yappi.stop()
+
+        expected = yappi.get_func_stats()
+        self.assertEqual(
+            3, utils.find_stat_by_name(expected, '<lambda>').ncall
+        )
+        for sort_type in ("ncall", "ttot", "tsub", "tavg"):
+            for limit in range(1, len(expected) + 2):
+                stats = yappi.get_func_stats(
+                    sort_type=sort_type, limit=limit
+                )
+                expected.sort(sort_type)
+                self.assertEqual(
+                    [
+                        getattr(stat, sort_type)
+                        for stat in expected
+                    ][:limit], [getattr(stat, sort_type) for stat in stats]
+                )
+                fs = utils.find_stat_by_name(stats, '<lambda>')
+                if fs is not None:
+                    self.assertEqual(3, fs.ncall)
+                    self.assertEqual(
+                        2, utils.find_stat_by_name(fs.children, 'a').ncall
+                    )
+
+    def test_func_stats_limit_ties(self):
+        ns = {}
+        exec(
+            "".join(f"def f{i}(): pass\n" for i in range(20)), ns
+        )
+
+        yappi.start()
+        for i in range(20):
+            ns[f"f{i}"]()
+        yappi.stop()
+
+        for sort_order in ("asc", "desc"):
+            expected = [
+                stat.full_name for stat in yappi.get_func_stats(
+                    sort_type="ncall", sort_order=sort_order
+                )
+            ]
+            for limit in (1, 5, 10):
+                stats = yappi.get_func_stats(
+                    sort_type="ncall", sort_order=sort_order, limit=limit
+                )
+                self.assertEqual(
+                    expected[:limit], [stat.full_name for stat in stats]
+                )
+
+    def test_lazy_func_stats(self):
+
+        def a():
+            for _ in range(3):
+                b()
+
+        def b():
+            c(2)
+
+        def c(n):
+            if n:
+                c(n - 1)
+
+        yappi.start(histograms=True)
+        a()
+        t = threading.Thread(target=a)
+        t.start()
+        t.join()
+        yappi.stop()
+
+        for sort_type in ("name", "ncall", "tsub", "tavg", "tmax", "p99"):
+            stats = yappi.get_func_stats().sort(sort_type, "asc")
+            lazy = yappi.get_func_stats(lazy=True).sort(sort_type, "asc")
+            self.assertEqual(len(stats), len(lazy))
+            for stat, lazy_stat in zip(stats, lazy):
+                self.assertEqual(stat.full_name, lazy_stat.full_name)
+                for key in yappi.YFuncStat._KEYS:
+                    if key != 'children':
+                        self.assertEqual(
+                            getattr(stat, key), getattr(lazy_stat, key)
+                        )
+                self.assertEqual(
+                    {
+                        child.full_name: child._asdict()
+                        for child in stat.children
+                    }, {
+                        child.full_name: child._asdict()
+                        for child in lazy_stat.children
+                    }
+                )
+
+        stats = yappi.get_func_stats(lazy=True)
+        self.assertIsInstance(stats, yappi.YFuncStatsView)
+        with open(os.devnull, "w") as f:
+            stats.print_all(out=f, limit=2)
+        self.assertEqual(2, len(stats._rows))
+        fsb = utils.find_stat_by_name(stats, 'b')
+        self.assertEqual(6, fsb.ncall)
+        self.assertEqual(6, utils.find_stat_by_name(fsb.children, 'c').ncall)
+        self.assertIs(fsb, stats[fsb.full_name])
+        self.assertIs(fsb, stats[fsb.index])
+
+        stats = yappi.get_func_stats(sort_type="ncall", limit=2, lazy=True)
+        self.assertEqual(
+            [('c', 18), ('b', 6)], [(stat.name, stat.ncall) for stat in stats]
+        )
+        self.assertEqual('b', stats.pop().name)
+        self.assertEqual(1, len(stats))
+        self.assertIsNone(stats[fsb.full_name])
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stats.save(path)
+            saved = yappi.YFuncStats(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(['c'], [stat.name for stat in saved])
+        self.assertRaises(
+            yappi.YappiError,
+            yappi.get_func_stats,
+            filter_callback=lambda stat: True,
+            lazy=True
+        )
+
+    def test_clock_overhead(self):
+        for clock_type in ('cpu', 'wall'):
+            yappi.set_clock_type(clock_type)
+            overhead = yappi.get_clock_overhead()
+            self.assertEqual({'function', 'builtin'}, set(overhead))
+            for v in overhead.values():
+                self.assertTrue(0 < v < 0.001)
+
+    def test_clock_overhead_subtracted(self):
+
+        def a():
+            pass
+
+        def b(n):
+            for _ in range(n):
+                a()
+
+        # the replayed stats of a trace file are not corrected
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            yappi.set_clock_type('wall')
+            yappi.start(trace_file=path, histograms=True)
+            b(1000)
+            yappi.stop()
+            trace = yappi.load_trace(path)
+        finally:
+            os.remove(path)
+
+        overhead = yappi.get_clock_overhead()['function']
+        stat = utils.find_stat_by_name(yappi.get_func_stats(), 'b')
+        rstat = utils.find_stat_by_name(trace.get_func_stats(), 'b')
+        # the overhead of each call of a and part of the call of b
+        corrected = rstat.ttot - stat.ttot
+        self.assertTrue(1000 * overhead * 0.99 <= corrected)
+        self.assertTrue(corrected <= 1001 * overhead * 1.01)
+        self.assertTrue(stat.tsub < rstat.tsub)
+
+    def test_clock_overhead_after_clear_stats(self):
+        # a fresh interpreter, the clock types are calibrated only once
+        p = subprocess.Popen(
+            [
+                sys.executable, '-c', 'import yappi; yappi.start(); '
+                'yappi.stop(); yappi.clear_stats(); '
+                'yappi.set_clock_type("wall"); '
+                'print(sorted(yappi.get_clock_overhead()))'
+            ],
+            stdout=subprocess.PIPE
+        )
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(b"['builtin', 'function']", out.strip())
+
     def test_profile_decorator(self):
 
         def aggregate(func, stats):
@@ -534,6 +1198,65 @@ class BasicUsage(utils.YappiUnitTestCase):
         self.assertEqual(fsa.ttot, 1)
         self.assertEqual(fsb.ttot, 1)
 
+    def test_reused_code_ids(self):
+        # code objects of the profiled functions are freed after clear_stats
+        # and their ids are given to the new ones.
+        for i in range(3):
+            ns = {}
+            exec(f"def f{i}():\n    pass\ndef g{i}():\n    f{i}()", ns)
+            yappi.start()
+            ns[f"g{i}"]()
+            yappi.stop()
+            stats = yappi.get_func_stats()
+            self.assertEqual(
+                sorted(s.name for s in stats if s.module == "<string>"),
+                [f"f{i}", f"g{i}"]
+            )
+            self.assertEqual(
+                [c.name for c in utils.find_stat_by_name(stats, f"g{i}").children],
+                [f"f{i}"]
+            )
+            yappi.clear_stats()
+            del ns
+
+    def test_many_functions(self):
+        # internal tables are grown many times while the functions are seen
+        ns = {}
+        n = 3000
+        exec("\n".join(f"def f{i}(): pass" for i in range(n)), ns)
+        funcs = [ns[f"f{i}"] for i in range(n)]
+        yappi.start()
+        for f in funcs + funcs:
+            f()
+        yappi.stop()
+        stats = [s for s in yappi.get_func_stats() if s.module == "<string>"]
+        self.assertEqual(len(stats), n)
+        self.assertTrue(all(s.ncall == 2 for s in stats))
+
+    def test_many_children(self):
+        ns = {}
+        n = 100
+        exec("\n".join(f"def f{i}(): pass" for i in range(n)), ns)
+        funcs = [ns[f"f{i}"] for i in range(n)]
+
+        def dispatch(f):
+            f()
+
+        def a():
+            for f in funcs + funcs:
+                dispatch(f)
+
+        yappi.start()
+        a()
+        yappi.stop()
+        stats = yappi.get_func_stats()
+        fsa = utils.find_stat_by_name(stats, "a")
+        fsdispatch = utils.find_stat_by_name(stats, "dispatch")
+        self.assertEqual(fsdispatch.ncall, 2 * n)
+        self.assertEqual(len(fsdispatch.children), n)
+        self.assertTrue(all(c.ncall == 2 for c in fsdispatch.children))
+        self.assertEqual(fsa.children[fsdispatch].ncall, 2 * n)
+
     def test_lambda(self):
         f = lambda: time.sleep(0.3)
         yappi.set_clock_type("wall")
@@ -714,9 +1437,189 @@ class BasicUsage(utils.YappiUnitTestCase):
         self.assertIsNotNone(utils.find_stat_by_name(stats, 'profiled'))
         self.assertIsNone(utils.find_stat_by_name(stats, 'not_profiled'))
 
+    def test_method_names(self):
+
+        class A:
+
+            def b(self):
+                pass
+
+            class B:
+
+                def c(self):
+                    pass
+
+        yappi.start()
+        A().b()
+        A.B().c()
+        yappi.stop()
+        stats = yappi.get_func_stats()
+        self.assertIsNotNone(utils.find_stat_by_name(stats, 'A.b'))
+        self.assertIsNotNone(utils.find_stat_by_name(stats, 'B.c'))
+
 
 class StatSaveScenarios(utils.YappiUnitTestCase):
 
+    def test_ybin(self):
+
+        def a():
+            for _ in range(3):
+                b()
+
+        def b():
+            pass
+
+        def compare(stats, saved):
+            self.assertEqual(len(stats), len(saved))
+            for stat in stats:
+                saved_stat = saved[stat.full_name]
+                for name in ('ncall', 'nactualcall', 'builtin', 'ctx_name'):
+                    self.assertEqual(
+                        getattr(stat, name), getattr(saved_stat, name)
+                    )
+                for name in ('ttot', 'tsub', 'tavg', 'tmax', 'p99'):
+                    self.assertAlmostEqual(
+                        getattr(stat, name), getattr(saved_stat, name)
+                    )
+                self.assertEqual(stat.hist, saved_stat.hist)
+                self.assertEqual(
+                    {child.full_name: child.ncall for child in stat.children},
+                    {
+                        child.full_name: child.ncall
+                        for child in saved_stat.children
+                    }
+                )
+
+        paths = []
+        for _ in range(2):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            paths.append(path)
+            yappi.start(histograms=True)
+            a()
+            t = threading.Thread(target=a)
+            t.start()
+            t.join()
+            yappi.stop()
+            yappi.get_func_stats().save(path, type="ybin")
+            yappi.get_func_stats().save(path + ".ys")
+            yappi.clear_stats()
+
+        try:
+            stats = yappi.YFuncStats(paths[0] + ".ys")
+            compare(stats, yappi.YFuncStats().add(paths[0], type="ybin"))
+            saved = yappi.YFuncStatsView().add(paths[0], type="ybin")
+            compare(stats, saved)
+            # used in place
+            self.assertIsInstance(saved._funcs["ttot"].obj, mmap.mmap)
+            # and not changed when the file is overwritten
+            yappi.YFuncStats().save(paths[0], type="ybin")
+            compare(stats, saved)
+            saved.close()
+            self.assertNotIsInstance(saved._funcs["ttot"].obj, mmap.mmap)
+            compare(stats, saved)
+            self.assertEqual(0, len(yappi.YFuncStatsView().add(paths[0], "ybin")))
+            stats.save(paths[0], type="ybin")
+
+            stats = yappi.YFuncStats([path + ".ys" for path in paths])
+            saved = yappi.YFuncStatsView().add(paths, type="ybin")
+            self.assertEqual(0, len(saved._rows))
+            saved.save(paths[0], type="ybin")
+            self.assertEqual(0, len(saved._rows))
+            compare(stats, saved)
+            compare(stats, yappi.YFuncStatsView().add(paths[0], type="ybin"))
+            self.assertEqual(12, utils.find_stat_by_name(saved, 'b').ncall)
+
+            with open(paths[1], "wb") as f:
+                f.write(b"YSTA")
+            self.assertRaises(
+                yappi.YappiError,
+                yappi.YFuncStatsView().add, paths[1], "ybin"
+            )
+        finally:
+            for path in paths:
+                os.remove(path)
+                os.remove(path + ".ys")
+
+    def test_load_dict_based_ystat(self):
+
+        # the stats of the older versions were dicts holding their items by index
+        class DictStat(dict):
+            pass
+
+        class DictStatPickler(pickle.Pickler):
+
+            def reducer_override(self, obj):
+                if not isinstance(obj, yappi.YStat):
+                    return NotImplemented
+                stat = DictStat()
+                for name, i in obj._KEYS.items():
+                    stat[i] = getattr(obj, name)
+                    setattr(stat, name, getattr(obj, name))
+                rv = stat.__reduce_ex__(2)
+                return (rv[0], (type(obj), )) + rv[2:]
+
+        def a():
+            b()
+            b()
+
+        def b():
+            pass
+
+        stats = utils.run_and_get_func_stats(a)
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                DictStatPickler(f, 2).dump((stats, stats._clock_type))
+            saved = yappi.YFuncStats(path)
+        finally:
+            os.remove(path)
+
+        fsa = utils.find_stat_by_name(stats, 'a')
+        saved_fsa = utils.find_stat_by_name(saved, 'a')
+        for name in yappi.YFuncStat._KEYS:
+            if name not in ('children', 'index'):
+                self.assertEqual(getattr(fsa, name), getattr(saved_fsa, name))
+        self.assertEqual(fsa.ttot, saved_fsa[6])
+        saved_fsb = utils.find_stat_by_name(saved_fsa.children, 'b')
+        self.assertEqual(2, saved_fsb.ncall)
+        self.assertEqual(saved[saved_fsb.full_name].index, saved_fsb.index)
+        self.assertFalse(hasattr(saved_fsa, '__dict__'))
+
+        # and the stats saved now can be loaded as dicts
+        loaded = pickle.loads(pickle.dumps(saved_fsb, 2))
+        self.assertEqual(saved_fsb, loaded)
+        self.assertEqual(saved_fsb._asdict(), loaded._asdict())
+        self.assertEqual(
+            (yappi.YChildFuncStat, ), saved_fsb.__reduce_ex__(2)[1]
+        )
+        self.assertEqual(
+            {i: saved_fsb[i] for i in yappi.YChildFuncStat._KEYS.values()},
+            dict(saved_fsb.__reduce_ex__(2)[4])
+        )
+
+    def test_load_ystat_of_1_7_6(self):
+        # saved by yappi 1.7.6 with test timings: a() calls b() twice
+        path = os.path.join(os.path.dirname(__file__), "ystats_1.7.6.ys")
+        stats = yappi.YFuncStats(path).add(path)
+        fsa = utils.find_stat_by_name(stats, 'a')
+        fsb = utils.find_stat_by_name(stats, 'b')
+        self.assertEqual(2, fsa.ncall)
+        self.assertEqual(12, fsa.ttot)
+        self.assertEqual(4, fsb.ncall)
+        self.assertEqual(0.0, fsa.ttot_cpu)
+        self.assertEqual({}, fsa.hist)
+        self.assertEqual(0.0, fsa.p99)
+        fsab = utils.find_stat_by_name(fsa.children, 'b')
+        self.assertEqual(4, fsab.ncall)
+        self.assertEqual(0.0, fsab.tsub_off)
+
+        for sort_type in ('ttot_cpu', 'tsub_off', 'tmax', 'p99'):
+            stats.sort(sort_type)
+        fsa.children.sort('ttot_cpu')
+        with open(os.devnull, "w") as f:
+            stats.print_all(out=f)
+
     def test_pstats_conversion(self):
 
         def pstat_id(fs):
@@ -1114,6 +2017,128 @@ class StatSaveScenarios(utils.YappiUnitTestCase):
 
         os.remove(path)
 
+    def _load_pprof(self, path):
+        """
+        Returns the function names by id, the function ids by location id and
+        the samples as ([function names], [values]) of a saved pprof file.
+        """
+        with gzip.open(path) as f:
+            profile = f.read()
+
+        def varint(data, i):
+            value = shift = 0
+            while True:
+                value |= (data[i] & 0x7f) << shift
+                shift += 7
+                i += 1
+                if data[i - 1] < 0x80:
+                    return value, i
+
+        def fields(data):
+            i, result = 0, []
+            while i < len(data):
+                key, i = varint(data, i)
+                if key & 7 == 0:
+                    value, i = varint(data, i)
+                else:
+                    length, i = varint(data, i)
+                    value, i = data[i:i + length], i + length
+                result.append((key >> 3, value))
+            return result
+
+        def packed(data):
+            i, result = 0, []
+            while i < len(data):
+                value, i = varint(data, i)
+                result.append(value)
+            return result
+
+        profile = fields(profile)
+        strings = [v.decode() for k, v in profile if k == 6]
+        self.assertEqual("", strings[0])
+        functions = {}
+        locations = {}
+        for k, v in profile:
+            if k == 5:
+                function = dict(fields(v))
+                functions[function[1]] = strings[function[2]]
+            elif k == 4:
+                location = dict(fields(v))
+                locations[location[1]] = dict(fields(location[4]))[1]
+        samples = []
+        for k, v in profile:
+            if k == 2:
+                sample = dict(fields(v))
+                samples.append((
+                    [
+                        functions[locations[id]]
+                        for id in packed(sample[1])
+                    ],
+                    packed(sample[2])
+                ))
+        return samples
+
+    def test_pprof(self):
+        _timings = {"a_1": 3, "b_1": 1}
+        _yappi._set_test_timings(_timings)
+
+        def b():
+            pass
+
+        def a():
+            b()
+
+        yappi.start()
+        a()
+        yappi.stop()
+
+        path = "tests/yappi.pb.gz"
+        yappi.get_func_stats().save(path, type="pprof")
+        try:
+            samples = self._load_pprof(path)
+        finally:
+            os.remove(path)
+
+        # the time of b is only spent when called from a
+        self.assertEqual(
+            sorted([(['b', 'a'], [1, 1000000000]), (['a'], [1, 2000000000])]),
+            sorted(samples)
+        )
+
+    def test_pprof_multithreaded(self):
+
+        def b():
+            pass
+
+        def a():
+            b()
+            b()
+
+        yappi.start()
+        # the merged stat of b is of a thread where a is not called
+        threads = [threading.Thread(target=f) for f in (b, a, a)]
+        for t in threads:
+            t.start()
+            t.join()
+        yappi.stop()
+
+        path = "tests/yappi_mt.pb.gz"
+        yappi.get_func_stats().save(path, type="pprof")
+        try:
+            # every location of the samples is defined
+            samples = self._load_pprof(path)
+        finally:
+            os.remove(path)
+
+        # the calls of b from a are not counted as its own too
+        self.assertEqual(
+            sorted([(['b', 'Thread.run'], 1), (['b', 'a'], 4)]),
+            sorted(
+                (names, values[0])
+                for names, values in samples if names[0] == 'b'
+            )
+        )
+
 
 class MultithreadedScenarios(utils.YappiUnitTestCase):
 
@@ -0,0 +1,156 @@
+import sys
+import time
+import unittest
+import yappi
+import _yappi
+import utils
+
+MONITORING_AVAILABLE = sys.version_info >= (3, 12)
+
+# functions compiled with a fake filename so that they are reported as
+# coming from a different module
+_EXCLUDED_SRC = """
+def excluded_func(f):
+    time.sleep(0.1)
+    return f()
+
+def excluded_raise():
+    raise ValueError()
+
+def excluded_gen():
+    yield 1
+    yield 2
+"""
+
+
+def _load_excluded_module():
+    ns = {"time": time}
+    exec(compile(_EXCLUDED_SRC, "yappi_excluded_mod.py", "exec"), ns)
+    return ns
+
+
+_excluded_mod = _load_excluded_module()
+
+
+def included_func():
+    time.sleep(0.1)
+
+
+def caller():
+    _excluded_mod["excluded_func"](included_func)
+    for _ in _excluded_mod["excluded_gen"]():
+        pass
+    try:
+        _excluded_mod["excluded_raise"]()
+    except ValueError:
+        pass
+
+
+class ModuleFilterTests(utils.YappiUnitTestCase):
+
+    engine = "setprofile"
+
+    def _profile(self, func, **kwargs):
+        yappi.set_clock_type("wall")
+        yappi.start(engine=self.engine, **kwargs)
+        func()
+        yappi.stop()
+        return yappi.get_func_stats()
+
+    def test_exclude(self):
+        stats = self._profile(caller, exclude_modules=["*excluded_mod*"])
+        for name in ("excluded_func", "excluded_raise", "excluded_gen"):
+            self.assertIsNone(utils.find_stat_by_name(stats, name))
+
+        fscaller = utils.find_stat_by_name(stats, "caller")
+        fsincluded = utils.find_stat_by_name(stats, "included_func")
+        self.assertEqual(fscaller.ncall, 1)
+        self.assertEqual(fsincluded.ncall, 1)
+        # the time spent in the excluded function is accounted to the caller
+        self.assert_almost_equal(fscaller.ttot, 0.2)
+        self.assert_almost_equal(fscaller.tsub, 0.1)
+        # included callees are attached to the nearest profiled caller
+        children = list(fscaller.children)
+        self.assertEqual(len(children), 1)
+        self.assertEqual(children[0].full_name, fsincluded.full_name)
+
+    def test_exclude_tagged(self):
+        # the excluded functions return with another tag than they were
+        # called with
+        tags = iter(range(1000))
+        yappi.set_tag_callback(lambda: next(tags) % 2)
+        try:
+            stats = self._profile(caller, exclude_modules=["*excluded_mod*"])
+        finally:
+            yappi.set_tag_callback(None)
+        self.assertIsNone(utils.find_stat_by_name(stats, "excluded_func"))
+        fscaller = utils.find_stat_by_name(stats, "caller")
+        fsincluded = utils.find_stat_by_name(stats, "included_func")
+        self.assertEqual(fscaller.ncall, 1)
+        self.assertEqual(fsincluded.ncall, 1)
+        self.assert_almost_equal(fscaller.ttot, 0.2)
+
+    def test_include(self):
+        stats = self._profile(caller, include_modules=[__file__])
+        self.assertIsNotNone(utils.find_stat_by_name(stats, "caller"))
+        self.assertIsNone(utils.find_stat_by_name(stats, "excluded_func"))
+
+        yappi.clear_stats()
+        stats = self._profile(
+            caller, include_modules=["yappi_excluded_mod.py"]
+        )
+        self.assertIsNone(utils.find_stat_by_name(stats, "caller"))
+        self.assertIsNotNone(utils.find_stat_by_name(stats, "excluded_func"))
+
+    def test_exclude_builtins(self):
+        stats = self._profile(
+            included_func, builtins=True, exclude_modules=["time"]
+        )
+        self.assertIsNone(utils.find_stat_by_name(stats, "sleep"))
+        fsincluded = utils.find_stat_by_name(stats, "included_func")
+        self.assert_almost_equal(fsincluded.tsub, 0.1)
+
+    def test_exclude_module_object(self):
+        stats = self._profile(
+            included_func, builtins=True, exclude_modules=[time]
+        )
+        self.assertIsNone(utils.find_stat_by_name(stats, "sleep"))
+
+    def test_filter_called_once(self):
+        calls = []
+
+        def a():
+            pass
+
+        def _filter(module):
+            calls.append(module)
+            return True
+
+        _yappi.start(0, 1, yappi.ENGINE_TYPES[self.engine.upper()], _filter)
+        for _ in range(10):
+            a()
+        yappi.stop()
+        self.assertEqual(calls.count(__file__), 1)
+
+    def test_filter_persists_until_clear_stats(self):
+        stats = self._profile(caller, exclude_modules=["*excluded_mod*"])
+        self.assertIsNone(utils.find_stat_by_name(stats, "excluded_func"))
+        stats = self._profile(caller)
+        self.assertIsNone(utils.find_stat_by_name(stats, "excluded_func"))
+        yappi.clear_stats()
+        stats = self._profile(caller)
+        self.assertIsNotNone(utils.find_stat_by_name(stats, "excluded_func"))
+
+    def test_invalid_module(self):
+        self.assertRaises(yappi.YappiError, yappi.start, exclude_modules=[1])
+        self.assertFalse(yappi.is_running())
+
+
+@unittest.skipIf(not MONITORING_AVAILABLE, "requires Python 3.12+")
+class MonitoringModuleFilterTests(ModuleFilterTests):
+
+    engine = "monitoring"
+
+
+if __name__ == '__main__':
+    unittest.main()
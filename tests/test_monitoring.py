@@ -0,0 +1,201 @@
+import sys
+import time
+import threading
+import unittest
+import yappi
+import _yappi
+import utils
+
+MONITORING_AVAILABLE = sys.version_info >= (3, 12)
+
+
+def _fib(n):
+    if n <= 1:
+        return n
+    return _fib(n - 1) + _fib(n - 2)
+
+
+def _gen(n):
+    while n > 0:
+        yield n
+        n -= 1
+
+
+def _raise():
+    raise ValueError()
+
+
+def _workload():
+    _fib(8)
+    for _ in _gen(3):
+        pass
+    try:
+        _raise()
+    except ValueError:
+        pass
+
+
+class EngineAPITests(utils.YappiUnitTestCase):
+
+    def test_invalid_engine(self):
+        self.assertRaises(yappi.YappiError, yappi.start, engine="invalid")
+        self.assertFalse(yappi.is_running())
+
+    def test_start_flags(self):
+        yappi.start()
+        self.assertEqual(
+            _yappi._get_start_flags()["engine"],
+            yappi.ENGINE_TYPES[yappi.SETPROFILE]
+        )
+
+    @unittest.skipIf(MONITORING_AVAILABLE, "sys.monitoring is available")
+    def test_monitoring_not_available(self):
+        self.assertRaises(yappi.YappiError, yappi.start, engine="monitoring")
+        self.assertFalse(yappi.is_running())
+
+
+@unittest.skipIf(not MONITORING_AVAILABLE, "requires Python 3.12+")
+class MonitoringEngineTests(utils.YappiUnitTestCase):
+
+    def _get_stats(self, engine, builtins=False):
+        yappi.clear_stats()
+        yappi.start(builtins=builtins, engine=engine)
+        _workload()
+        yappi.stop()
+        stats = {}
+        for stat in yappi.get_func_stats():
+            stats[stat.full_name] = (
+                stat.ncall, stat.nactualcall,
+                sorted((c.full_name, c.ncall, c.nactualcall)
+                       for c in stat.children)
+            )
+        return stats
+
+    def test_same_stats_as_setprofile(self):
+        self.assertEqual(
+            self._get_stats("setprofile", builtins=True),
+            self._get_stats("monitoring", builtins=True)
+        )
+
+    def test_recursive(self):
+        yappi.start(engine="monitoring")
+        _fib(10)
+        yappi.stop()
+        stats = yappi.get_func_stats()
+        fsfib = utils.find_stat_by_name(stats, "_fib")
+        self.assertEqual(fsfib.ncall, 177)
+        self.assertEqual(fsfib.nactualcall, 1)
+
+    def test_builtins_not_subscribed(self):
+        E = sys.monitoring.events
+        yappi.start(engine="monitoring")
+        self.assertFalse(
+            sys.monitoring.get_events(sys.monitoring.PROFILER_ID) & E.CALL
+        )
+        time.sleep(0.01)
+        yappi.stop()
+        self.assertIsNone(
+            utils.find_stat_by_name(yappi.get_func_stats(), "time.sleep")
+        )
+
+        yappi.clear_stats()
+        yappi.start(builtins=True, engine="monitoring")
+        self.assertTrue(
+            sys.monitoring.get_events(sys.monitoring.PROFILER_ID) & E.CALL
+        )
+        time.sleep(0.01)
+        [].append(1)
+        yappi.stop()
+        stats = yappi.get_func_stats()
+        self.assertEqual(utils.find_stat_by_name(stats, "time.sleep").ncall, 1)
+        self.assertIsNotNone(
+            utils.find_stat_by_name(
+                stats, "builtins.<method 'append' of 'list' objects>"
+            )
+        )
+
+    def test_tool_id_released_on_stop(self):
+        yappi.start(engine="monitoring")
+        self.assertEqual(
+            sys.monitoring.get_tool(sys.monitoring.PROFILER_ID), "yappi"
+        )
+        yappi.stop()
+        self.assertIsNone(sys.monitoring.get_tool(sys.monitoring.PROFILER_ID))
+        self.assertEqual(
+            sys.monitoring.get_events(sys.monitoring.PROFILER_ID), 0
+        )
+
+    def test_tool_id_in_use(self):
+        sys.monitoring.use_tool_id(sys.monitoring.PROFILER_ID, "other")
+        try:
+            self.assertRaises(_yappi.error, yappi.start, engine="monitoring")
+            self.assertFalse(yappi.is_running())
+        finally:
+            sys.monitoring.free_tool_id(sys.monitoring.PROFILER_ID)
+
+    def test_multithread(self):
+
+        def a():
+            _fib(5)
+
+        yappi.start(engine="monitoring")
+        ts = [threading.Thread(target=a) for _ in range(3)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        yappi.stop()
+
+        fsa = utils.find_stat_by_name(yappi.get_func_stats(), "a")
+        self.assertEqual(fsa.ncall, 3)
+        self.assertEqual(len(yappi.get_thread_stats()), 4)
+
+    def test_singlethread(self):
+
+        def a():
+            _fib(5)
+
+        def b():
+            pass
+
+        yappi.start(profile_threads=False, engine="monitoring")
+        t = threading.Thread(target=a)
+        t.start()
+        t.join()
+        b()
+        yappi.stop()
+
+        stats = yappi.get_func_stats()
+        self.assertIsNone(utils.find_stat_by_name(stats, "a"))
+        self.assertIsNone(utils.find_stat_by_name(stats, "_fib"))
+        self.assertEqual(utils.find_stat_by_name(stats, "b").ncall, 1)
+
+    def test_generator_wall(self):
+        yappi.set_clock_type("wall")
+
+        def g():
+            yield 1
+            time.sleep(0.1)
+            yield 2
+
+        yappi.start(engine="monitoring")
+        for _ in g():
+            time.sleep(0.1)
+        yappi.stop()
+
+        fsg = utils.find_stat_by_name(yappi.get_func_stats(), "g")
+        self.assertEqual(fsg.ncall, 3)
+        self.assert_almost_equal(fsg.ttot, 0.1)
+
+    def test_run(self):
+        with yappi.run(engine="monitoring"):
+            _fib(5)
+        self.assertFalse(yappi.is_running())
+        self.assertIsNone(sys.monitoring.get_tool(sys.monitoring.PROFILER_ID))
+        self.assertIsNotNone(
+            utils.find_stat_by_name(yappi.get_func_stats(), "_fib")
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import contextvars
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+import yappi
+import utils
+
+# short enough for the tests to collect enough samples in a few 100ms
+_INTERVAL = 0.001
+
+
+def a():
+    utils.burn_io(0.2)
+
+
+def b():
+    utils.burn_cpu(0.2)
+
+
+def c():
+    a()
+    b()
+
+
+def count_down(n):
+    if n:
+        count_down(n - 1)
+    else:
+        utils.burn_io(0.2)
+
+
+class SamplingTests(utils.YappiUnitTestCase):
+
+    def _profile(self, func, **kwargs):
+        yappi.start(mode="sampling", interval=_INTERVAL, **kwargs)
+        func()
+        yappi.stop()
+        return yappi.get_func_stats()
+
+    def test_wall(self):
+        yappi.set_clock_type("wall")
+        stats = self._profile(c)
+        fsc = utils.find_stat_by_name(stats, "c")
+        fsa = utils.find_stat_by_name(stats, "a")
+        fsb = utils.find_stat_by_name(stats, "b")
+        self.assertEqual(fsc.ncall, 1)
+        self.assertEqual(fsa.ncall, 1)
+        self.assertEqual(fsb.ncall, 1)
+        self.assert_almost_equal(0.4, fsc.ttot)
+        self.assert_almost_equal(0.2, fsa.ttot)
+        self.assert_almost_equal(0.2, fsb.ttot)
+        self.assertEqual(fsc.tsub, 0)
+
+        children = {child.name: child for child in fsc.children}
+        self.assertEqual(children["a"].ncall, 1)
+        self.assert_almost_equal(0.2, children["a"].ttot)
+        self.assert_almost_equal(0.2, children["b"].ttot)
+
+    def test_cpu(self):
+        yappi.set_clock_type("cpu")
+        stats = self._profile(c)
+        fsc = utils.find_stat_by_name(stats, "c")
+        fsb = utils.find_stat_by_name(stats, "b")
+        self.assert_almost_equal(0.2, fsc.ttot)
+        self.assert_almost_equal(0.2, fsb.ttot)
+
+    def test_recursion(self):
+        yappi.set_clock_type("wall")
+        stats = self._profile(lambda: count_down(5))
+        fs = utils.find_stat_by_name(stats, "count_down")
+        self.assertEqual(fs.ncall, 6)
+        self.assertEqual(fs.nactualcall, 1)
+        self.assert_almost_equal(0.2, fs.ttot)
+
+    def test_repeated_calls(self):
+
+        def f():
+            utils.burn_io(0.03)
+
+        def g():
+            for _ in range(10):
+                f()
+
+        yappi.set_clock_type("wall")
+        stats = self._profile(g)
+        fsf = utils.find_stat_by_name(stats, "f")
+        self.assertEqual(fsf.ncall, 10)
+        self.assert_almost_equal(0.3, fsf.ttot)
+
+    def test_threads(self):
+        yappi.set_clock_type("wall")
+
+        tids = []
+
+        def run():
+            tids.append(yappi._sampler[0].ident)
+            ts = [threading.Thread(target=a) for _ in range(3)]
+            for t in ts:
+                t.start()
+            tids.extend(t.ident for t in ts)
+            for t in ts:
+                t.join()
+
+        stats = self._profile(run)
+        fsa = utils.find_stat_by_name(stats, "a")
+        self.assertEqual(fsa.ncall, 3)
+        self.assert_almost_equal(0.6, fsa.ttot)
+
+        # the sampler thread itself is not sampled
+        sampled_tids = [tstat.tid for tstat in yappi.get_thread_stats()]
+        self.assertNotIn(tids[0], sampled_tids)
+        for tid in tids[1:]:
+            self.assertIn(tid, sampled_tids)
+
+    def test_profile_threads_false(self):
+        yappi.set_clock_type("wall")
+
+        def run():
+            t = threading.Thread(target=a)
+            t.start()
+            t.join()
+            utils.burn_io(0.1)
+
+        stats = self._profile(run, profile_threads=False)
+        self.assertIsNone(utils.find_stat_by_name(stats, "a"))
+        self.assertIsNotNone(utils.find_stat_by_name(stats, "run"))
+        self.assertEqual(len(yappi.get_thread_stats()), 1)
+
+    def test_exclude_modules(self):
+        yappi.set_clock_type("wall")
+        stats = self._profile(c, exclude_modules=[utils])
+        self.assertIsNone(utils.find_stat_by_name(stats, "burn_io"))
+        fsa = utils.find_stat_by_name(stats, "a")
+        self.assert_almost_equal(0.2, fsa.tsub)
+
+    def test_tag_contextvar(self):
+        var = contextvars.ContextVar("tag", default=1)
+
+        def run():
+            var.set(2)
+            a()
+
+        yappi.set_clock_type("wall")
+        yappi.set_tag_contextvar(var)
+        self._profile(lambda: (a(), contextvars.copy_context().run(run)))
+        for tag in (1, 2):
+            stats = yappi.get_func_stats(filter={"tag": tag})
+            self.assertEqual(utils.find_stat_by_name(stats, "a").ncall, 1)
+
+    def test_save(self):
+        yappi.set_clock_type("wall")
+        stats = self._profile(c)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stats.save(path, type="pstat")
+            ps = pstats.Stats(path)
+            self.assertTrue(any(k[2] == "c" for k in ps.stats))
+        finally:
+            os.remove(path)
+
+    def test_sampler_stops(self):
+        yappi.start(mode="sampling", interval=_INTERVAL)
+        self.assertTrue(
+            any(t.name == "YappiSampler" for t in threading.enumerate())
+        )
+        yappi.stop()
+        self.assertFalse(
+            any(t.name == "YappiSampler" for t in threading.enumerate())
+        )
+
+    def test_invalid_args(self):
+        self.assertRaises(yappi.YappiError, yappi.start, mode="invalid")
+        self.assertRaises(
+            yappi.YappiError, yappi.start, mode="sampling", interval=0
+        )
+        self.assertFalse(yappi.is_running())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import unittest
 import yappi
+import asyncio
+import contextvars
 import threading
 import time
 from utils import YappiUnitTestCase, find_stat_by_name, burn_cpu, burn_io
@@ -174,3 +176,92 @@ class SingleThreadTests(YappiUnitTestCase):
         self.assert_traces_almost_equal(t1, tagged_traces)
 
         yappi.clear_stats()
+
+    def test_tag_contextvar(self):
+        var = contextvars.ContextVar('tag')
+
+        def a():
+            pass
+
+        def request(tag):
+            var.set(tag)
+            a()
+
+        def run():
+            a()
+            for i in range(1, 4):
+                contextvars.copy_context().run(request, i)
+            # the tag changes when the var is set in the same context, too
+            var.set(5)
+            a()
+            var.set(6)
+            a()
+
+        yappi.set_tag_contextvar(var)
+        yappi.start()
+        contextvars.copy_context().run(run)
+        yappi.stop()
+
+        stats = yappi.get_func_stats()
+        self.assertEqual(find_stat_by_name(stats, 'a').ncall, 6)
+        for tag in (0, 1, 2, 3, 5, 6):
+            stats = yappi.get_func_stats(filter={'tag': tag})
+            self.assertEqual(find_stat_by_name(stats, 'a').ncall, 1, tag)
+
+    def test_tag_contextvar_asyncio(self):
+        var = contextvars.ContextVar('request_id', default=0)
+
+        def a():
+            pass
+
+        async def request(request_id):
+            var.set(request_id)
+            for _ in range(request_id):
+                await asyncio.sleep(0)
+                a()
+
+        async def main():
+            await asyncio.gather(*(request(i) for i in range(1, 6)))
+
+        yappi.set_tag_contextvar(var)
+        yappi.start()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main())
+        loop.close()
+        yappi.stop()
+
+        for request_id in range(1, 6):
+            stats = yappi.get_func_stats(filter={'tag': request_id})
+            self.assertEqual(find_stat_by_name(stats, 'a').ncall, request_id)
+
+    def test_tag_contextvar_replaces_callback(self):
+        var = contextvars.ContextVar('tag', default=1)
+
+        def a():
+            pass
+
+        yappi.set_tag_callback(lambda: 2)
+        yappi.set_tag_contextvar(var)
+        yappi.start()
+        a()
+        yappi.set_tag_callback(lambda: 2)
+        a()
+        yappi.stop()
+
+        for tag in (1, 2):
+            stats = yappi.get_func_stats(filter={'tag': tag})
+            self.assertEqual(find_stat_by_name(stats, 'a').ncall, 1)
+
+    def test_invalid_tag_contextvar(self):
+        var = contextvars.ContextVar('tag', default="not an int")
+
+        def a():
+            pass
+
+        self.assertRaises(TypeError, yappi.set_tag_contextvar, 1)
+        yappi.set_tag_contextvar(var)
+        yappi.start()
+        a()
+        yappi.stop()
+        stats = yappi.get_func_stats(filter={'tag': 0})
+        self.assertEqual(find_stat_by_name(stats, 'a').ncall, 1)
@@ -15,6 +15,7 @@ class YappiUnitTestCase(unittest.TestCase):
         yappi.set_context_id_callback(None)
         yappi.set_context_name_callback(None)
         yappi.set_tag_callback(None)
+        yappi.set_tag_contextvar(None)
 
     def tearDown(self):
         fstats = yappi.get_func_stats()
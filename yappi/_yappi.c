@@ -31,9 +31,15 @@
 #include "freelist.h"
 #include "mem.h"
 #include "tls.h"
+#include "histogram.h"
+#include "tracebuf.h"
 
 #define SUPPRESS_WARNING(a) (void)a
 
+#if PY_VERSION_HEX >= 0x030C0000  // Python 3.12+
+  #define MONITORING_AVAILABLE
+#endif
+
 PyDoc_STRVAR(_yappi__doc__, "Yet Another Python Profiler");
 
 // linked list for holding callee/caller info in the pit
@@ -44,6 +50,9 @@ typedef struct {
     unsigned long nonrecursive_callcount;   // how many times the child function is called non-recursively?
     long long tsubtotal;                    // the time that the child function spent excluding its children (include recursive parent-child calls)
     long long ttotal;                       // the total time that the child function spent
+    long long cpu_tsubtotal;                // tsubtotal and ttotal in CPU time, with the dual clock
+    long long cpu_ttotal;
+    unsigned long rec_level;                // how many times the (parent, child) pair is on the callstack
     struct _pit_children_info *next;
 } _pit_children_info;
 
@@ -73,8 +82,22 @@ typedef struct {
 
     // the total time that a function spent
     long long ttotal;
+
+    // tsubtotal and ttotal in CPU time (see cputickcount), only measured with
+    // the dual clock.
+    long long cpu_tsubtotal;
+    long long cpu_ttotal;
+
+    // how many times the function is on the callstack of its context
+    unsigned long rec_level;
     unsigned int builtin;
 
+    // the function is not profiled. (see module_filter)
+    unsigned int excluded;
+
+    // the key the pit is hashed with: PyCodeObject or PyMethodDef pointer
+    uintptr_t key;
+
     // a number that uniquely identifies the _pit during the lifetime of a profile
     // session (for multiple start/stop pairs) We could use PyCodeObject for this
     // too, but then there are builtin calls, it is better to have a custom id
@@ -87,21 +110,63 @@ typedef struct {
     // TODO: Comment
     PyObject *fn_descriptor;
 
+    // the class of the "self" argument of a method on Python < 3.11. The name
+    // of the pit is prefixed with it when the stats are read.
+    PyObject *cls;
+
     _pit_children_info *children;
+
+    // the latencies of the calls, only recorded when start() is called with
+    // histograms. Created on the first return of the function.
+    _hist *hist;
+
+    // maps index:_pit_children_info once a pit has many children so that
+    // finding a child info does not require walking the list.
+    unsigned int nchildren;
+    _htab *children_index;
 } _pit; // profile_item
 
+// a node of the calling context tree of a context: the stats of a function
+// called through a specific call path, only built when start() is called
+// with call_paths.
+typedef struct _cctnode {
+    _pit *pit;
+    unsigned int id; // unique in the context
+    unsigned long callcount;
+    long long ttotal;
+    long long tsubtotal;
+    struct _cctnode *parent;
+    struct _cctnode *children;
+    struct _cctnode *next; // sibling
+} _cctnode;
+
 typedef struct {
     int paused;
     long long paused_at;
 } _glstate;
 
+// pits of a single tag
+typedef struct {
+    // all the pits, keyed by PyCodeObject or PyMethodDef pointer
+    _htab *pits;
+
+    // pits of Python functions indexed by the fid of their PyCodeObject (see
+    // _code2fid). Pages are allocated on demand.
+    _pit ***pages;
+    unsigned int npages;
+} _tagged_pits;
+
 typedef struct {
     _cstack *cs;
-    _htab *rec_levels;
 
-    // mapping tag:htab of pits
+    // mapping tag:_tagged_pits
     _htab *tags;
 
+    // the _tagged_pits of the last tag seen, tags rarely change between
+    // consecutive events.
+    uintptr_t last_tag;
+    _tagged_pits *last_tagged_pits;
+
     // internal tid given by user callback or yappi. Will be unique per profile session.
     uintptr_t id;
 
@@ -119,10 +184,46 @@ typedef struct {
     long long last_seen;
 
     PyThreadState *ts_ptr;
+    uint64_t ts_id; // ts_ptr can be recycled, the id is unique
+
+    // the profiler overhead of all the calls returned in this context so
+    // far (see _call_overhead)
+    double overhead;
+
+    // the sampling session the thread is last sampled in. ctx->cs holds the
+    // call stack of that sample.
+    unsigned long sample_gen;
 
     _glstate gl_state;
+
+    // the pits, children and coroutines are allocated from the pools of the
+    // context they are created in. A context is only modified by its own
+    // thread, so they need no locking.
+    _freelist *flpit;
+    _freelist *flchildren; // _pit_children_info
+    _freelist *flcoro;
+    _freelist *flcct; // _cctnode
+
+    // the root of the calling context tree, its children are the functions
+    // called from an empty call stack. Created on the first call.
+    _cctnode *cct;
+    unsigned int cct_count; // nodes in the tree
+
+    // the last call events of the context, only recorded when start() is
+    // called with trace_buffer. Created on the first event.
+    _tracebuf *trace;
+
+    // the chunk being filled with the events streamed to the trace file,
+    // only used when start() is called with trace_file.
+    _streamchunk *stream;
 } _ctx; // context
 
+// the time the profiler adds to a call, measured by _calibrate() in ticks
+typedef struct {
+    double inner; // spent between the clock reads of the called function
+    double total; // all of it is spent between the clock reads of the caller
+} _overhead;
+
 typedef struct {
     PyObject *ctx_id;
     PyObject *tag;
@@ -130,10 +231,72 @@ typedef struct {
     PyObject *modname;
 } _fast_func_stat_filter;
 
+// a growing column of the stats arrays, see get_func_stats_arrays()
+typedef struct {
+    char *data;
+    Py_ssize_t size;
+    Py_ssize_t capacity;
+} _column;
+
+#define FUNC_COLUMN_COUNT 15
+#define EDGE_COLUMN_COUNT 8
+#define HIST_COLUMN_COUNT 3
+
+typedef struct {
+    _column funcs[FUNC_COLUMN_COUNT];
+    _column edges[EDGE_COLUMN_COUNT];
+    _column hists[HIST_COLUMN_COUNT]; // the histogram buckets of the functions
+    PyObject *strings; // the names and modules of the functions and contexts
+    PyObject *string_ids; // maps a string to its index in strings
+    _htab *indexes; // the indexes of the functions added
+} _statcolumns;
+
+// the sort types of the top functions selected in C
+typedef enum {
+    TOP_NCALL,
+    TOP_TTOT,
+    TOP_TSUB,
+    TOP_TAVG,
+    TOP_TTOT_CPU,
+    TOP_TSUB_CPU,
+    TOP_TMAX,
+} _topsort_t;
+
+// the stats of the pits of a function summed over the contexts and tags. The
+// pits of the same full_name are of the same function, like in yappi.py.
+typedef struct _topfunc {
+    PyObject *name; // borrowed from the first pit of the function
+    PyObject *modname;
+    long lineno; // -1 for builtins, their lineno is not part of the full_name
+    unsigned long order; // the functions enumerated first win the ties
+    struct _topfunc *next; // another function of the same hash
+    unsigned long callcount;
+    long long ttotal;
+    long long tsubtotal;
+    long long cpu_ttotal;
+    long long cpu_tsubtotal;
+    long long tmax;
+    double value; // to be sorted by, negated for the ascending order
+} _topfunc;
+
+typedef struct {
+    _topsort_t sort_type;
+    int ascending;
+    _htab *funcs; // hash:_topfunc list of every function enumerated
+    unsigned long nfuncs;
+    _htab *pits; // index:_pit of every pit enumerated
+    _htab *pitfuncs; // index:_topfunc of every pit enumerated
+    _htab *top; // the _topfuncs selected
+    _htab *selected; // the _topfuncs selected and their children
+    PyObject *indexes; // of the pits of the selected functions
+} _topargs;
+
 typedef struct
 {
     _fast_func_stat_filter func_filter;
     PyObject *enumfn;
+    _statcolumns *columns; // the pits are added to the columns instead of enumfn if set
+    _topargs *top; // only the pits of the top functions are enumerated if set
 } _ctxenumarg;
 
 typedef struct
@@ -146,6 +309,12 @@ typedef struct
 typedef struct {
     int builtins;
     int multicontext;
+    int engine;
+    int histograms;
+    int trace_buffer; // the number of events kept per context, 0 to disable
+    int trace_stream; // stream the events to the trace file
+    int call_paths; // build the calling context trees
+    unsigned long writer_tid; // the thread writing the trace file, not profiled
 } _flag; // flags passed from yappi.start()
 
 typedef enum
@@ -154,11 +323,18 @@ typedef enum
     GREENLET = 0x01,
 } _ctx_type_t;
 
+typedef enum
+{
+    SETPROFILE_ENGINE = 0x00,
+    MONITORING_ENGINE = 0x01, // sys.monitoring (PEP 669), Python 3.12+
+    SAMPLING_ENGINE = 0x02, // no hooks, the call stacks are sampled (see sample())
+} _engine_type_t;
+
 // globals
 static PyObject *YappiProfileError;
 static _htab *contexts;
+static ymutex_t contexts_lock; // guards contexts and flctx
 static _flag flags;
-static _freelist *flpit;
 static _freelist *flctx;
 static int yappinitialized;
 static unsigned int ycurfuncindex; // used for providing unique index for functions
@@ -167,19 +343,44 @@ static int yapphavestats;   // start() called at least once or stats cleared?
 static int yapprunning;
 static int paused;
 static volatile int _callback_depth = 0;
+#ifdef Py_GIL_DISABLED
+static int _events_in_progress = 0; // see _wait_for_events()
+static YTHREAD_LOCAL int _event_depth = 0; // events in progress on this thread
+#endif
 static time_t yappstarttime;
 static long long yappstarttick;
 static long long yappstoptick;
 static tls_key_t* tl_prev_ctx_key = NULL;
-static _ctx *prev_ctx = NULL;
-static _ctx *current_ctx = NULL;
+static tls_key_t* tl_current_ctx_key = NULL; // _ctx of the thread, see _current_thread_ctx()
+static YTHREAD_LOCAL _ctx *prev_ctx = NULL;
+static YTHREAD_LOCAL _ctx *current_ctx = NULL;
 static _ctx *initial_ctx = NULL; // used for holding the context that called start()
 static PyObject *context_id_callback = NULL;
 static PyObject *tag_callback = NULL;
+static PyObject *tag_contextvar = NULL; // read instead of tag_callback if set
 static PyObject *context_name_callback = NULL;
+static PyObject *module_filter = NULL; // decides which modules are profiled
+static _htab *module_filter_cache = NULL; // key:excluded for functions seen
+static ymutex_t module_filter_lock;
 static PyObject *test_timings; // used for testing
 static const uintptr_t DEFAULT_TAG = 0;
+static Py_ssize_t code_extra_index = -1; // co_extra slot holding the fid
+static uintptr_t ycurfid = 0; // last fid given to a PyCodeObject
+static uintptr_t *free_fids = NULL; // fids of the deallocated PyCodeObjects
+static unsigned int free_fids_head = 0;
+static unsigned int free_fids_size = 0;
+static ymutex_t fids_lock; // guards ycurfid and free_fids
 static _ctx_type_t ctx_type = NATIVE_THREAD;
+static unsigned long sample_gen = 0; // incremented on every start() in sampling mode
+static PyFrameObject **sampled_frames = NULL; // the frames of the thread being sampled
+static int sampled_frames_size = 0;
+static _overhead call_overhead[CLOCK_TYPE_COUNT][2]; // [clock type][builtin], see _calibrate()
+static int calibrated[CLOCK_TYPE_COUNT]; // [clock type]
+static _overhead *overhead = NULL; // call_overhead of the running clock type
+static _streamchunk *stream_head = NULL; // the full chunks to be written, see take_trace()
+static _streamchunk *stream_tail = NULL;
+static ymutex_t stream_lock; // guards stream_head and stream_tail
+static int dualclock = 0; // the CPU time is measured along with the wall time
 
 // defines
 #define UNINITIALIZED_STRING_VAL "N/A"
@@ -190,6 +391,35 @@ static _ctx_type_t ctx_type = NATIVE_THREAD;
 #define PyStr_FromFormatV(fmt, vargs) PyUnicode_FromFormatV(fmt, vargs)
 
 #define PyLong_AsVoidPtr (uintptr_t)PyLong_AsVoidPtr
+
+#if PY_VERSION_HEX < 0x030C0000 // renamed in Python 3.12
+#define PyUnstable_Eval_RequestCodeExtraIndex _PyEval_RequestCodeExtraIndex
+#define PyUnstable_Code_GetExtra _PyCode_GetExtra
+#define PyUnstable_Code_SetExtra _PyCode_SetExtra
+#endif
+
+#if PY_VERSION_HEX < 0x03090000 // added in Python 3.9
+static uint64_t
+PyThreadState_GetID(PyThreadState *ts)
+{
+    return ts->id;
+}
+
+// new references like the Python 3.9+ functions
+static PyFrameObject *
+PyThreadState_GetFrame(PyThreadState *ts)
+{
+    Py_XINCREF(ts->frame);
+    return ts->frame;
+}
+
+static PyFrameObject *
+PyFrame_GetBack(PyFrameObject *frame)
+{
+    Py_XINCREF(frame->f_back);
+    return frame->f_back;
+}
+#endif
  
 // forwards
 static _ctx * _profile_thread(PyThreadState *ts);
@@ -199,10 +429,13 @@ static int _pitenumdel(_hitem *item, void *arg);
 
 // funcs
 
+// returns a borrowed reference, the frame holds a reference to its code.
 static PyCodeObject *
 FRAME2CODE(PyFrameObject *frame) {
 #if PY_VERSION_HEX >= 0x030A0000 // Python 3.10+
-    return PyFrame_GetCode(frame);
+    PyCodeObject *cobj = PyFrame_GetCode(frame);
+    Py_DECREF(cobj);
+    return cobj;
 #else
     return frame->f_code;
 #endif
@@ -275,7 +508,7 @@ _create_pit(void)
 {
     _pit *pit;
 
-    pit = flget(flpit);
+    pit = flget(current_ctx->flpit);
     if (!pit)
         return NULL;
     
@@ -283,14 +516,27 @@ _create_pit(void)
     pit->nonrecursive_callcount = 0;
     pit->ttotal = 0;
     pit->tsubtotal = 0;
+    pit->cpu_ttotal = 0;
+    pit->cpu_tsubtotal = 0;
+    pit->rec_level = 0;
     pit->name = NULL;
     pit->modname = NULL;
     pit->lineno = 0;
     pit->builtin = 0;
+    pit->excluded = 0;
+    pit->key = 0;
+#ifdef Py_GIL_DISABLED
+    pit->index = _Py_atomic_add_uint(&ycurfuncindex, 1);
+#else
     pit->index = ycurfuncindex++;
+#endif
     pit->children = NULL;
+    pit->nchildren = 0;
+    pit->children_index = NULL;
     pit->coroutines = NULL;
     pit->fn_descriptor = NULL;
+    pit->cls = NULL;
+    pit->hist = NULL;
 
     return pit;
 }
@@ -310,6 +556,26 @@ _create_ctx(void)
     ctx->tags = htcreate(HT_TAG_SIZE);
     if (!ctx->tags)
         return NULL;
+    ctx->flpit = flcreate(sizeof(_pit), FL_PIT_SIZE);
+    if (!ctx->flpit)
+        return NULL;
+    ctx->flchildren = flcreate(sizeof(_pit_children_info), FL_CHILDREN_SIZE);
+    if (!ctx->flchildren)
+        return NULL;
+    ctx->flcoro = flcreate(sizeof(_coro), FL_CORO_SIZE);
+    if (!ctx->flcoro)
+        return NULL;
+    ctx->flcct = flcreate(sizeof(_cctnode), FL_CCT_SIZE);
+    if (!ctx->flcct)
+        return NULL;
+    ctx->cct = NULL;
+    ctx->cct_count = 0;
+    ctx->last_tag = 0;
+    ctx->last_tagged_pits = NULL;
+    ctx->overhead = 0;
+    ctx->sample_gen = 0;
+    ctx->trace = NULL;
+    ctx->stream = NULL;
 
     ctx->sched_cnt = 0;
     ctx->id = 0;
@@ -317,9 +583,6 @@ _create_ctx(void)
     ctx->name = NULL;
     ctx->t0 = tickcount();
     ctx->last_seen = ctx->t0;
-    ctx->rec_levels = htcreate(HT_RLEVEL_SIZE);
-    if (!ctx->rec_levels)
-        return NULL;
     return ctx;
 }
 
@@ -336,9 +599,15 @@ _call_funcobjargs(PyObject *func, PyObject *args)
 
     _local_current_ctx = current_ctx;
     _local_prev_ctx = prev_ctx;
+#ifdef Py_GIL_DISABLED
+    _Py_atomic_add_int((int *)&_callback_depth, 1);
+    result = PyObject_CallFunctionObjArgs(func, args, NULL);
+    _Py_atomic_add_int((int *)&_callback_depth, -1);
+#else
     _callback_depth++;
-    result = PyObject_CallFunctionObjArgs(func, args);
+    result = PyObject_CallFunctionObjArgs(func, args, NULL);
     _callback_depth--;
+#endif
     current_ctx = _local_current_ctx;
     prev_ctx = _local_prev_ctx;
 
@@ -382,12 +651,49 @@ later:
     return NULL;
 }
 
+// reads the tag from tag_contextvar without running any Python code. The
+// ContextVar caches its value per thread and only looks it up again when the
+// current context is switched or the var is set.
+static uintptr_t
+_current_contextvar_tag(void)
+{
+    PyObject *val;
+    uintptr_t result;
+
+    if (PyContextVar_Get(tag_contextvar, NULL, &val) < 0) {
+        PyErr_Print();
+        goto error;
+    }
+
+    if (!val) {
+        // not set in this context and has no default
+        result = DEFAULT_TAG;
+    } else {
+        result = PyLong_AsVoidPtr(val);
+        Py_DECREF(val);
+        if (PyErr_Occurred()) {
+            yerr("tag contextvar holds a non-integer (overflow?)");
+            goto error;
+        }
+    }
+
+    return result;
+error:
+    PyErr_Clear();
+    Py_CLEAR(tag_contextvar); // don't use the contextvar again
+    return 0;
+}
+
 static uintptr_t
 _current_tag(void)
 {
     PyObject *r;
     uintptr_t result;
 
+    if (tag_contextvar) {
+        return _current_contextvar_tag();
+    }
+
     if (!tag_callback) {
         return DEFAULT_TAG;
     }
@@ -460,7 +766,12 @@ _current_context_id(PyThreadState *ts)
 
         ytid = PyDict_GetItemString(ts->dict, "_yappi_tid");
         if (!ytid) {
+#ifdef Py_GIL_DISABLED
+            ytid = PyLong_FromLongLong(
+                _Py_atomic_add_int64((int64_t *)&ycurthreadindex, 1));
+#else
             ytid = PyLong_FromLongLong(ycurthreadindex++);
+#endif
             if (!ytid) {
                 PyErr_Clear();
                 return 0;
@@ -489,9 +800,17 @@ error:
 static _ctx *
 _thread2ctx(PyThreadState *ts)
 {
+    uintptr_t ctx_id;
+    _ctx *ctx;
     _hitem *it;
-    it = hfind(contexts, _current_context_id(ts));
-    if (!it) {
+
+    ctx_id = _current_context_id(ts);
+    ylock(&contexts_lock);
+    it = hfind(contexts, ctx_id);
+    // the item can be moved by a concurrent hadd once the lock is released
+    ctx = it ? (_ctx *)it->val : NULL;
+    yunlock(&contexts_lock);
+    if (!ctx) {
         // callback functions in some circumtances, can be called before the context entry is not
         // created. (See issue 21). To prevent this problem we need to ensure the context entry for
         // the thread is always available here.
@@ -499,27 +818,53 @@ _thread2ctx(PyThreadState *ts)
         // This path is also excercised when new greenlets are encountered on an already profiled thread.
         return _profile_thread(ts);
     }
-    return (_ctx *)it->val;
+    return ctx;
 }
 
-// the pit will be cleared by the relevant freelist. we do not free it here.
-// we only DECREF the CodeObject or the MethodDescriptive string.
-static void
-_del_pit(_pit *pit)
+// returns the _ctx of the running thread. The _ctx of a native thread never
+// changes, so it is cached in a thread specific storage to avoid resolving
+// the context id and looking up the contexts table on every event. With a
+// context id callback (e.g: greenlets) the context may change at any time,
+// so it is resolved each time.
+static _ctx *
+_current_thread_ctx(PyThreadState *ts)
 {
-    // the pit will be freed by fldestrot() in clear_stats, otherwise it stays
-    // for later enumeration
-    _pit_children_info *it,*next;
+    _ctx *ctx;
+
+    if (context_id_callback) {
+        return _thread2ctx(ts);
+    }
+
+    ctx = (_ctx *)get_tls_key_value(tl_current_ctx_key);
+    if (ctx && ctx->ts_ptr == ts && ctx->ts_id == PyThreadState_GetID(ts)) {
+        return ctx;
+    }
 
-    // free children
-    it = pit->children;
-    while(it) {
-        next = (_pit_children_info *)it->next;
-        yfree(it);
-        it = next;
+    ctx = _thread2ctx(ts);
+    if (ctx && ctx->ts_ptr == ts) {
+        set_tls_key_value(tl_current_ctx_key, ctx);
     }
+    return ctx;
+}
+
+// the pit, its children and coroutines will be cleared by the relevant
+// freelists. we do not free them here. we only DECREF the CodeObject or the
+// MethodDescriptive string.
+static void
+_del_pit(_pit *pit)
+{
     pit->children = NULL;
+    pit->coroutines = NULL;
+    if (pit->children_index) {
+        htdestroy(pit->children_index);
+        pit->children_index = NULL;
+    }
+    if (pit->hist) {
+        histdestroy(pit->hist);
+        pit->hist = NULL;
+    }
     Py_DECREF(pit->fn_descriptor);
+    Py_XDECREF(pit->cls);
 }
 
 static PyObject *
@@ -554,27 +899,253 @@ error:
     return PyStr_FromString("<unknown>");
 }
 
-_htab *
-_get_pits_tbl(uintptr_t current_tag)
+static _tagged_pits *
+_create_tagged_pits(void)
+{
+    _tagged_pits *tp;
+
+    tp = ymalloc(sizeof(_tagged_pits));
+    if (!tp) {
+        return NULL;
+    }
+    tp->pits = htcreate(HT_TAGGED_PIT_SIZE);
+    if (!tp->pits) {
+        yfree(tp);
+        return NULL;
+    }
+    tp->pages = NULL;
+    tp->npages = 0;
+
+    return tp;
+}
+
+static void
+_del_tagged_pits(_tagged_pits *tp)
+{
+    unsigned int i;
+
+    for (i = 0; i < tp->npages; i++) {
+        if (tp->pages[i]) {
+            yfree(tp->pages[i]);
+        }
+    }
+    if (tp->pages) {
+        yfree(tp->pages);
+    }
+    htdestroy(tp->pits);
+    yfree(tp);
+}
+
+static _tagged_pits *
+_get_tagged_pits(uintptr_t current_tag)
 {
     _hitem *it;
-    _htab *pits;
+    _tagged_pits *tp;
+
+    if (current_ctx->last_tagged_pits && current_ctx->last_tag == current_tag) {
+        return current_ctx->last_tagged_pits;
+    }
 
     it = hfind(current_ctx->tags, current_tag);
     if (!it) {
-        pits = htcreate(HT_TAGGED_PIT_SIZE);
-        if (!pits) {
+        tp = _create_tagged_pits();
+        if (!tp) {
             return NULL;
         }
 
-        if (!hadd(current_ctx->tags, current_tag, (uintptr_t)pits)) {
+        if (!hadd(current_ctx->tags, current_tag, (uintptr_t)tp)) {
+            _del_tagged_pits(tp);
             return NULL;
         }
+    } else {
+        tp = (_tagged_pits *)it->val;
+    }
+
+    current_ctx->last_tag = current_tag;
+    current_ctx->last_tagged_pits = tp;
+
+    return tp;
+}
+
+static _pit *
+_fid2pit(_tagged_pits *tp, uintptr_t fid)
+{
+    uintptr_t page;
+
+    page = fid / PIT_PAGE_SIZE;
+    if (page >= tp->npages || !tp->pages[page]) {
+        return NULL;
+    }
+    return tp->pages[page][fid & (PIT_PAGE_SIZE-1)];
+}
+
+static int
+_set_fid2pit(_tagged_pits *tp, uintptr_t fid, _pit *pit)
+{
+    uintptr_t page;
+    unsigned int npages;
+    _pit ***pages;
+
+    page = fid / PIT_PAGE_SIZE;
+    if (page >= tp->npages) {
+        npages = (unsigned int)page * 2 + 1;
+        pages = ymalloc(npages * sizeof(_pit **));
+        if (!pages) {
+            return 0;
+        }
+        memset(pages, 0, npages * sizeof(_pit **));
+        if (tp->pages) {
+            memcpy(pages, tp->pages, tp->npages * sizeof(_pit **));
+            yfree(tp->pages);
+        }
+        tp->pages = pages;
+        tp->npages = npages;
+    }
+    if (!tp->pages[page]) {
+        tp->pages[page] = ymalloc(PIT_PAGE_SIZE * sizeof(_pit *));
+        if (!tp->pages[page]) {
+            return 0;
+        }
+        memset(tp->pages[page], 0, PIT_PAGE_SIZE * sizeof(_pit *));
+    }
+    tp->pages[page][fid & (PIT_PAGE_SIZE-1)] = pit;
+
+    return 1;
+}
+
+// called by the interpreter when a PyCodeObject with a fid is deallocated.
+// A PyCodeObject cannot be deallocated while a pit holds a reference to it,
+// so its fid is not in any _tagged_pits and can be given to another one.
+static void
+_free_code_extra(void *extra)
+{
+    uintptr_t *fids;
+
+    ylock(&fids_lock);
+    if (free_fids_head == free_fids_size) {
+        fids = ymalloc((free_fids_size + FID_STACK_SIZE) * sizeof(uintptr_t));
+        if (!fids) {
+            yunlock(&fids_lock);
+            return; // the fid is leaked
+        }
+        if (free_fids) {
+            memcpy(fids, free_fids, free_fids_size * sizeof(uintptr_t));
+            yfree(free_fids);
+        }
+        free_fids = fids;
+        free_fids_size += FID_STACK_SIZE;
+    }
+    free_fids[free_fids_head++] = (uintptr_t)extra;
+    yunlock(&fids_lock);
+}
+
+// returns the function id of a PyCodeObject or 0 if there is none. The fid
+// is cached in the co_extra of the code object so that the pit of a code
+// object can be found with a direct array index instead of hashing.
+static uintptr_t
+_code2fid(PyCodeObject *cobj)
+{
+    void *extra;
+    uintptr_t fid;
+
+    if (code_extra_index < 0) {
+        return 0;
+    }
+
+    if (PyUnstable_Code_GetExtra((PyObject *)cobj, code_extra_index, &extra) < 0) {
+        PyErr_Clear();
+        return 0;
+    }
+    if (extra) {
+        return (uintptr_t)extra;
+    }
+
+    ylock(&fids_lock);
+#ifdef Py_GIL_DISABLED
+    // another thread might have given a fid to the code object meanwhile
+    if (PyUnstable_Code_GetExtra((PyObject *)cobj, code_extra_index, &extra) < 0) {
+        PyErr_Clear();
+        yunlock(&fids_lock);
+        return 0;
+    }
+    if (extra) {
+        yunlock(&fids_lock);
+        return (uintptr_t)extra;
+    }
+#endif
+    if (free_fids_head) {
+        fid = free_fids[--free_fids_head];
+    } else {
+        fid = ++ycurfid;
+    }
+    if (PyUnstable_Code_SetExtra((PyObject *)cobj, code_extra_index, (void *)fid) < 0) {
+        PyErr_Clear();
+        yunlock(&fids_lock);
+        _free_code_extra((void *)fid);
+        return 0;
+    }
+    yunlock(&fids_lock);
+
+    return fid;
+}
+
+// returns 1 if the function is known to be excluded from profiling.
+static int
+_excluded(uintptr_t key)
+{
+    _hitem *it;
+    int excluded;
+
+    ylock(&module_filter_lock);
+    it = hfind(module_filter_cache, key);
+    excluded = it ? (int)it->val : 0;
+    yunlock(&module_filter_lock);
+    return excluded;
+}
+
+// decides whether a function shall be profiled or not by calling the
+// module_filter with the module name of the function. The result is cached
+// per function (see _excluded) so the filter is called only once per code
+// object/builtin during a profile session.
+static int
+_module_filter_excludes(uintptr_t key, PyObject *modname)
+{
+    PyObject *r;
+    _hitem *it;
+    int excluded;
+
+    ylock(&module_filter_lock);
+    it = hfind(module_filter_cache, key);
+    yunlock(&module_filter_lock);
+    if (!module_filter || it) {
+        return _excluded(key);
+    }
+
+    r = _call_funcobjargs(module_filter, modname);
+    if (!r) {
+        PyErr_Print();
+        goto error;
+    }
+    excluded = PyObject_Not(r);
+    Py_DECREF(r);
+    if (excluded < 0) {
+        goto error;
+    }
 
-        return pits;
+    // another thread might have added the key meanwhile, the results of
+    // the filter are the same.
+    ylock(&module_filter_lock);
+    if (!hfind(module_filter_cache, key) &&
+            !hadd(module_filter_cache, key, (uintptr_t)excluded)) {
+        _log_err(16);
     }
+    yunlock(&module_filter_lock);
+    return excluded;
 
-    return (_htab *)it->val;
+error:
+    PyErr_Clear();
+    Py_CLEAR(module_filter); // don't use filter again
+    return 0;
 }
 
 static _pit *
@@ -584,11 +1155,13 @@ _ccode2pit(void *cco, uintptr_t current_tag)
     _hitem *it;
     PyObject *name, *mo, *obj_type, *method_descriptor;
     _htab *pits;
+    _tagged_pits *tp;
 
-    pits = _get_pits_tbl(current_tag);
-    if (!pits) {
+    tp = _get_tagged_pits(current_tag);
+    if (!tp) {
         return NULL;
     }
+    pits = tp->pits;
 
     cfn = cco;
     // Issue #15:
@@ -604,9 +1177,11 @@ _ccode2pit(void *cco, uintptr_t current_tag)
             return NULL;
 
         pit->builtin = 1;
+        pit->key = (uintptr_t)cfn->m_ml;
         pit->modname = _pycfunction_module_name(cfn);
         pit->lineno = 0;
         pit->fn_descriptor = NULL;
+        pit->excluded = _module_filter_excludes(pit->key, pit->modname);
 
         // built-in method?
         if (cfn->m_self != NULL) {
@@ -655,81 +1230,121 @@ fallback_name:
     return ((_pit *)it->val);
 }
 
-static PyObject *_get_locals(PyFrameObject *fobj) {
-#if PY_VERSION_HEX >= 0x030A0000 // Python 3.10+
-    return PyEval_GetLocals();
+#if PY_VERSION_HEX >= 0x030B0000 // Python 3.11+
+// returns "Class.method" from the qualified name of a method, e.g:
+// "outer.<locals>.Class.method", or NULL if it is not defined in a class.
+static PyObject *
+_qualname2name(PyCodeObject *cobj)
+{
+    const char *qualname, *start;
+
+    qualname = PyStr_AS_CSTRING(cobj->co_qualname);
+    if (!qualname) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    // the class is the component before the last one
+    start = strrchr(qualname, '.');
+    if (!start) {
+        return NULL;
+    }
+    while (start > qualname && *(start-1) != '.') {
+        start--;
+    }
+    if (*start == '<') { // a nested function, e.g: "<locals>.method"
+        return NULL;
+    }
+    return PyStr_FromString(start);
+}
 #else
-    PyFrame_FastToLocals(fobj);
-    PyObject* locals = fobj->f_locals;
-    PyFrame_LocalsToFast(fobj, 0);
-    return locals;
-#endif
+// returns a new reference to the "self" argument of the frame or NULL. The
+// arguments are the first fast locals unless "self" is a cell, only then the
+// locals dict is built.
+static PyObject *
+_get_self(PyFrameObject *fobj)
+{
+    PyObject *self;
+
+    self = fobj->f_localsplus[0];
+    if (!self && PyFrame_FastToLocalsWithError(fobj) == 0 && fobj->f_locals) {
+        self = PyDict_GetItemString(fobj->f_locals, "self");
+    }
+    PyErr_Clear();
+    Py_XINCREF(self);
+    return self;
 }
+#endif
 
-// maps the PyCodeObject to our internal pit item via hash table.
+// maps the PyCodeObject to our internal pit item via its fid. Falls back to
+// the hash table if the PyCodeObject has no fid.
 static _pit *
 _code2pit(PyFrameObject *fobj, uintptr_t current_tag)
 {
     _hitem *it;
     PyCodeObject *cobj;
     _pit *pit;
-    _htab *pits;
-    PyObject *co_varnames;
+    _tagged_pits *tp;
+    uintptr_t fid;
+    const char *firstarg;
 
-    pits = _get_pits_tbl(current_tag);
-    if (!pits) {
+    tp = _get_tagged_pits(current_tag);
+    if (!tp) {
         return NULL;
     }
 
     cobj = FRAME2CODE(fobj);
-    it = hfind(pits, (uintptr_t)cobj);
-    if (it) {
-        return ((_pit *)it->val);
+    fid = _code2fid(cobj);
+    if (fid) {
+        pit = _fid2pit(tp, fid);
+        if (pit) {
+            return pit;
+        }
+    } else {
+        it = hfind(tp->pits, (uintptr_t)cobj);
+        if (it) {
+            return ((_pit *)it->val);
+        }
     }
 
     pit = _create_pit();
     if (!pit)
         return NULL;
-    if (!hadd(pits, (uintptr_t)cobj, (uintptr_t)pit))
+    if (!hadd(tp->pits, (uintptr_t)cobj, (uintptr_t)pit))
         return NULL;
+    if (fid && !_set_fid2pit(tp, fid, pit)) {
+        _log_err(17);
+    }
 
     pit->name = NULL;
+    pit->key = (uintptr_t)cobj;
     Py_INCREF(cobj->co_filename);
     pit->modname = cobj->co_filename;
     pit->lineno = cobj->co_firstlineno;
     pit->fn_descriptor = (PyObject *)cobj;
     Py_INCREF(cobj);
+    pit->excluded = _module_filter_excludes(pit->key, pit->modname);
 
-    if (cobj->co_argcount) {
-        // There has been a lot going on with `co_varnames`, but finally in 
-        // 3.11.0rc1, it is added as a public API
+    // no need to resolve the class name of an excluded method
+    if (cobj->co_argcount && !pit->excluded) {
 #if PY_VERSION_HEX >= 0x030B0000 // Python 3.11+
-        co_varnames = PyCode_GetVarnames(cobj);
+        firstarg = PyStr_AS_CSTRING(PyTuple_GET_ITEM(cobj->co_localsplusnames, 0));
 #else
-        co_varnames = cobj->co_varnames;
+        firstarg = PyStr_AS_CSTRING(PyTuple_GET_ITEM(cobj->co_varnames, 0));
 #endif
-        const char *firstarg = PyStr_AS_CSTRING(PyTuple_GET_ITEM(co_varnames, 0));
-
         if (!strcmp(firstarg, "self")) {
-            PyObject* locals = _get_locals(fobj);
-            if (locals) {
-                PyObject* self = PyDict_GetItemString(locals, "self");
-                if (self) {
-                    PyObject *class_obj = PyObject_GetAttrString(self, "__class__");
-                    if (class_obj) {
-                        PyObject *class_name = PyObject_GetAttrString(class_obj, "__name__");
-                        if (class_name) {
-                            pit->name = PyStr_FromFormat("%s.%s", PyStr_AS_CSTRING(class_name), PyStr_AS_CSTRING(cobj->co_name));
-                            Py_DECREF(class_name);
-                        } else {
-                            PyErr_Clear();
-                        }
-                        Py_DECREF(class_obj);
-                    } else {
-                        PyErr_Clear();
-                    }
-                }
+#if PY_VERSION_HEX >= 0x030B0000 // Python 3.11+
+            pit->name = _qualname2name(cobj);
+#else
+            // the name is formatted when the stats are read (see
+            // _resolve_pit_name), only the class is kept here.
+            PyObject *self = _get_self(fobj);
+            if (self) {
+                pit->cls = (PyObject *)Py_TYPE(self);
+                Py_INCREF(pit->cls);
+                Py_DECREF(self);
             }
+#endif
         }
     }
     if (!pit->name) {
@@ -755,38 +1370,108 @@ _get_frame(void)
 static _cstackitem *
 _push_frame(_pit *cp)
 {
-    return spush(current_ctx->cs, cp);
+    _cstackitem *ci;
+
+    ci = spush(current_ctx->cs, cp);
+    if (ci) {
+        ci->node = NULL;
+    }
+    return ci;
 }
 
-static _pit *
-_pop_frame(void)
+static _cctnode *
+_new_cctnode(_cctnode *parent, _pit *cp)
 {
-    _cstackitem *ci;
+    _cctnode *node;
 
-    ci = spop(current_ctx->cs);
-    if (!ci) {
+    node = flget(current_ctx->flcct);
+    if (!node) {
         return NULL;
     }
-    return ci->ckey;
+    node->pit = cp;
+    node->id = current_ctx->cct_count++;
+    node->callcount = 0;
+    node->ttotal = 0;
+    node->tsubtotal = 0;
+    node->parent = parent;
+    node->children = NULL;
+    node->next = NULL;
+    if (parent) {
+        node->next = parent->children;
+        parent->children = node;
+    }
+    return node;
 }
 
-static _pit_children_info *
-_add_child_info(_pit *parent, _pit *current)
+// returns the node of cp called from the call path on the stack, the
+// functions pushed without a node are skipped.
+static _cctnode *
+_cct_enter(_pit *cp)
 {
-    _pit_children_info *newci;
+    _cstack *cs;
+    _cctnode *parent, *node;
+    int i;
 
-    // TODO: Optimize by moving to a freelist?
-    newci = ymalloc(sizeof(_pit_children_info));
-    if (!newci) {
-        return NULL;
+    if (!current_ctx->cct) {
+        current_ctx->cct = _new_cctnode(NULL, NULL);
+        if (!current_ctx->cct) {
+            return NULL;
+        }
+    }
+
+    cs = current_ctx->cs;
+    parent = current_ctx->cct;
+    for (i = cs->head; i >= 0; i--) {
+        if (cs->_items[i].node) {
+            parent = cs->_items[i].node;
+            break;
+        }
+    }
+
+    for (node = parent->children; node; node = node->next) {
+        if (node->pit == cp) {
+            return node;
+        }
+    }
+    return _new_cctnode(parent, cp);
+}
+
+static _pit_children_info *
+_add_child_info(_pit *parent, _pit *current)
+{
+    _pit_children_info *newci, *it;
+
+    newci = flget(current_ctx->flchildren);
+    if (!newci) {
+        return NULL;
     }
     newci->index = current->index;
     newci->callcount = 0;
     newci->nonrecursive_callcount = 0;
     newci->ttotal = 0;
     newci->tsubtotal = 0;
+    newci->cpu_ttotal = 0;
+    newci->cpu_tsubtotal = 0;
+    newci->rec_level = 0;
     newci->next = (struct _pit_children_info *)parent->children;
     parent->children = (_pit_children_info *)newci;
+    parent->nchildren++;
+
+    if (parent->children_index) {
+        if (!hadd(parent->children_index, newci->index, (uintptr_t)newci)) {
+            return NULL;
+        }
+    } else if (parent->nchildren > CHILDREN_INDEX_THRESHOLD) {
+        parent->children_index = htcreate(HT_CHILDREN_INDEX_SIZE);
+        if (!parent->children_index) {
+            return NULL;
+        }
+        for (it = parent->children; it; it = (_pit_children_info *)it->next) {
+            if (!hadd(parent->children_index, it->index, (uintptr_t)it)) {
+                return NULL;
+            }
+        }
+    }
 
     return newci;
 }
@@ -795,17 +1480,23 @@ static _pit_children_info *
 _get_child_info(_pit *parent, _pit *current, int add_if_not_exists)
 {
     _pit_children_info *citem;
+    _hitem *it;
 
     if (!parent || !current) {
         return NULL;
     }
 
-    citem = parent->children;
-    while(citem) {
-        if (citem->index == current->index) {
-            break;
+    if (parent->children_index) {
+        it = hfind(parent->children_index, current->index);
+        citem = it ? (_pit_children_info *)it->val : NULL;
+    } else {
+        citem = parent->children;
+        while(citem) {
+            if (citem->index == current->index) {
+                break;
+            }
+            citem = (_pit_children_info *)citem->next;
         }
-        citem = (_pit_children_info *)citem->next;
     }
 
     if (add_if_not_exists && !citem) {
@@ -815,58 +1506,14 @@ _get_child_info(_pit *parent, _pit *current, int add_if_not_exists)
     return citem;
 }
 
-static uintptr_t
-get_rec_level(uintptr_t key)
-{
-    _hitem *it;
-
-    it = hfind(current_ctx->rec_levels, key);
-    if (!it) {
-        _log_err(1);
-        return -1; // should not happen
-    }
-    return it->val;
-}
-
-static int
-incr_rec_level(uintptr_t key)
-{
-    _hitem *it;
-
-    it = hfind(current_ctx->rec_levels, key);
-    if (it) {
-        it->val++;
-    } else {
-        if (!hadd(current_ctx->rec_levels, key, 1))
-        {
-            _log_err(2);
-            return 0; // should not happen
-        }
-    }
-    return 1;
-}
-
-static int
-decr_rec_level(uintptr_t key)
+static void
+_decr_rec_level(unsigned long *rec_level)
 {
-    _hitem *it;
-    uintptr_t v;
-
-    it = hfind(current_ctx->rec_levels, key);
-    if (it) {
-        v = it->val--;  /*supress warning -- it is safe to cast long vs pointers*/
-        if (v == 0)
-        {
-            hfree(current_ctx->rec_levels, it);
-        }
-    } else {
-        _log_err(3);
-        return 0; // should not happen
+    if (*rec_level) {
+        (*rec_level)--;
     }
-    return 1;
 }
 
-
 static long long
 _ctx_tickcount(void) {
     long long now;
@@ -890,9 +1537,8 @@ _get_frame_elapsed(void)
     cp = ci->ckey;
 
     if (test_timings) {
-        uintptr_t rlevel = get_rec_level((uintptr_t)cp);
         PyObject *formatted_string = PyStr_FromFormat(
-                "%s_%d", PyStr_AS_CSTRING(cp->name), rlevel);
+                "%s_%lu", PyStr_AS_CSTRING(cp->name), cp->rec_level);
 
         PyObject *tval = PyDict_GetItem(test_timings, formatted_string);
         Py_DECREF(formatted_string);
@@ -927,8 +1573,8 @@ _coro_enter(_pit *cp, PyFrameObject *frame)
 {
     _coro *coro;
 
-    if (!(get_timing_clock_type() == WALL_CLOCK) || 
-        (get_rec_level((uintptr_t)cp) != 1)) {
+    if (!IS_WALL_CLOCK(get_timing_clock_type()) || 
+        (cp->rec_level != 1)) {
             return 0;
     }
 
@@ -943,7 +1589,7 @@ _coro_enter(_pit *cp, PyFrameObject *frame)
 
     //printf("CORO ENTER %s %p %lld\n", PyStr_AS_CSTRING(cp->name), frame, tickcount());
 
-    coro = ymalloc(sizeof(_coro));
+    coro = flget(current_ctx->flcoro);
     if (!coro) {
         return -1;
     }
@@ -966,8 +1612,8 @@ _coro_exit(_pit *cp, PyFrameObject *frame)
     _coro *coro, *prev;
     long long _t0;
 
-    if (!(get_timing_clock_type() == WALL_CLOCK) || 
-        (get_rec_level((uintptr_t)cp) != 1)) {
+    if (!IS_WALL_CLOCK(get_timing_clock_type()) || 
+        (cp->rec_level != 1)) {
             return 0;
     }
 
@@ -983,7 +1629,7 @@ _coro_exit(_pit *cp, PyFrameObject *frame)
             } else {
                 cp->coroutines = (_coro *)coro->next;
             }
-            yfree(coro);
+            flput(current_ctx->flcoro, coro);
             //printf("CORO EXIT(elapsed) %s %p %lld\n", PyStr_AS_CSTRING(cp->name), frame, tickcount()-_t0);
             return tickcount() - _t0;
         }
@@ -996,12 +1642,91 @@ _coro_exit(_pit *cp, PyFrameObject *frame)
 }
 
 
+// records a call event in the ring buffer of the current context
+static void
+_trace_event(_pit *cp, long long t, int what)
+{
+    // builtin functions are hidden from the stats too
+    if (cp->builtin && !flags.builtins) {
+        return;
+    }
+
+    if (!current_ctx->trace) {
+        current_ctx->trace = tbcreate(flags.trace_buffer);
+        if (!current_ctx->trace) {
+            _log_err(23);
+            return;
+        }
+    }
+    tbadd(current_ctx->trace, t, cp, what);
+}
+
+static void
+_queue_chunk(_streamchunk *chunk)
+{
+    ylock(&stream_lock);
+    if (stream_tail) {
+        stream_tail->next = chunk;
+    } else {
+        stream_head = chunk;
+    }
+    stream_tail = chunk;
+    yunlock(&stream_lock);
+}
+
+static void
+_free_stream(_streamchunk *chunk)
+{
+    _streamchunk *next;
+
+    while (chunk) {
+        next = chunk->next;
+        yfree(chunk);
+        chunk = next;
+    }
+}
+
+// records a call event in the chunk of the current context, the chunk is
+// queued for the trace writer once it is full. The hidden builtin functions
+// are recorded too, as their time is not accounted to their callers.
 static void
+_stream_event(_pit *cp, long long t, int what)
+{
+    _streamchunk *chunk;
+    _streamevent *ev;
+
+    chunk = current_ctx->stream;
+    if (!chunk) {
+        chunk = (_streamchunk *)ymalloc(sizeof(_streamchunk));
+        if (!chunk) {
+            _log_err(24);
+            return;
+        }
+        chunk->ctx_id = current_ctx->id;
+        chunk->count = 0;
+        chunk->next = NULL;
+        current_ctx->stream = chunk;
+    }
+
+    ev = &chunk->events[chunk->count++];
+    ev->t = t;
+    ev->index = cp->index;
+    ev->what = what;
+
+    if (chunk->count == STREAM_CHUNK_SIZE) {
+        current_ctx->stream = NULL;
+        _queue_chunk(chunk);
+    }
+}
+
+// returns 1 if the function is excluded from profiling, 0 otherwise.
+static int
 _call_enter(PyObject *self, PyFrameObject *frame, PyObject *arg, int ccall)
 {
     _pit *cp,*pp;
     _cstackitem *ci;
-    _pit_children_info *pci;
+    _pit_children_info *pci = NULL;
+    _cctnode *node;
     uintptr_t current_tag;
 
     // printf("call ENTER:%s %s\n", PyStr_AS_CSTRING(frame->f_code->co_filename),
@@ -1022,7 +1747,13 @@ _call_enter(PyObject *self, PyFrameObject *frame, PyObject *arg, int ccall)
     // a corresponding pit. just run away:)
     if (!cp) {
         _log_err(4);
-        return;
+        return 0;
+    }
+
+    // excluded functions are never pushed to the callstack, their time is
+    // accounted on the nearest profiled caller.
+    if (cp->excluded) {
+        return 1;
     }
 
     // create/update children info if we have a valid parent
@@ -1031,45 +1762,184 @@ _call_enter(PyObject *self, PyFrameObject *frame, PyObject *arg, int ccall)
         pci = _get_child_info(pp, cp, 1);
         if (!pci) {
             _log_err(12); // defensive runaway
-            return;
+            return 0;
+        }
+        pci->rec_level++;
+    }
+
+    // the hidden builtin functions get no node, their time is accounted to
+    // their caller like with the monitoring engine.
+    node = NULL;
+    if (flags.call_paths && (!cp->builtin || flags.builtins)) {
+        node = _cct_enter(cp);
+        if (!node) {
+            _log_err(25);
         }
-        incr_rec_level((uintptr_t)pci);
     }
 
     ci = _push_frame(cp);
     if (!ci) { // runaway! (defensive)
         _log_err(5);
-        return;
+        return 0;
     }
+    ci->node = node;
 
     ci->t0 = _ctx_tickcount();
+    ci->cinfo = pci;
+    ci->overhead = current_ctx->overhead;
+    if (dualclock) {
+        ci->cpu_t0 = cputickcount();
+    }
+    if (flags.trace_buffer) {
+        _trace_event(cp, ci->t0, TRACE_CALL);
+    }
+    if (flags.trace_stream) {
+        _stream_event(cp, ci->t0, TRACE_CALL);
+    }
 
-    incr_rec_level((uintptr_t)cp);
+    cp->rec_level++;
 
     // TODO: Comment
     if (IS_ASYNC(frame)) {
         _coro_enter(cp, frame);
     }
+
+    return 0;
+}
+
+// returns the profiler overhead (see _calibrate) in the elapsed time of a
+// returning call: the overhead inside its own measurement and the overhead
+// of all the calls it made. The latter is the increase of ctx->overhead since
+// the call is entered as they all returned before it.
+static double
+_call_overhead(_cstackitem *ci, _pit *cp)
+{
+    _overhead *ov;
+    double nested;
+
+    if (!overhead) {
+        return 0;
+    }
+
+    ov = &overhead[cp->builtin];
+    nested = current_ctx->overhead - ci->overhead;
+    current_ctx->overhead += ov->total;
+
+    return nested + ov->inner;
+}
+
+static long long
+_subtract_overhead(long long elapsed, double ov)
+{
+    elapsed -= (long long)(ov + 0.5);
+    if (elapsed < 0) {
+        return 0;
+    }
+    return elapsed;
+}
+
+// returns the pit of a returning function from the pits of the last tag of
+// the current context like _code2pit/_ccode2pit do on enter, or NULL if there
+// is none. No pit is created and the tag callback is not called.
+static _pit *
+_find_pit(PyFrameObject *frame, PyObject *arg, int ccall)
+{
+    _tagged_pits *tp;
+    _hitem *it;
+    PyCodeObject *cobj;
+    uintptr_t fid;
+
+    tp = current_ctx->last_tagged_pits;
+    if (!tp) {
+        return NULL;
+    }
+
+    if (ccall) {
+        it = hfind(tp->pits, (uintptr_t)((PyCFunctionObject *)arg)->m_ml);
+    } else {
+        cobj = FRAME2CODE(frame);
+        fid = _code2fid(cobj);
+        if (fid) {
+            return _fid2pit(tp, fid);
+        }
+        it = hfind(tp->pits, (uintptr_t)cobj);
+    }
+    return it ? (_pit *)it->val : NULL;
 }
 
 static void
+_cct_leave(_cctnode *node, long long elapsed, int yielded)
+{
+    if (!yielded) {
+        node->callcount++;
+    }
+    node->ttotal += elapsed;
+    node->tsubtotal += elapsed;
+    if (node->parent) {
+        node->parent->tsubtotal -= elapsed;
+    }
+}
+
+// returns 1 if the function is excluded from profiling, 0 otherwise.
+static int
 _call_leave(PyObject *self, PyFrameObject *frame, PyObject *arg, int ccall)
 {
-    long long elapsed;
-    _pit *cp, *pp, *ppp;
+    long long elapsed, cpu_elapsed;
+    double ov;
+    _pit *cp, *pp;
+    _cstackitem *ci;
     _pit_children_info *pci,*ppci;
+    uintptr_t key;
     int yielded = 0;
     pci = ppci = NULL;
 
     // printf("call LEAVE:%s %s\n", PyStr_AS_CSTRING(frame->f_code->co_filename),
     //                              PyStr_AS_CSTRING(frame->f_code->co_name));
 
+    // excluded functions are not on the callstack, do not pop their caller.
+    if (hcount(module_filter_cache)) {
+        cp = _find_pit(frame, arg, ccall);
+        if (cp) {
+            if (cp->excluded) {
+                return 1;
+            }
+        } else {
+            // entered with another tag or before the profiler was started
+            if (ccall) {
+                key = (uintptr_t)((PyCFunctionObject *)arg)->m_ml;
+            } else {
+                key = (uintptr_t)FRAME2CODE(frame);
+            }
+            if (_excluded(key)) {
+                return 1;
+            }
+        }
+    }
+
     elapsed = _get_frame_elapsed();
 
     // leaving a frame while callstack is empty?
-    cp = _pop_frame();
-    if (!cp) {
-        return;
+    ci = spop(current_ctx->cs);
+    if (!ci) {
+        return 0;
+    }
+    cp = ci->ckey;
+    pci = ci->cinfo; // (parent, cp) child info, set when cp is entered
+    if (flags.trace_buffer) {
+        _trace_event(cp, current_ctx->last_seen, TRACE_RETURN);
+    }
+    if (flags.trace_stream) {
+        _stream_event(cp, current_ctx->last_seen, TRACE_RETURN);
+    }
+    ov = _call_overhead(ci, cp);
+    elapsed = _subtract_overhead(elapsed, ov);
+
+    // the CPU time is accumulated like with the CPU clock, the coroutine
+    // handling below only applies to the wall time.
+    cpu_elapsed = 0;
+    if (dualclock) {
+        cpu_elapsed = _subtract_overhead(cputickcount() - ci->cpu_t0,
+            ov * tickfactor() / cputickfactor());
     }
 
     // if the function that the frame belongs is a coroutine, we check if we RETURN
@@ -1077,9 +1947,9 @@ _call_leave(PyObject *self, PyFrameObject *frame, PyObject *arg, int ccall)
     if (IS_ASYNC(frame)) {
         if (IS_SUSPENDED(frame)) {
             yielded = 1;
-            if (get_timing_clock_type() == WALL_CLOCK) {
+            if (IS_WALL_CLOCK(get_timing_clock_type())) {
                 // In fact setting this zero means following:
-                // for this specific pit, we say that if WALL_CLOCK is on,
+                // for this specific pit, we say that if a wall clock is on,
                 // we only aggregate time between first non-recursive enter and
                 // last non-recursive exit
                 elapsed = 0;
@@ -1093,71 +1963,83 @@ _call_leave(PyObject *self, PyFrameObject *frame, PyObject *arg, int ccall)
         }
     }
 
+    if (ci->node) {
+        _cct_leave(ci->node, elapsed, yielded);
+    }
+
     if (!yielded) {
         cp->callcount++;
+
+        if (flags.histograms) {
+            if (!cp->hist) {
+                cp->hist = histcreate();
+            }
+            if (cp->hist) {
+                histadd(cp->hist, elapsed);
+            }
+        }
     }
 
     // is this the last function in the callstack?
-    pp = _pop_frame();
-    if (!pp) {
+    ci = shead(current_ctx->cs);
+    if (!ci) {
         // update actual pit
         cp->ttotal += elapsed;
         cp->tsubtotal += elapsed;
+        cp->cpu_ttotal += cpu_elapsed;
+        cp->cpu_tsubtotal += cpu_elapsed;
         if (!yielded) {
             cp->nonrecursive_callcount++;
         }
-        decr_rec_level((uintptr_t)cp);
-        return;
+        _decr_rec_level(&cp->rec_level);
+        return 0;
     }
-    // get children info
-    pci = _get_child_info(pp, cp, 0);
+    pp = ci->ckey;
+    ppci = ci->cinfo;
     if(!pci)
     {
         _log_err(6);
-        return; // defensive
+        return 0; // defensive
     }
 
     // a calls b. b's elapsed time is subtracted from a's tsub and 
     // a adds its own elapsed it is leaving.
     pp->tsubtotal -= elapsed;
     cp->tsubtotal += elapsed;
+    pp->cpu_tsubtotal -= cpu_elapsed;
+    cp->cpu_tsubtotal += cpu_elapsed;
     
     if (!yielded) {
         pci->callcount++;
     }
 
     // a->b->c. b->c is substracted from a->b.
-    ppp = _get_frame();
-    if (ppp) {
-        ppci = _get_child_info(ppp, pp, 0);
-        if(!ppci) {
-            _log_err(7);
-            return;
-        }
+    if (ppci) {
         ppci->tsubtotal -= elapsed;
+        ppci->cpu_tsubtotal -= cpu_elapsed;
     }
     pci->tsubtotal += elapsed;
+    pci->cpu_tsubtotal += cpu_elapsed;
 
     // wait for the top-level function/parent/child to update timing values accordingly.
-    if (get_rec_level((uintptr_t)cp) == 1) {
+    if (cp->rec_level == 1) {
         cp->ttotal += elapsed;
+        cp->cpu_ttotal += cpu_elapsed;
         if (!yielded) {
             cp->nonrecursive_callcount++;
             pci->nonrecursive_callcount++;
         }
     }
 
-    if (get_rec_level((uintptr_t)pci) == 1) {
+    if (pci->rec_level == 1) {
         pci->ttotal += elapsed;
+        pci->cpu_ttotal += cpu_elapsed;
     }
 
-    decr_rec_level((uintptr_t)pci);
-    decr_rec_level((uintptr_t)cp);
+    _decr_rec_level(&pci->rec_level);
+    _decr_rec_level(&cp->rec_level);
 
-    if (!_push_frame(pp)) {
-        _log_err(8);
-        return; //defensive
-    }
+    return 0;
 }
 
 static int
@@ -1170,48 +2052,81 @@ _pitenumdel(_hitem *item, void *arg)
 static int
 _tagenumdel(_hitem *item, void *arg)
 {
-    _htab *pits;
+    _tagged_pits *tp;
 
-    pits = (_htab *)item->val;
-    henum(pits, _pitenumdel, NULL);
-    htdestroy(pits);
+    tp = (_tagged_pits *)item->val;
+    henum(tp->pits, _pitenumdel, NULL);
+    _del_tagged_pits(tp);
 
     return 0;
 }
 
+// releases the frames held by the items of a sampled call stack from the
+// given depth on and pops them.
+static void
+_release_sampled_frames(_cstack *cs, int depth)
+{
+    int i;
+
+    for (i = cs->head; i >= depth; i--) {
+        Py_CLEAR(cs->_items[i].frame);
+    }
+    if (cs->head >= depth) {
+        cs->head = depth - 1;
+    }
+}
+
 // context will be cleared by the free list. we do not free it here.
-// we only free the context call stack.
+// we only free the context call stack and the pools of the context.
 static void
 _del_ctx(_ctx * ctx)
 {
+    _release_sampled_frames(ctx->cs, 0);
     sdestroy(ctx->cs);
-    htdestroy(ctx->rec_levels);
 
     henum(ctx->tags, _tagenumdel, NULL);
     htdestroy(ctx->tags);
 
+    fldestroy(ctx->flpit);
+    fldestroy(ctx->flchildren);
+    fldestroy(ctx->flcoro);
+    fldestroy(ctx->flcct);
+    ctx->cct = NULL;
+
+    if (ctx->trace) {
+        tbdestroy(ctx->trace);
+        ctx->trace = NULL;
+    }
+    if (ctx->stream) {
+        yfree(ctx->stream);
+        ctx->stream = NULL;
+    }
+
     Py_CLEAR(ctx->name);
 }
 
 static int
-_yapp_callback(PyObject *self, PyFrameObject *frame, int what,
-               PyObject *arg)
+_handle_event(PyObject *self, PyFrameObject *frame, int what, PyObject *arg)
 {
-    PyObject *last_type, *last_value, *last_tb;
     _ctx* tl_prev_ctx;
-    PyErr_Fetch(&last_type, &last_value, &last_tb);
+    int excluded = 0;
 
     //printf("call EVENT %d %s %s", what, PyStr_AS_CSTRING(frame->f_code->co_filename),
     //                         PyStr_AS_CSTRING(frame->f_code->co_name));
 
+    // the trace writer would otherwise record itself writing the events
+    if (flags.writer_tid && PyThreadState_GET()->thread_id == flags.writer_tid) {
+        return 0;
+    }
+
     // get current ctx
-    current_ctx = _thread2ctx(PyThreadState_GET());
+    current_ctx = _current_thread_ctx(PyThreadState_GET());
     if (!current_ctx) {
         _log_err(9);
-        goto finally;
+        return 0;
     }
 
-    if (ctx_type == GREENLET && get_timing_clock_type() == CPU_CLOCK) {
+    if (ctx_type == GREENLET && HAS_CPU_CLOCK(get_timing_clock_type())) {
         tl_prev_ctx = (_ctx*)(get_tls_key_value(tl_prev_ctx_key));
 
         if (tl_prev_ctx != current_ctx) {
@@ -1242,10 +2157,10 @@ _yapp_callback(PyObject *self, PyFrameObject *frame, int what,
 
     switch (what) {
     case PyTrace_CALL:
-        _call_enter(self, frame, arg, 0);
+        excluded = _call_enter(self, frame, arg, 0);
         break;
     case PyTrace_RETURN: // either normally or with an exception
-        _call_leave(self, frame, arg, 0);
+        excluded = _call_leave(self, frame, arg, 0);
         break;
     /* case PyTrace_EXCEPTION:
         If the exception results in the function exiting, a
@@ -1254,13 +2169,13 @@ _yapp_callback(PyObject *self, PyFrameObject *frame, int what,
 
     case PyTrace_C_CALL:
         if (PyCFunction_Check(arg))
-            _call_enter(self, frame, arg, 1); // set ccall to true
+            excluded = _call_enter(self, frame, arg, 1); // set ccall to true
         break;
 
     case PyTrace_C_RETURN:
     case PyTrace_C_EXCEPTION:
         if (PyCFunction_Check(arg))
-            _call_leave(self, frame, arg, 1);
+            excluded = _call_leave(self, frame, arg, 1);
         break;
     default:
         break;
@@ -1269,10 +2184,6 @@ _yapp_callback(PyObject *self, PyFrameObject *frame, int what,
     goto finally;
 
 finally:
-    if (last_type) {
-        PyErr_Restore(last_type, last_value, last_tb);
-    }
-
     // there shall be no context switch happenning inside 
     // profile events and no concurent running events is possible
     if (current_ctx->ts_ptr != PyThreadState_GET()) {
@@ -1284,54 +2195,427 @@ finally:
         _log_err(15);
     }
 
-    return 0;
+    return excluded;
 }
 
-static void
-_pause_greenlet_ctx(_ctx *ctx)
+// dispatches a profile event to _call_enter/_call_leave and returns 1 if the
+// function is excluded from profiling. Shared by all the
+// profiling engines, the caller is responsible for saving/restoring the error
+// indicator if needed.
+static int
+_yapp_event(PyObject *self, PyFrameObject *frame, int what, PyObject *arg)
 {
-    ydprintf("pausing context: %ld", ctx->id);
-    ctx->gl_state.paused = 1;
-    ctx->gl_state.paused_at = tickcount();
+#ifdef Py_GIL_DISABLED
+    int excluded;
+
+    // the event is counted before yapprunning is checked, so _stop() either
+    // sees it in progress or the event sees the profiler stopped.
+    _Py_atomic_add_int(&_events_in_progress, 1);
+    if (!_Py_atomic_load_int(&yapprunning)) {
+        _Py_atomic_add_int(&_events_in_progress, -1);
+        return 0;
+    }
+    _event_depth++;
+    excluded = _handle_event(self, frame, what, arg);
+    _event_depth--;
+    _Py_atomic_add_int(&_events_in_progress, -1);
+    return excluded;
+#else
+    return _handle_event(self, frame, what, arg);
+#endif
 }
 
-static void
-_resume_greenlet_ctx(_ctx *ctx)
+static int
+_yapp_callback(PyObject *self, PyFrameObject *frame, int what,
+               PyObject *arg)
 {
-    long long shift;
-    int i;
-
-    ydprintf("resuming context: %ld", ctx->id);
+    PyObject *last_type, *last_value, *last_tb;
 
-    if (!ctx->gl_state.paused) {
-        return;
-    }
+    PyErr_Fetch(&last_type, &last_value, &last_tb);
 
-    ctx->gl_state.paused = 0;
-    shift = tickcount() - ctx->gl_state.paused_at;
-    ctx->t0 += shift;
+    _yapp_event(self, frame, what, arg);
 
-    for (i = 0; i <= ctx->cs->head; i++) {
-        ctx->cs->_items[i].t0 += shift;
+    if (last_type) {
+        PyErr_Restore(last_type, last_value, last_tb);
     }
 
-    ydprintf("resuming context: %ld, shift: %lld", ctx->id, shift);
+    return 0;
 }
 
-static void 
-_eval_setprofile(PyThreadState *ts)
+#ifdef MONITORING_AVAILABLE
+
+// sys.monitoring engine: instead of the legacy profile hook, yappi registers
+// itself as a PEP 669 tool and only subscribes to the events it needs. C
+// call events are not subscribed at all unless builtins are profiled. The
+// callbacks below mimic what CPython's legacy profiler emulation does
+// (Python/legacy_tracing.c) so that both engines produce identical stats.
+static PyObject *monitoring_tool_id = NULL;
+static PyObject *monitoring_missing = NULL; // sys.monitoring.MISSING
+static PyObject *monitoring_disable = NULL; // sys.monitoring.DISABLE
+static int monitoring_restart_needed = 0; // some events are DISABLEd
+
+static int
+_monitoring_skip_event(void)
 {
-#if PY_VERSION_HEX > 0x030c0000
-    PyEval_SetProfileAllThreads(_yapp_callback, NULL);
-#elif PY_VERSION_HEX > 0x030b0000
-    _PyEval_SetProfile(ts, _yapp_callback, NULL);
-#elif PY_VERSION_HEX < 0x030a00b1
-    ts->use_tracing = 1;
-    ts->c_profilefunc = _yapp_callback;
-#else
-    ts->cframe->use_tracing = 1;
-    ts->c_profilefunc = _yapp_callback;
-#endif
+    if (!yapprunning) {
+        return 1;
+    }
+
+    // events are delivered for all threads with sys.monitoring, so filter
+    // the ones that are not coming from the thread that called start().
+    if (!flags.multicontext && initial_ctx &&
+            initial_ctx->ts_ptr != PyThreadState_GET()) {
+        return 1;
+    }
+
+    return 0;
+}
+
+static PyObject *
+_monitoring_bind_callable(PyObject *callable, PyObject *self_arg)
+{
+    // method descriptors are called unbound. Bind them so that they are
+    // hashed to the same pit as the bound builtin methods.
+    if (Py_TYPE(callable) == &PyMethodDescr_Type && self_arg != monitoring_missing) {
+        return Py_TYPE(callable)->tp_descr_get(callable, self_arg,
+            (PyObject *)Py_TYPE(self_arg));
+    }
+    Py_INCREF(callable);
+    return callable;
+}
+
+// local events of excluded functions are DISABLEd so that they are never
+// delivered again for that code location until sys.monitoring.restart_events()
+// is called. Only PY_START, PY_RESUME, PY_RETURN and PY_YIELD can be disabled.
+static PyObject *
+_monitoring_py_event(int what, int disable)
+{
+    PyFrameObject *frame;
+
+    if (_monitoring_skip_event()) {
+        Py_RETURN_NONE;
+    }
+
+    frame = PyEval_GetFrame();
+    if (frame && _yapp_event(NULL, frame, what, NULL) && disable) {
+        monitoring_restart_needed = 1;
+        Py_INCREF(monitoring_disable);
+        return monitoring_disable;
+    }
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+_monitoring_c_event(int what, PyObject *const *args, Py_ssize_t nargs)
+{
+    PyObject *callable;
+    PyFrameObject *frame;
+
+    if (_monitoring_skip_event()) {
+        Py_RETURN_NONE;
+    }
+
+    if (nargs < 4) {
+        Py_RETURN_NONE;
+    }
+
+    frame = PyEval_GetFrame();
+    if (!frame) {
+        Py_RETURN_NONE;
+    }
+
+    callable = _monitoring_bind_callable(args[2], args[3]);
+    if (!callable) {
+        PyErr_Clear();
+        Py_RETURN_NONE;
+    }
+    _yapp_event(NULL, frame, what, callable);
+    Py_DECREF(callable);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+_monitoring_py_start(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_py_event(PyTrace_CALL, 1);
+}
+
+static PyObject *
+_monitoring_py_throw(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_py_event(PyTrace_CALL, 0);
+}
+
+static PyObject *
+_monitoring_py_return(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_py_event(PyTrace_RETURN, 1);
+}
+
+static PyObject *
+_monitoring_py_unwind(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_py_event(PyTrace_RETURN, 0);
+}
+
+static PyObject *
+_monitoring_call(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_c_event(PyTrace_C_CALL, args, nargs);
+}
+
+static PyObject *
+_monitoring_c_return(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_c_event(PyTrace_C_RETURN, args, nargs);
+}
+
+static PyObject *
+_monitoring_c_raise(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return _monitoring_c_event(PyTrace_C_EXCEPTION, args, nargs);
+}
+
+typedef struct {
+    const char *event;
+    int builtin; // only registered if builtins are profiled
+    PyMethodDef def;
+} _monitoring_callback;
+
+#define _MONITORING_CALLBACK(event, builtin, fn) \
+    {event, builtin, {"_" event, (PyCFunction)(void(*)(void))fn, METH_FASTCALL, NULL}}
+
+static _monitoring_callback monitoring_callbacks[] = {
+    _MONITORING_CALLBACK("PY_START", 0, _monitoring_py_start),
+    _MONITORING_CALLBACK("PY_RESUME", 0, _monitoring_py_start),
+    _MONITORING_CALLBACK("PY_THROW", 0, _monitoring_py_throw),
+    _MONITORING_CALLBACK("PY_RETURN", 0, _monitoring_py_return),
+    _MONITORING_CALLBACK("PY_YIELD", 0, _monitoring_py_return),
+    _MONITORING_CALLBACK("PY_UNWIND", 0, _monitoring_py_unwind),
+    _MONITORING_CALLBACK("CALL", 1, _monitoring_call),
+    _MONITORING_CALLBACK("C_RETURN", 1, _monitoring_c_return),
+    _MONITORING_CALLBACK("C_RAISE", 1, _monitoring_c_raise),
+    {NULL, 0, {NULL, NULL, 0, NULL}}      /* sentinel */
+};
+
+// registers (or unregisters if register_callbacks is 0) the callbacks and
+// returns the event set. returns -1 and sets an exception on error.
+static long
+_monitoring_register(PyObject *monitoring, int register_callbacks)
+{
+    _monitoring_callback *mc;
+    PyObject *events, *event_id, *callback, *r;
+    long event_set;
+
+    events = PyObject_GetAttrString(monitoring, "events");
+    if (!events) {
+        return -1;
+    }
+
+    event_set = 0;
+    for (mc = monitoring_callbacks; mc->event != NULL; mc++) {
+        if (mc->builtin && !flags.builtins && register_callbacks) {
+            continue;
+        }
+
+        event_id = PyObject_GetAttrString(events, mc->event);
+        if (!event_id) {
+            goto error;
+        }
+
+        if (register_callbacks) {
+            callback = PyCFunction_New(&mc->def, NULL);
+            if (!callback) {
+                Py_DECREF(event_id);
+                goto error;
+            }
+        } else {
+            callback = Py_None;
+            Py_INCREF(callback);
+        }
+
+        r = PyObject_CallMethod(monitoring, "register_callback", "OOO",
+            monitoring_tool_id, event_id, callback);
+        event_set |= PyLong_AsLong(event_id);
+        Py_DECREF(event_id);
+        Py_DECREF(callback);
+        if (!r) {
+            goto error;
+        }
+        Py_DECREF(r);
+    }
+
+    Py_DECREF(events);
+    return event_set;
+
+error:
+    Py_DECREF(events);
+    return -1;
+}
+
+static int
+_monitoring_start(void)
+{
+    PyObject *monitoring, *r;
+    long event_set;
+
+    monitoring = PySys_GetObject("monitoring"); // borrowed
+    if (!monitoring) {
+        PyErr_SetString(YappiProfileError, "sys.monitoring is not available.");
+        return 0;
+    }
+
+    if (!monitoring_tool_id) {
+        monitoring_tool_id = PyObject_GetAttrString(monitoring, "PROFILER_ID");
+        monitoring_missing = PyObject_GetAttrString(monitoring, "MISSING");
+        monitoring_disable = PyObject_GetAttrString(monitoring, "DISABLE");
+        if (!monitoring_tool_id || !monitoring_missing || !monitoring_disable) {
+            Py_CLEAR(monitoring_tool_id);
+            Py_CLEAR(monitoring_missing);
+            Py_CLEAR(monitoring_disable);
+            return 0;
+        }
+    }
+
+    r = PyObject_CallMethod(monitoring, "use_tool_id", "Os",
+        monitoring_tool_id, "yappi");
+    if (!r) {
+        PyErr_Clear();
+        PyErr_SetString(YappiProfileError,
+            "sys.monitoring profiler tool id is already in use.");
+        return 0;
+    }
+    Py_DECREF(r);
+
+    event_set = _monitoring_register(monitoring, 1);
+    if (event_set < 0) {
+        goto error;
+    }
+
+    r = PyObject_CallMethod(monitoring, "set_events", "Ol",
+        monitoring_tool_id, event_set);
+    if (!r) {
+        goto error;
+    }
+    Py_DECREF(r);
+
+    return 1;
+
+error:
+    r = PyObject_CallMethod(monitoring, "free_tool_id", "O", monitoring_tool_id);
+    Py_XDECREF(r);
+    return 0;
+}
+
+static void
+_monitoring_stop(void)
+{
+    PyObject *monitoring, *r;
+    PyObject *last_type, *last_value, *last_tb;
+
+    PyErr_Fetch(&last_type, &last_value, &last_tb);
+
+    monitoring = PySys_GetObject("monitoring"); // borrowed
+    if (!monitoring || !monitoring_tool_id) {
+        goto finally;
+    }
+
+    // free_tool_id() does not clear the events/callbacks on all versions
+    r = PyObject_CallMethod(monitoring, "set_events", "Oi", monitoring_tool_id, 0);
+    Py_XDECREF(r);
+    _monitoring_register(monitoring, 0);
+    r = PyObject_CallMethod(monitoring, "free_tool_id", "O", monitoring_tool_id);
+    Py_XDECREF(r);
+
+finally:
+    PyErr_Clear();
+    if (last_type) {
+        PyErr_Restore(last_type, last_value, last_tb);
+    }
+}
+
+// re-enables the events DISABLEd for the excluded functions. Called when the
+// exclusion cache is cleared.
+static void
+_monitoring_restart_events(void)
+{
+    PyObject *monitoring, *r;
+
+    if (!monitoring_restart_needed) {
+        return;
+    }
+
+    monitoring = PySys_GetObject("monitoring"); // borrowed
+    if (monitoring) {
+        r = PyObject_CallMethod(monitoring, "restart_events", NULL);
+        if (!r) {
+            PyErr_Print();
+        }
+        Py_XDECREF(r);
+    }
+    monitoring_restart_needed = 0;
+}
+
+#endif /* MONITORING_AVAILABLE */
+
+static void
+_pause_greenlet_ctx(_ctx *ctx)
+{
+    ydprintf("pausing context: %ld", ctx->id);
+    ctx->gl_state.paused = 1;
+    ctx->gl_state.paused_at = dualclock ? cputickcount() : tickcount();
+}
+
+static void
+_resume_greenlet_ctx(_ctx *ctx)
+{
+    long long shift;
+    int i;
+
+    ydprintf("resuming context: %ld", ctx->id);
+
+    if (!ctx->gl_state.paused) {
+        return;
+    }
+
+    ctx->gl_state.paused = 0;
+
+    // only the CPU time of the dual clock is shifted, the wall time of the
+    // context keeps running while it is paused.
+    if (dualclock) {
+        shift = cputickcount() - ctx->gl_state.paused_at;
+        for (i = 0; i <= ctx->cs->head; i++) {
+            ctx->cs->_items[i].cpu_t0 += shift;
+        }
+        return;
+    }
+
+    shift = tickcount() - ctx->gl_state.paused_at;
+    ctx->t0 += shift;
+
+    for (i = 0; i <= ctx->cs->head; i++) {
+        ctx->cs->_items[i].t0 += shift;
+    }
+
+    ydprintf("resuming context: %ld, shift: %lld", ctx->id, shift);
+}
+
+static void 
+_eval_setprofile(PyThreadState *ts)
+{
+#if PY_VERSION_HEX > 0x030c0000
+    PyEval_SetProfileAllThreads(_yapp_callback, NULL);
+#elif PY_VERSION_HEX > 0x030b0000
+    _PyEval_SetProfile(ts, _yapp_callback, NULL);
+#elif PY_VERSION_HEX < 0x030a00b1
+    ts->use_tracing = 1;
+    ts->c_profilefunc = _yapp_callback;
+#else
+    ts->cframe->use_tracing = 1;
+    ts->c_profilefunc = _yapp_callback;
+#endif
 }
 
 static void
@@ -1353,6 +2637,9 @@ _eval_unsetprofile(PyThreadState *ts)
 static _ctx *
 _bootstrap_thread(PyThreadState *ts)
 {
+    if (flags.writer_tid && ts->thread_id == flags.writer_tid) {
+        return NULL;
+    }
     _eval_setprofile(ts);
     return NULL;
 }
@@ -1365,10 +2652,12 @@ _profile_thread(PyThreadState *ts)
     _hitem *it;
 
     ctx_id = _current_context_id(ts);
+    ylock(&contexts_lock);
     it = hfind(contexts, ctx_id);
     if (!it) {
         ctx = _create_ctx();
         if (!ctx) {
+            yunlock(&contexts_lock);
             return NULL;
         }
         if (!hadd(contexts, ctx_id, (uintptr_t)ctx)) {
@@ -1376,16 +2665,21 @@ _profile_thread(PyThreadState *ts)
             if (!flput(flctx, ctx)) {
                 _log_err(10);
             }
+            yunlock(&contexts_lock);
             _log_err(11);
             return NULL;
         }
     } else {
         ctx = (_ctx *)it->val;
     }
-    _eval_setprofile(ts);
+    yunlock(&contexts_lock);
+    if (flags.engine == SETPROFILE_ENGINE) {
+        _eval_setprofile(ts);
+    }
     ctx->id = ctx_id;
     ctx->tid = ts->thread_id;
     ctx->ts_ptr = ts;
+    ctx->ts_id = PyThreadState_GetID(ts);
     ctx->gl_state.paused = 0;
     ctx->gl_state.paused_at = 0;
 
@@ -1424,61 +2718,298 @@ _enum_threads(_ctx* (*f) (PyThreadState *))
     }
 }
 
-static int
-_init_profiler(void)
+// the tag of a sampled thread. The tag callback cannot be called on behalf of
+// another thread, only tag_contextvar is looked up in the thread's context.
+static uintptr_t
+_sampled_tag(PyThreadState *ts)
 {
-    // already initialized? only after clear_stats() and first time, this flag
-    // will be unset.
-    if (!yappinitialized) {
-        contexts = htcreate(HT_CTX_SIZE);
-        if (!contexts)
-            goto error;
-        flpit = flcreate(sizeof(_pit), FL_PIT_SIZE);
-        if (!flpit)
-            goto error;
-        flctx = flcreate(sizeof(_ctx), FL_CTX_SIZE);
-        if (!flctx)
-            goto error;
-        tl_prev_ctx_key = create_tls_key();
-        if (!tl_prev_ctx_key)
-            goto error;
-        yappinitialized = 1;
-    }
-    return 1;
+    PyObject *val;
+    uintptr_t result;
 
-error:
-    if (contexts) {
-        htdestroy(contexts);
-        contexts = NULL;
-    }
-    if (flpit) {
-        fldestroy(flpit);
-        flpit = NULL;
-    }
-    if (flctx) {
-        fldestroy(flctx);
-        flctx = NULL;
+    if (!tag_contextvar) {
+        return DEFAULT_TAG;
     }
-    if (tl_prev_ctx_key) {
-        delete_tls_key(tl_prev_ctx_key);
-        tl_prev_ctx_key = NULL;
+
+    val = ts->context ? PyObject_GetItem(ts->context, tag_contextvar) : NULL;
+    if (!val) {
+        PyErr_Clear();
+        // not set in the thread's context. The sampler thread never sets the
+        // var, so looking it up in its own context gives the default.
+        if (PyContextVar_Get(tag_contextvar, NULL, &val) < 0 || !val) {
+            PyErr_Clear();
+            return DEFAULT_TAG;
+        }
     }
 
-    return 0;
+    result = PyLong_AsVoidPtr(val);
+    Py_DECREF(val);
+    if (PyErr_Occurred()) {
+        PyErr_Clear();
+        return DEFAULT_TAG;
+    }
+    return result;
 }
 
-static PyObject*
-profile_event(PyObject *self, PyObject *args)
+static int
+_push_sampled_frame(int n, PyFrameObject *frame)
 {
-    const char *ev;
-    PyObject *arg;
-    PyObject *event;
-    PyFrameObject * frame;
+    PyFrameObject **frames;
+    int size;
 
-    if (!PyArg_ParseTuple(args, "OOO", &frame, &event, &arg)) {
-        return NULL;
+    if (n == sampled_frames_size) {
+        size = sampled_frames_size ? sampled_frames_size * 2 : FRAME_BUFFER_SIZE;
+        frames = ymalloc(size * sizeof(PyFrameObject *));
+        if (!frames) {
+            return 0;
+        }
+        if (sampled_frames) {
+            memcpy(frames, sampled_frames, n * sizeof(PyFrameObject *));
+            yfree(sampled_frames);
+        }
+        sampled_frames = frames;
+        sampled_frames_size = size;
     }
-
+    sampled_frames[n] = frame;
+    return 1;
+}
+
+// accounts a single sample of a thread. Every function on the call stack is
+// assumed to be running since the previous sample of the thread, so the
+// elapsed time is added to ttot of each of them and to tsub of the leaf. The
+// call stack of the previous sample is kept in ctx->cs: the frames that are
+// not on it are counted as new calls. The items hold references to their
+// frames, so the frame of a call that has returned cannot be reused by a new
+// one and be mistaken for it. Calls that start and end between two
+// samples are not seen at all, so the call counts are estimates.
+static void
+_sample_thread(PyThreadState *ts, PyObject *name_callback)
+{
+    PyFrameObject *frame;
+    _cstack *cs;
+    _cstackitem *ci;
+    _pit *cp, *pp;
+    _pit_children_info *pci;
+    PyObject *tid;
+    long long now, elapsed;
+    uintptr_t tag;
+    int n, i, depth, diverged;
+
+    // a thread is just starting if its id is not set yet
+    if (!ts->thread_id) {
+        return;
+    }
+
+    // only the thread that called start() is profiled
+    if (!flags.multicontext && (!initial_ctx || initial_ctx->ts_ptr != ts)) {
+        return;
+    }
+
+    n = 0;
+    frame = PyThreadState_GetFrame(ts);
+    while (frame) {
+        if (!_push_sampled_frame(n, frame)) {
+            Py_DECREF(frame);
+            goto finally;
+        }
+        n++;
+        frame = PyFrame_GetBack(frame);
+    }
+    if (!n) {
+        return; // no Python code is running
+    }
+
+    current_ctx = _thread2ctx(ts);
+    if (!current_ctx) {
+        _log_err(18);
+        goto finally;
+    }
+    if (!current_ctx->name && name_callback != Py_None) {
+        tid = PyLong_FromUnsignedLong(ts->thread_id);
+        if (tid) {
+            current_ctx->name = _call_funcobjargs(name_callback, tid);
+            Py_DECREF(tid);
+        }
+        if (current_ctx->name && !PyStr_Check(current_ctx->name)) {
+            Py_CLEAR(current_ctx->name);
+        }
+        PyErr_Clear();
+    }
+
+    cs = current_ctx->cs;
+    now = threadtickcount(ts->thread_id);
+    if (current_ctx->sample_gen != sample_gen) {
+        // first sample of the thread in this session
+        current_ctx->sample_gen = sample_gen;
+        if (!current_ctx->sched_cnt) {
+            current_ctx->t0 = now;
+        }
+        current_ctx->last_seen = now;
+        _release_sampled_frames(cs, 0);
+    }
+    elapsed = 0;
+    if (now > current_ctx->last_seen) {
+        elapsed = now - current_ctx->last_seen;
+        current_ctx->last_seen = now;
+    }
+    current_ctx->sched_cnt++;
+
+    tag = _sampled_tag(ts);
+
+    pp = NULL;
+    depth = 0;
+    diverged = 0;
+    for (i = n - 1; i >= 0; i--) {
+        frame = sampled_frames[i];
+        cp = _code2pit(frame, tag);
+        if (!cp) {
+            _log_err(19);
+            break;
+        }
+        if (cp->excluded) {
+            continue;
+        }
+
+        // the same frame of the same function is still on the stack?
+        if (!diverged && (depth > cs->head ||
+                cs->_items[depth].frame != frame ||
+                cs->_items[depth].ckey != cp)) {
+            diverged = 1;
+        }
+
+        if (diverged) {
+            _release_sampled_frames(cs, depth);
+            pci = NULL;
+            if (pp) {
+                pci = _get_child_info(pp, cp, 1);
+                if (!pci) {
+                    _log_err(20);
+                    break;
+                }
+            }
+            ci = spush(cs, cp);
+            if (!ci) {
+                _log_err(21);
+                break;
+            }
+            Py_INCREF(frame);
+            ci->frame = frame;
+            ci->cinfo = pci;
+            ci->node = NULL;
+
+            cp->callcount++;
+            if (!cp->rec_level) {
+                cp->nonrecursive_callcount++;
+            }
+            if (pci) {
+                pci->callcount++;
+                if (!pci->rec_level) {
+                    pci->nonrecursive_callcount++;
+                }
+            }
+        } else {
+            pci = cs->_items[depth].cinfo;
+        }
+
+        // recursive functions are running once
+        if (!cp->rec_level) {
+            cp->ttotal += elapsed;
+        }
+        cp->rec_level++;
+        if (pci) {
+            if (!pci->rec_level) {
+                pci->ttotal += elapsed;
+            }
+            pci->rec_level++;
+        }
+
+        pp = cp;
+        depth++;
+    }
+    _release_sampled_frames(cs, depth);
+
+    ci = shead(cs);
+    if (ci) {
+        ((_pit *)ci->ckey)->tsubtotal += elapsed;
+        if (ci->cinfo) {
+            ((_pit_children_info *)ci->cinfo)->tsubtotal += elapsed;
+        }
+    }
+
+    for (i = 0; i <= cs->head; i++) {
+        ((_pit *)cs->_items[i].ckey)->rec_level = 0;
+        if (cs->_items[i].cinfo) {
+            ((_pit_children_info *)cs->_items[i].cinfo)->rec_level = 0;
+        }
+    }
+
+finally:
+    for (i = 0; i < n; i++) {
+        Py_DECREF(sampled_frames[i]);
+    }
+}
+
+static int
+_init_profiler(void)
+{
+    // already initialized? only after clear_stats() and first time, this flag
+    // will be unset.
+    if (!yappinitialized) {
+        contexts = htcreate(HT_CTX_SIZE);
+        if (!contexts)
+            goto error;
+        flctx = flcreate(sizeof(_ctx), FL_CTX_SIZE);
+        if (!flctx)
+            goto error;
+        tl_prev_ctx_key = create_tls_key();
+        if (!tl_prev_ctx_key)
+            goto error;
+        tl_current_ctx_key = create_tls_key();
+        if (!tl_current_ctx_key)
+            goto error;
+        module_filter_cache = htcreate(HT_MODULE_FILTER_SIZE);
+        if (!module_filter_cache)
+            goto error;
+        yappinitialized = 1;
+    }
+    return 1;
+
+error:
+    if (contexts) {
+        htdestroy(contexts);
+        contexts = NULL;
+    }
+    if (flctx) {
+        fldestroy(flctx);
+        flctx = NULL;
+    }
+    if (tl_prev_ctx_key) {
+        delete_tls_key(tl_prev_ctx_key);
+        tl_prev_ctx_key = NULL;
+    }
+    if (tl_current_ctx_key) {
+        delete_tls_key(tl_current_ctx_key);
+        tl_current_ctx_key = NULL;
+    }
+    if (module_filter_cache) {
+        htdestroy(module_filter_cache);
+        module_filter_cache = NULL;
+    }
+
+    return 0;
+}
+
+static PyObject*
+profile_event(PyObject *self, PyObject *args)
+{
+    const char *ev;
+    PyObject *arg;
+    PyObject *event;
+    PyFrameObject * frame;
+
+    if (!PyArg_ParseTuple(args, "OOO", &frame, &event, &arg)) {
+        return NULL;
+    }
+
     _ensure_thread_profiled(PyThreadState_GET());
 
     ev = PyStr_AS_CSTRING(event);
@@ -1508,6 +3039,19 @@ _calc_cumdiff(long long a, long long b)
     return r;
 }
 
+// waits until the events running on the other threads are finished. The GIL
+// already guarantees that when the profiler is stopped.
+static void
+_wait_for_events(void)
+{
+#ifdef Py_GIL_DISABLED
+    Py_BEGIN_ALLOW_THREADS
+    while (_Py_atomic_load_int(&_events_in_progress) > _event_depth)
+        ;
+    Py_END_ALLOW_THREADS
+#endif
+}
+
 static int
 _ctxenumdel(_hitem *item, void *arg)
 {
@@ -1515,6 +3059,134 @@ _ctxenumdel(_hitem *item, void *arg)
     return 0;
 }
 
+static PyObject *
+_calibration_call(PyObject *self, PyObject *args)
+{
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef calibration_def = {"calibration_call", _calibration_call,
+    METH_NOARGS, NULL};
+
+// measures the overhead of the calls of a Python function (the frame) or a
+// builtin on the current context.
+static int
+_calibrate_call(PyFrameObject *frame, PyObject *cfn, int builtin, _overhead *ov)
+{
+    _pit *pit;
+    long long t0, total, best, ttotal, inner;
+    int i, r;
+
+    // the pit is created by the first call
+    _call_enter(NULL, frame, cfn, builtin);
+    pit = _get_frame();
+    _call_leave(NULL, frame, cfn, builtin);
+    if (!pit) {
+        return 0;
+    }
+
+    // the round with the least interference from the rest of the system
+    best = -1;
+    inner = 0;
+    for (r = 0; r < CALIBRATION_ROUNDS; r++) {
+        ttotal = pit->ttotal;
+        t0 = tickcount();
+        for (i = 0; i < CALIBRATION_CALLS; i++) {
+            _call_enter(NULL, frame, cfn, builtin);
+            _call_leave(NULL, frame, cfn, builtin);
+        }
+        total = tickcount() - t0;
+        if (best < 0 || total < best) {
+            best = total;
+            inner = pit->ttotal - ttotal;
+        }
+    }
+
+    ov->total = (double)best / CALIBRATION_CALLS;
+    ov->inner = (double)(inner < best ? inner : best) / CALIBRATION_CALLS;
+    return 1;
+}
+
+// measures the time the profiler adds to the calls with the current clock
+// type, similar to the bias of the profile module. It is subtracted from the
+// timings of the functions (see _call_overhead). The calls are made on a
+// private context with the user callbacks and the tracing disabled, so
+// nothing is recorded. The histograms and call paths are disabled too, the
+// overhead is measured once per clock type whatever the flags of start().
+// The dispatching of the events by the interpreter is not measured, so the
+// overhead is rather underestimated than overestimated.
+static void
+_calibrate(void)
+{
+    PyFrameObject *frame;
+    PyObject *cfn;
+    PyObject *saved_tag_callback, *saved_tag_contextvar, *saved_module_filter;
+    _overhead *ov, *saved_overhead;
+    int saved_trace_buffer, saved_trace_stream, saved_histograms;
+    int saved_call_paths;
+    _ctx *ctx, *saved_ctx;
+    clock_type_t clk_type;
+
+    clk_type = get_timing_clock_type();
+    calibrated[clk_type] = 1;
+    ov = call_overhead[clk_type];
+    memset(ov, 0, 2 * sizeof(_overhead));
+
+    frame = PyEval_GetFrame();
+    if (!frame || IS_ASYNC(frame)) {
+        return;
+    }
+    cfn = PyCFunction_New(&calibration_def, NULL);
+    if (!cfn) {
+        PyErr_Clear();
+        return;
+    }
+    ylock(&contexts_lock);
+    ctx = _create_ctx();
+    yunlock(&contexts_lock);
+    if (!ctx) {
+        Py_DECREF(cfn);
+        return;
+    }
+
+    saved_ctx = current_ctx;
+    saved_tag_callback = tag_callback;
+    saved_tag_contextvar = tag_contextvar;
+    saved_module_filter = module_filter;
+    saved_overhead = overhead;
+    saved_trace_buffer = flags.trace_buffer;
+    saved_trace_stream = flags.trace_stream;
+    saved_histograms = flags.histograms;
+    saved_call_paths = flags.call_paths;
+    current_ctx = ctx;
+    tag_callback = tag_contextvar = module_filter = NULL;
+    overhead = NULL;
+    flags.trace_buffer = flags.trace_stream = 0;
+    flags.histograms = flags.call_paths = 0;
+
+    if (!_calibrate_call(frame, NULL, 0, &ov[0]) ||
+            !_calibrate_call(frame, cfn, 1, &ov[1])) {
+        _log_err(22);
+        memset(ov, 0, 2 * sizeof(_overhead));
+    }
+
+    current_ctx = saved_ctx;
+    tag_callback = saved_tag_callback;
+    tag_contextvar = saved_tag_contextvar;
+    module_filter = saved_module_filter;
+    overhead = saved_overhead;
+    flags.trace_buffer = saved_trace_buffer;
+    flags.trace_stream = saved_trace_stream;
+    flags.histograms = saved_histograms;
+    flags.call_paths = saved_call_paths;
+
+    _del_ctx(ctx);
+    ylock(&contexts_lock);
+    flput(flctx, ctx);
+    yunlock(&contexts_lock);
+    Py_DECREF(cfn);
+}
+
 // start profiling. return 1 on success, or 0 and set exception.
 static int
 _start(void)
@@ -1527,8 +3199,42 @@ _start(void)
         return 0;
     }
 
-    if (flags.multicontext) {
+    dualclock = (get_timing_clock_type() == DUAL_CLOCK);
+    if (test_timings || flags.engine == SAMPLING_ENGINE) {
+        overhead = NULL;
+    } else {
+        if (!calibrated[get_timing_clock_type()]) {
+            _calibrate();
+        }
+        overhead = call_overhead[get_timing_clock_type()];
+    }
+
+    if (flags.engine == SAMPLING_ENGINE) {
+        // the sampler thread of yappi.py calls sample()
+        sample_gen++;
+        if (!flags.multicontext) {
+            initial_ctx = _thread2ctx(PyThreadState_GET());
+        }
+    } else if (flags.engine == MONITORING_ENGINE) {
+#ifdef MONITORING_AVAILABLE
+        if (!flags.multicontext) {
+            initial_ctx = _thread2ctx(PyThreadState_GET());
+        }
+        if (!_monitoring_start()) {
+            return 0;
+        }
+#else
+        PyErr_SetString(YappiProfileError, "sys.monitoring engine requires Python 3.12+.");
+        return 0;
+#endif
+    } else if (flags.multicontext) {
+#ifdef Py_GIL_DISABLED
+        // the thread states cannot be walked while the threads are running,
+        // the profile function is set for all of them at once instead.
+        _bootstrap_thread(PyThreadState_GET());
+#else
         _enum_threads(&_bootstrap_thread);
+#endif
     } else {
         _ensure_thread_profiled(PyThreadState_GET());
         initial_ctx = _thread2ctx(PyThreadState_GET());
@@ -1542,16 +3248,40 @@ _start(void)
     return 1;
 }
 
+static int
+_ctxenumrelease(_hitem *item, void *arg)
+{
+    _release_sampled_frames(((_ctx *)item->val)->cs, 0);
+    return 0;
+}
+
 static void
 _stop(void)
 {
     if (!yapprunning)
         return;
 
-    _enum_threads(&_unprofile_thread);
+    if (flags.engine == MONITORING_ENGINE) {
+#ifdef MONITORING_AVAILABLE
+        _monitoring_stop();
+#endif
+    } else if (flags.engine == SAMPLING_ENGINE) {
+        henum(contexts, _ctxenumrelease, NULL);
+    } else if (flags.engine == SETPROFILE_ENGINE) {
+#ifdef Py_GIL_DISABLED
+        _unprofile_thread(PyThreadState_GET());
+#else
+        _enum_threads(&_unprofile_thread);
+#endif
+    }
 
+#ifdef Py_GIL_DISABLED
+    _Py_atomic_store_int(&yapprunning, 0);
+#else
     yapprunning = 0;
+#endif
     yappstoptick = tickcount();
+    _wait_for_events();
 }
 
 static PyObject*
@@ -1570,15 +3300,35 @@ clear_stats(PyObject *self, PyObject *args)
     htdestroy(contexts);
     contexts = NULL;
 
-    fldestroy(flpit);
-    flpit = NULL;
-
     fldestroy(flctx);
     flctx = NULL;
 
     delete_tls_key(tl_prev_ctx_key);
     tl_prev_ctx_key = NULL;
 
+    // a new key has no value in any thread, so the cached _ctx pointers are
+    // invalidated along with the contexts.
+    delete_tls_key(tl_current_ctx_key);
+    tl_current_ctx_key = NULL;
+
+    if (sampled_frames) {
+        yfree(sampled_frames);
+        sampled_frames = NULL;
+        sampled_frames_size = 0;
+    }
+
+    htdestroy(module_filter_cache);
+    module_filter_cache = NULL;
+
+    ylock(&stream_lock);
+    _free_stream(stream_head);
+    stream_head = NULL;
+    stream_tail = NULL;
+    yunlock(&stream_lock);
+#ifdef MONITORING_AVAILABLE
+    _monitoring_restart_events();
+#endif
+
     yappinitialized = 0;
     yapphavestats = 0;
     ycurfuncindex = 0;
@@ -1603,6 +3353,15 @@ _normt(long long tickcount)
     return (double)tickcount;
 }
 
+static double
+_normcput(long long cputickcount)
+{
+    if (!test_timings) {
+        return cputickcount * cputickfactor();
+    }
+    return (double)cputickcount;
+}
+
 static int
 _ctxenumstat(_hitem *item, void *arg)
 {
@@ -1698,230 +3457,1266 @@ int _pit_filtered(_pit *pt, _ctxfuncenumarg *eargs)
     return 0;
 }
 
-static int
-_pitenumstat(_hitem *item, void *arg)
+#if PY_VERSION_HEX < 0x030B0000
+static void
+_resolve_pit_name(_pit *pit)
+{
+    PyObject *class_name, *name;
+
+    if (!pit->cls) {
+        return;
+    }
+
+    class_name = PyObject_GetAttrString(pit->cls, "__name__");
+    if (class_name) {
+        name = PyStr_FromFormat("%s.%s", PyStr_AS_CSTRING(class_name),
+            PyStr_AS_CSTRING(pit->name));
+        if (name) {
+            Py_DECREF(pit->name);
+            pit->name = name;
+        }
+        Py_DECREF(class_name);
+    }
+    PyErr_Clear();
+    Py_CLEAR(pit->cls);
+}
+#endif
+
+// returns the latency histogram of the pit as a list of (the largest value
+// in the bucket, count) pairs for the buckets that are not empty.
+static PyObject *
+_hist2list(_hist *hist)
+{
+    PyObject *result, *bucket;
+    int i;
+
+    result = PyList_New(0);
+    if (!result || !hist) {
+        return result;
+    }
+
+    for (i = 0; i < HIST_BUCKETS; i++) {
+        if (!hist->buckets[i]) {
+            continue;
+        }
+        bucket = Py_BuildValue("(fI)", _normt(histhigh(i)), hist->buckets[i]);
+        if (!bucket || PyList_Append(result, bucket) < 0) {
+            Py_XDECREF(bucket);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(bucket);
+    }
+    return result;
+}
+
+// negative tsubtotals are expected, e.g. for the callers of the functions
+// still running. The callcount of a function still running is 0.
+static void
+_normalize_pit(_pit *pt)
 {
-    _pit *pt;
-    PyObject *exc;
-    PyObject *children;
-    PyObject *ctx_name;
     _pit_children_info *pci;
-    _ctxfuncenumarg *eargs;
 
-    children = NULL;
-    pt = (_pit *)item->val;
-    eargs = (_ctxfuncenumarg *)arg;
+    for (pci = pt->children; pci; pci = (_pit_children_info *)pci->next) {
+        if (pci->tsubtotal < 0) {
+            pci->tsubtotal = 0;
+        }
+        if (pci->cpu_tsubtotal < 0) {
+            pci->cpu_tsubtotal = 0;
+        }
+        if (pci->callcount == 0)
+            pci->callcount = 1;
+    }
+    if (pt->tsubtotal < 0)
+        pt->tsubtotal = 0;
+    if (pt->cpu_tsubtotal < 0)
+        pt->cpu_tsubtotal = 0;
+    if (pt->callcount == 0)
+        pt->callcount = 1;
+}
 
-    if (_pit_filtered(pt, eargs)) {
-        return 0;
+static int
+_colappend(_column *col, const void *value, Py_ssize_t size)
+{
+    char *data;
+    Py_ssize_t capacity;
+
+    if (col->size + size > col->capacity) {
+        capacity = col->capacity ? col->capacity * 2 : 64 * size;
+        data = PyMem_Realloc(col->data, capacity);
+        if (!data) {
+            PyErr_NoMemory();
+            return 0;
+        }
+        col->data = data;
+        col->capacity = capacity;
     }
+    memcpy(col->data + col->size, value, size);
+    col->size += size;
+    return 1;
+}
 
-    // do not show builtin pits if specified
-    if  ((!flags.builtins) && (pt->builtin)) {
-        return 0;
+#define COLAPPEND(col, type, value) \
+    do { \
+        type _v = (type)(value); \
+        if (!_colappend((col), &_v, sizeof(type))) \
+            return 0; \
+    } while (0)
+
+// returns the index of s in the string table, adding it if needed. -1 on error.
+static Py_ssize_t
+_string_id(_statcolumns *cols, PyObject *s)
+{
+    PyObject *id;
+    Py_ssize_t result;
+
+    id = PyDict_GetItemWithError(cols->string_ids, s);
+    if (id) {
+        return PyLong_AsSsize_t(id);
+    }
+    if (PyErr_Occurred()) {
+        return -1;
+    }
+
+    result = PyList_GET_SIZE(cols->strings);
+    id = PyLong_FromSsize_t(result);
+    if (!id) {
+        return -1;
+    }
+    if (PyDict_SetItem(cols->string_ids, s, id) < 0 ||
+            PyList_Append(cols->strings, s) < 0) {
+        Py_DECREF(id);
+        return -1;
+    }
+    Py_DECREF(id);
+    return result;
+}
+
+// adds the pit and its children info to the columns, returns 0 on error.
+static int
+_pitcolumns(_pit *pt, _ctxfuncenumarg *eargs)
+{
+    _statcolumns *cols;
+    _column *c;
+    _pit_children_info *pci;
+    PyObject *ctx_name;
+    Py_ssize_t name_id, module_id, ctx_name_id;
+    int i;
+
+    // the enumeration of the other contexts goes on after an error
+    if (PyErr_Occurred()) {
+        return 0;
+    }
+
+    cols = eargs->enum_args->columns;
+    name_id = _string_id(cols, pt->name);
+    if (name_id < 0) {
+        return 0;
+    }
+    module_id = _string_id(cols, pt->modname);
+    if (module_id < 0) {
+        return 0;
+    }
+    ctx_name = eargs->ctx->name ? eargs->ctx->name : Py_None;
+    ctx_name_id = _string_id(cols, ctx_name);
+    if (ctx_name_id < 0) {
+        return 0;
+    }
+
+    c = cols->funcs;
+    COLAPPEND(c++, unsigned int, pt->index);
+    COLAPPEND(c++, unsigned int, name_id);
+    COLAPPEND(c++, unsigned int, module_id);
+    COLAPPEND(c++, unsigned int, pt->lineno);
+    COLAPPEND(c++, unsigned char, pt->builtin);
+    COLAPPEND(c++, unsigned long long, eargs->ctx->id);
+    COLAPPEND(c++, unsigned long long, eargs->tag);
+    COLAPPEND(c++, unsigned long long, pt->callcount);
+    COLAPPEND(c++, unsigned long long, pt->nonrecursive_callcount);
+    COLAPPEND(c++, double, _normt(pt->ttotal));
+    COLAPPEND(c++, double, _normt(pt->tsubtotal));
+    COLAPPEND(c++, double, _normcput(pt->cpu_ttotal));
+    COLAPPEND(c++, double, _normcput(pt->cpu_tsubtotal));
+    COLAPPEND(c++, double, pt->hist ? _normt(pt->hist->max) : 0.0);
+    COLAPPEND(c++, unsigned int, ctx_name_id);
+    if (!hfind(cols->indexes, pt->index) && !hadd(cols->indexes, pt->index, 1)) {
+        PyErr_NoMemory();
+        return 0;
+    }
+
+    for (i = 0; pt->hist && i < HIST_BUCKETS; i++) {
+        if (!pt->hist->buckets[i]) {
+            continue;
+        }
+        c = cols->hists;
+        COLAPPEND(c++, unsigned int, pt->index);
+        COLAPPEND(c++, double, _normt(histhigh(i)));
+        COLAPPEND(c++, unsigned int, pt->hist->buckets[i]);
+    }
+
+    for (pci = pt->children; pci; pci = (_pit_children_info *)pci->next) {
+        c = cols->edges;
+        COLAPPEND(c++, unsigned int, pt->index);
+        COLAPPEND(c++, unsigned int, pci->index);
+        COLAPPEND(c++, unsigned long long, pci->callcount);
+        COLAPPEND(c++, unsigned long long, pci->nonrecursive_callcount);
+        COLAPPEND(c++, double, _normt(pci->ttotal));
+        COLAPPEND(c++, double, _normt(pci->tsubtotal));
+        COLAPPEND(c++, double, _normcput(pci->cpu_ttotal));
+        COLAPPEND(c++, double, _normcput(pci->cpu_tsubtotal));
+    }
+    return 1;
+}
+
+// removes the edges to the functions that are not in the columns, e.g. the
+// builtins recorded before a session with builtins=False or yappi itself.
+static void
+_dropdanglingedges(_statcolumns *cols)
+{
+    Py_ssize_t row, nrows, kept, size;
+    unsigned int child;
+    int i;
+
+    nrows = cols->edges[0].size / sizeof(unsigned int);
+    kept = 0;
+    for (row = 0; row < nrows; row++) {
+        child = ((unsigned int *)cols->edges[1].data)[row];
+        if (!hfind(cols->indexes, child)) {
+            continue;
+        }
+        if (kept != row) {
+            for (i = 0; i < EDGE_COLUMN_COUNT; i++) {
+                size = cols->edges[i].size / nrows;
+                memcpy(cols->edges[i].data + kept * size,
+                    cols->edges[i].data + row * size, size);
+            }
+        }
+        kept++;
+    }
+    for (i = 0; nrows && i < EDGE_COLUMN_COUNT; i++) {
+        cols->edges[i].size = cols->edges[i].size / nrows * kept;
+    }
+}
+
+// returns 1 if the pit belongs to yappi.py or _yappi, which are not shown
+static int
+_yappi_pit(_pit *pt)
+{
+    const char *modname;
+    size_t len, suffix;
+
+    if (!PyUnicode_Check(pt->modname)) {
+        return 0;
+    }
+    modname = PyUnicode_AsUTF8(pt->modname);
+    if (!modname) {
+        PyErr_Clear();
+        return 0;
+    }
+    if (strcmp(modname, "_yappi") == 0) {
+        return 1;
+    }
+    len = strlen(modname);
+    suffix = strlen("yappi.py");
+    if (len < suffix || strcmp(modname + len - suffix, "yappi.py") != 0) {
+        return 0;
+    }
+    return len == suffix || modname[len - suffix - 1] == '/' ||
+        modname[len - suffix - 1] == '\\';
+}
+
+// returns the function of the pit, the same for the pits that have the same
+// full_name, or NULL on error. The functions are hashed by the hashes of
+// their name and module, which are cached by the str objects.
+static _topfunc *
+_topfind(_topargs *top, _pit *pt)
+{
+    _hitem *it;
+    _topfunc *tf, *head;
+    Py_hash_t name_hash, modname_hash;
+    uintptr_t hash;
+    long lineno;
+
+    // the lineno of a builtin is not part of its full_name
+    lineno = pt->builtin ? -1L : (long)pt->lineno;
+    name_hash = PyObject_Hash(pt->name);
+    modname_hash = PyObject_Hash(pt->modname);
+    if (name_hash == -1 || modname_hash == -1) {
+        return NULL;
+    }
+    hash = (uintptr_t)name_hash ^ ((uintptr_t)modname_hash * 31) ^
+        (uintptr_t)lineno;
+
+    head = NULL;
+    it = hfind(top->funcs, hash);
+    if (it) {
+        head = (_topfunc *)it->val;
+        for (tf = head; tf; tf = tf->next) {
+            if (tf->lineno == lineno &&
+                    PyObject_RichCompareBool(tf->name, pt->name, Py_EQ) > 0 &&
+                    PyObject_RichCompareBool(tf->modname, pt->modname, Py_EQ) > 0) {
+                return tf;
+            }
+        }
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+    }
+
+    tf = (_topfunc *)ycalloc(sizeof(_topfunc));
+    if (!tf) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    tf->name = pt->name;
+    tf->modname = pt->modname;
+    tf->lineno = lineno;
+    tf->order = top->nfuncs++;
+    if (head) {
+        tf->next = head;
+        it->val = (uintptr_t)tf;
+    } else if (!hadd(top->funcs, hash, (uintptr_t)tf)) {
+        yfree(tf);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    return tf;
+}
+
+// sums the stats of the pit into its function, returns 0 on error.
+static int
+_topadd(_topargs *top, _pit *pt)
+{
+    _topfunc *tf;
+
+    if (_yappi_pit(pt)) {
+        return 1;
+    }
+
+    tf = _topfind(top, pt);
+    if (!tf) {
+        return 0;
+    }
+    tf->callcount += pt->callcount;
+    tf->ttotal += pt->ttotal;
+    tf->tsubtotal += pt->tsubtotal;
+    tf->cpu_ttotal += pt->cpu_ttotal;
+    tf->cpu_tsubtotal += pt->cpu_tsubtotal;
+    if (pt->hist && pt->hist->max > tf->tmax) {
+        tf->tmax = pt->hist->max;
+    }
+
+    if (!hadd(top->pits, pt->index, (uintptr_t)pt) ||
+            !hadd(top->pitfuncs, pt->index, (uintptr_t)tf)) {
+        PyErr_NoMemory();
+        return 0;
+    }
+    return 1;
+}
+
+static int
+_pitenumstat(_hitem *item, void *arg)
+{
+    _pit *pt;
+    PyObject *exc;
+    PyObject *children;
+    PyObject *hist;
+    PyObject *ctx_name;
+    PyObject *index;
+    _pit_children_info *pci;
+    _ctxfuncenumarg *eargs;
+    _topargs *top;
+    _hitem *it;
+    uintptr_t func;
+
+    children = NULL;
+    pt = (_pit *)item->val;
+    eargs = (_ctxfuncenumarg *)arg;
+
+#if PY_VERSION_HEX < 0x030B0000
+    _resolve_pit_name(pt);
+#endif
+
+    if (pt->excluded || _pit_filtered(pt, eargs)) {
+        return 0;
+    }
+
+    // do not show builtin pits if specified
+    if  ((!flags.builtins) && (pt->builtin)) {
+        return 0;
+    }
+
+    _normalize_pit(pt);
+
+    if (eargs->enum_args->columns) {
+        if (_yappi_pit(pt)) {
+            return 0;
+        }
+        return _pitcolumns(pt, eargs) ? 0 : 1;
+    }
+
+    top = eargs->enum_args->top;
+    if (top) {
+        if (!top->selected) {
+            return _topadd(top, pt) ? 0 : 1;
+        }
+        it = hfind(top->pitfuncs, pt->index);
+        if (!it) {
+            return 0;
+        }
+        func = it->val;
+        if (!hfind(top->selected, func)) {
+            return 0;
+        }
+        if (hfind(top->top, func)) {
+            index = PyLong_FromUnsignedLong(pt->index);
+            if (!index || PyList_Append(top->indexes, index) < 0) {
+                Py_XDECREF(index);
+                return 1;
+            }
+            Py_DECREF(index);
+        }
+    }
+
+    // convert children function index list to PyList
+    children = PyList_New(0);
+    pci = pt->children;
+    while(pci) {
+        PyObject *stats_tuple;
+        stats_tuple = Py_BuildValue("Ikkffff", pci->index, pci->callcount,
+                pci->nonrecursive_callcount, _normt(pci->ttotal),
+                _normt(pci->tsubtotal), _normcput(pci->cpu_ttotal),
+                _normcput(pci->cpu_tsubtotal));
+        PyList_Append(children, stats_tuple);
+        Py_DECREF(stats_tuple);
+        pci = (_pit_children_info *)pci->next;
+    }
+
+    // normally _yapp_callback sets ctx->name if not set but there is a possibility
+    // that we might end up here even it is not set. We also do not default it to 
+    // Py_None as we will Py_CLEAR() on it later on.
+    ctx_name = eargs->ctx->name;
+    if (!ctx_name) {
+        ctx_name = Py_None;
+    }
+
+    hist = _hist2list(pt->hist);
+    if (!hist) {
+        PyErr_Print();
+        Py_XDECREF(children);
+        return 1;
+    }
+
+    exc = PyObject_CallFunction(eargs->enum_args->enumfn, "((OOkkkIffIOkOkOffOf))", 
+                        pt->name, pt->modname, pt->lineno, pt->callcount,
+                        pt->nonrecursive_callcount, pt->builtin, 
+                        _normt(pt->ttotal), _normt(pt->tsubtotal),
+                        pt->index, children, eargs->ctx->id, ctx_name,
+                        eargs->tag, pt->fn_descriptor,
+                        _normcput(pt->cpu_ttotal), _normcput(pt->cpu_tsubtotal),
+                        hist, pt->hist ? _normt(pt->hist->max) : 0.0);
+
+    if (!exc) {
+        PyErr_Print();
+        Py_XDECREF(children);
+        Py_DECREF(hist);
+        return 1; // abort enumeration
+    }
+
+    Py_DECREF(exc);
+    Py_XDECREF(children);
+    Py_DECREF(hist);
+
+    return 0;
+}
+
+static int
+_tagenumstat(_hitem *item, void *arg)
+{
+    _htab *pits;
+    uintptr_t current_tag;
+    _ctxfuncenumarg *eargs;
+    _fast_func_stat_filter filter;
+
+    current_tag = item->key;
+    eargs = (_ctxfuncenumarg *)arg;
+    filter = eargs->enum_args->func_filter;
+    eargs->tag = current_tag;
+
+    if (filter.tag) {
+        if (current_tag != PyLong_AsVoidPtr(filter.tag)) {
+            return 0;
+        }
+    }
+
+    pits = ((_tagged_pits *)item->val)->pits;
+    henum(pits, _pitenumstat, arg);
+
+    return 0;
+}
+
+static int 
+_ctxfuncenumstat(_hitem *item, void *arg)
+{
+    _ctxfuncenumarg ext_args;
+    PyObject *filtered_ctx_id;
+
+    ext_args.ctx = (_ctx *)item->val; 
+    ext_args.enum_args = (_ctxenumarg *)arg;
+    ext_args.tag = 0; // default
+
+    filtered_ctx_id = ext_args.enum_args->func_filter.ctx_id;
+    if (filtered_ctx_id) {
+        if (ext_args.ctx->id != PyLong_AsVoidPtr(filtered_ctx_id)) {
+            return 0;
+        }
+    }
+
+    henum(ext_args.ctx->tags, _tagenumstat, &ext_args);
+
+    return 0;
+}
+
+static PyObject*
+start(PyObject *self, PyObject *args)
+{
+    PyObject *filter = Py_None;
+
+    if (yapprunning)
+        Py_RETURN_NONE;
+
+    flags.engine = SETPROFILE_ENGINE;
+    flags.histograms = 0;
+    flags.trace_buffer = 0;
+    flags.trace_stream = 0;
+    flags.call_paths = 0;
+    flags.writer_tid = 0;
+    if (!PyArg_ParseTuple(args, "ii|iOiiiik", &flags.builtins, &flags.multicontext,
+            &flags.engine, &filter, &flags.histograms, &flags.trace_buffer,
+            &flags.trace_stream, &flags.call_paths, &flags.writer_tid))
+        return NULL;
+
+    if (flags.trace_buffer < 0) {
+        flags.trace_buffer = 0;
+        PyErr_SetString(YappiProfileError, "trace buffer size cannot be negative.");
+        return NULL;
+    }
+
+    if (flags.engine != SETPROFILE_ENGINE && flags.engine != MONITORING_ENGINE &&
+            flags.engine != SAMPLING_ENGINE) {
+        flags.engine = SETPROFILE_ENGINE;
+        PyErr_SetString(YappiProfileError, "Invalid engine type.");
+        return NULL;
+    }
+#ifdef Py_GIL_DISABLED
+    // the frames of a running thread cannot be walked from another one
+    if (flags.engine == SAMPLING_ENGINE) {
+        flags.engine = SETPROFILE_ENGINE;
+        PyErr_SetString(YappiProfileError,
+            "sampling mode is not supported on free-threaded builds.");
+        return NULL;
+    }
+#endif
+
+    if (filter != Py_None && !PyCallable_Check(filter)) {
+        PyErr_SetString(YappiProfileError, "module filter must be callable.");
+        return NULL;
+    }
+    Py_CLEAR(module_filter);
+    if (filter != Py_None) {
+        Py_INCREF(filter);
+        module_filter = filter;
+    }
+
+    if (!_start())
+        // error
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+// takes a sample of the call stacks of all the profiled threads except the
+// calling one. name_callback is called with the thread id to get the name of
+// a thread that is sampled first time.
+static PyObject*
+sample(PyObject *self, PyObject *args)
+{
+    PyThreadState *ts, *current;
+    PyObject *name_callback;
+
+    if (!PyArg_ParseTuple(args, "O", &name_callback)) {
+        return NULL;
+    }
+
+    if (!yapprunning || flags.engine != SAMPLING_ENGINE) {
+        Py_RETURN_NONE;
+    }
+
+    current = PyThreadState_GET();
+    for (ts = PyInterpreterState_ThreadHead(current->interp); ts != NULL;
+            ts = PyThreadState_Next(ts)) {
+        if (ts != current) {
+            _sample_thread(ts, name_callback);
+        }
+    }
+    current_ctx = NULL;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+stop(PyObject *self, PyObject *args)
+{
+    _stop();
+    Py_RETURN_NONE;
+}
+
+int
+_filterdict_to_statfilter(PyObject *filter_dict, _fast_func_stat_filter* filter)
+{
+    // we use a _statfilter struct to hold the struct and not to always 
+    // as the filter_dict to get its values for each pit enumerated. This
+    // is for performance
+    PyObject *fv;
+
+    fv = PyDict_GetItemString(filter_dict, "tag");
+    if (fv) {
+        PyLong_AsVoidPtr(fv);
+        if (PyErr_Occurred()) {
+            PyErr_Clear();
+            yerr("invalid tag passed to get_func_stats.");
+            PyErr_SetString(YappiProfileError, "invalid tag passed to get_func_stats");
+            filter->tag = NULL;
+            return 0;
+        }
+        filter->tag = fv;
+    }
+    fv = PyDict_GetItemString(filter_dict, "ctx_id");
+    if (fv) {
+        PyLong_AsVoidPtr(fv);
+        if (PyErr_Occurred()) {
+            PyErr_Clear();
+            yerr("invalid ctx_id passed to get_func_stats.");
+            PyErr_SetString(YappiProfileError, "invalid ctx_id passed to get_func_stats");
+            filter->ctx_id = NULL;
+            return 0;
+        }
+        filter->ctx_id = fv;
+    }
+
+    fv = PyDict_GetItemString(filter_dict, "name");
+    if (fv) {
+        filter->name = fv;
+    }
+    fv = PyDict_GetItemString(filter_dict, "module");
+    if (fv) {
+        filter->modname = fv;
+    }
+
+    return 1;
+}
+
+static int
+_ctxenumtrace(_hitem *item, void *arg)
+{
+    PyObject *events, *event;
+    _ctx *ctx;
+    _pit *pt;
+    _traceevent *ev;
+    int i;
+
+    ctx = (_ctx *)item->val;
+    events = (PyObject *)arg;
+    if (!ctx->trace) {
+        return 0;
+    }
+
+    for (i = 0; i < ctx->trace->count; i++) {
+        ev = tbget(ctx->trace, i);
+        pt = (_pit *)ev->ckey;
+#if PY_VERSION_HEX < 0x030B0000
+        _resolve_pit_name(pt);
+#endif
+        event = Py_BuildValue("(kfiOOkI)", ctx->id, _normt(ev->t), ev->what,
+            pt->name, pt->modname, pt->lineno, pt->builtin);
+        if (!event || PyList_Append(events, event) < 0) {
+            Py_XDECREF(event);
+            return 1; // abort enumeration
+        }
+        Py_DECREF(event);
+    }
+    return 0;
+}
+
+// returns the events in the ring buffers of all the contexts, oldest first
+// per context, as (ctx_id, timestamp, what, name, modname, lineno, builtin).
+static PyObject *
+get_trace(PyObject *self, PyObject *args)
+{
+    PyObject *events;
+
+    events = PyList_New(0);
+    if (!events || !yapphavestats) {
+        return events;
+    }
+
+    henum(contexts, _ctxenumtrace, events);
+    if (PyErr_Occurred()) {
+        Py_DECREF(events);
+        return NULL;
+    }
+    return events;
+}
+
+static int
+_ctxenumstream(_hitem *item, void *arg)
+{
+    _ctx *ctx;
+
+    ctx = (_ctx *)item->val;
+    if (ctx->stream) {
+        _queue_chunk(ctx->stream);
+        ctx->stream = NULL;
+    }
+    return 0;
+}
+
+// returns the queued chunks serialized for the trace file and frees them. A
+// chunk is a (1, count, ctx_id) header followed by count (t, index, what)
+// events, in native byte order. The partially filled chunks of the contexts
+// are also taken if flush is set, which is only safe when the profiler is
+// stopped.
+static PyObject *
+take_trace(PyObject *self, PyObject *args)
+{
+    PyObject *result;
+    _streamchunk *chunks, *chunk;
+    Py_ssize_t size;
+    char *buf;
+    uint32_t header[2];
+    uint64_t ctx_id;
+    double t;
+    uint32_t event[2];
+    int flush, i;
+
+    flush = 0;
+    if (!PyArg_ParseTuple(args, "|i", &flush))
+        return NULL;
+
+    if (flush && yapphavestats) {
+        henum(contexts, _ctxenumstream, NULL);
+    }
+
+    ylock(&stream_lock);
+    chunks = stream_head;
+    stream_head = NULL;
+    stream_tail = NULL;
+    yunlock(&stream_lock);
+
+    size = 0;
+    for (chunk = chunks; chunk; chunk = chunk->next) {
+        size += sizeof(header) + sizeof(ctx_id) +
+            chunk->count * (sizeof(t) + sizeof(event));
+    }
+
+    result = PyBytes_FromStringAndSize(NULL, size);
+    if (!result) {
+        _free_stream(chunks);
+        return NULL;
+    }
+
+    buf = PyBytes_AS_STRING(result);
+    for (chunk = chunks; chunk; chunk = chunk->next) {
+        header[0] = 1;
+        header[1] = (uint32_t)chunk->count;
+        ctx_id = chunk->ctx_id;
+        memcpy(buf, header, sizeof(header));
+        buf += sizeof(header);
+        memcpy(buf, &ctx_id, sizeof(ctx_id));
+        buf += sizeof(ctx_id);
+        for (i = 0; i < chunk->count; i++) {
+            t = _normt(chunk->events[i].t);
+            event[0] = chunk->events[i].index;
+            event[1] = (uint32_t)chunk->events[i].what;
+            memcpy(buf, &t, sizeof(t));
+            buf += sizeof(t);
+            memcpy(buf, event, sizeof(event));
+            buf += sizeof(event);
+        }
+    }
+
+    _free_stream(chunks);
+    return result;
+}
+
+// appends the descendants of node to paths, parents first
+static int
+_cctenum(_ctx *ctx, _cctnode *node, PyObject *paths)
+{
+    PyObject *path;
+    _cctnode *child;
+    _pit *pt;
+    long long tsub;
+
+    for (child = node->children; child; child = child->next) {
+        pt = child->pit;
+#if PY_VERSION_HEX < 0x030B0000
+        _resolve_pit_name(pt);
+#endif
+        // the callers of a function still running have no time of their own
+        tsub = child->tsubtotal < 0 ? 0 : child->tsubtotal;
+        path = Py_BuildValue("(kIIOOkIkff)", ctx->id, child->id, node->id,
+            pt->name, pt->modname, pt->lineno, pt->builtin, child->callcount,
+            _normt(child->ttotal), _normt(tsub));
+        if (!path || PyList_Append(paths, path) < 0) {
+            Py_XDECREF(path);
+            return 1;
+        }
+        Py_DECREF(path);
+
+        if (_cctenum(ctx, child, paths)) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static int
+_ctxenumcct(_hitem *item, void *arg)
+{
+    _ctx *ctx;
+
+    ctx = (_ctx *)item->val;
+    if (!ctx->cct) {
+        return 0;
+    }
+    return _cctenum(ctx, ctx->cct, (PyObject *)arg);
+}
+
+// returns the nodes of the calling context trees of all the contexts as
+// (ctx_id, id, parent_id, name, modname, lineno, builtin, ncall, ttot, tsub),
+// parents first. The parent_id of the outermost calls is 0.
+static PyObject *
+get_call_paths(PyObject *self, PyObject *args)
+{
+    PyObject *paths;
+
+    paths = PyList_New(0);
+    if (!paths || !yapphavestats) {
+        return paths;
+    }
+
+    henum(contexts, _ctxenumcct, paths);
+    if (PyErr_Occurred()) {
+        Py_DECREF(paths);
+        return NULL;
+    }
+    return paths;
+}
+
+static PyObject*
+enum_func_stats(PyObject *self, PyObject *args)
+{
+    PyObject *filter_dict;
+    _ctxenumarg ext_args;
+
+    filter_dict = NULL;
+    memset(&ext_args, 0, sizeof(_ctxenumarg)); // make sure everything is NULLed
+
+    if (!yapphavestats) {
+        Py_RETURN_NONE;
+    }
+
+    if (!PyArg_ParseTuple(args, "OO", &ext_args.enumfn, &filter_dict)) {
+        PyErr_SetString(YappiProfileError, "invalid param to enum_func_stats");
+        return NULL;
+    }
+
+    if (!PyDict_Check(filter_dict)) {
+        PyErr_SetString(YappiProfileError, "filter param should be a dict");
+        return NULL;
+    }
+
+    if (!PyCallable_Check(ext_args.enumfn)) {
+        PyErr_SetString(YappiProfileError, "enum function must be callable");
+        return NULL;
+    }
+
+    if (!_filterdict_to_statfilter(filter_dict, &ext_args.func_filter)) {
+        return NULL;
+    }
+
+    henum(contexts, _ctxfuncenumstat, &ext_args);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+_columns2tuple(_column *cols, int count)
+{
+    PyObject *result, *data;
+    int i;
+
+    result = PyTuple_New(count);
+    if (!result) {
+        return NULL;
+    }
+    for (i = 0; i < count; i++) {
+        data = PyBytes_FromStringAndSize(cols[i].data, cols[i].size);
+        if (!data) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(result, i, data);
+    }
+    return result;
+}
+
+// returns the function stats as (function columns, edge columns, strings,
+// histogram columns). A column is the bytes of a C array with a value per
+// function, per (parent, child) pair or per histogram bucket, see
+// FUNC_ARRAY_COLUMNS, EDGE_ARRAY_COLUMNS and HIST_ARRAY_COLUMNS in yappi.py.
+// The names, modules and context names are indexes in strings.
+static PyObject *
+get_func_stats_arrays(PyObject *self, PyObject *args)
+{
+    PyObject *filter_dict, *funcs, *edges, *hists, *result;
+    _ctxenumarg ext_args;
+    _statcolumns cols;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "O!", &PyDict_Type, &filter_dict))
+        return NULL;
+
+    memset(&ext_args, 0, sizeof(_ctxenumarg));
+    memset(&cols, 0, sizeof(_statcolumns));
+    if (!_filterdict_to_statfilter(filter_dict, &ext_args.func_filter)) {
+        return NULL;
+    }
+
+    result = NULL;
+    cols.strings = PyList_New(0);
+    cols.string_ids = PyDict_New();
+    cols.indexes = htcreate(HT_PIT_SIZE);
+    if (!cols.strings || !cols.string_ids) {
+        goto finally;
+    }
+    if (!cols.indexes) {
+        PyErr_NoMemory();
+        goto finally;
     }
 
-    // convert children function index list to PyList
-    children = PyList_New(0);
-    pci = pt->children;
-    while(pci) {
-        PyObject *stats_tuple;
-        // normalize tsubtotal. tsubtotal being negative is an expected situation.
-        if (pci->tsubtotal < 0) {
-            pci->tsubtotal = 0;
+    if (yapphavestats) {
+        ext_args.columns = &cols;
+        henum(contexts, _ctxfuncenumstat, &ext_args);
+        if (PyErr_Occurred()) {
+            goto finally;
         }
-        if (pci->callcount == 0)
-            pci->callcount = 1;
-        stats_tuple = Py_BuildValue("Ikkff", pci->index, pci->callcount,
-                pci->nonrecursive_callcount, _normt(pci->ttotal),
-                _normt(pci->tsubtotal));
-        PyList_Append(children, stats_tuple);
-        Py_DECREF(stats_tuple);
-        pci = (_pit_children_info *)pci->next;
+        _dropdanglingedges(&cols);
     }
-    // normalize values
-    if (pt->tsubtotal < 0)
-        pt->tsubtotal = 0;
-    if (pt->callcount == 0)
-        pt->callcount = 1;
 
-    // normally _yapp_callback sets ctx->name if not set but there is a possibility
-    // that we might end up here even it is not set. We also do not default it to 
-    // Py_None as we will Py_CLEAR() on it later on.
-    ctx_name = eargs->ctx->name;
-    if (!ctx_name) {
-        ctx_name = Py_None;
+    funcs = _columns2tuple(cols.funcs, FUNC_COLUMN_COUNT);
+    edges = _columns2tuple(cols.edges, EDGE_COLUMN_COUNT);
+    hists = _columns2tuple(cols.hists, HIST_COLUMN_COUNT);
+    if (funcs && edges && hists) {
+        result = PyTuple_Pack(4, funcs, edges, cols.strings, hists);
     }
+    Py_XDECREF(funcs);
+    Py_XDECREF(edges);
+    Py_XDECREF(hists);
 
-    exc = PyObject_CallFunction(eargs->enum_args->enumfn, "((OOkkkIffIOkOkO))", 
-                        pt->name, pt->modname, pt->lineno, pt->callcount,
-                        pt->nonrecursive_callcount, pt->builtin, 
-                        _normt(pt->ttotal), _normt(pt->tsubtotal),
-                        pt->index, children, eargs->ctx->id, ctx_name,
-                        eargs->tag, pt->fn_descriptor);
-
-    if (!exc) {
-        PyErr_Print();
-        Py_XDECREF(children);
-        return 1; // abort enumeration
+finally:
+    for (i = 0; i < FUNC_COLUMN_COUNT; i++) {
+        PyMem_Free(cols.funcs[i].data);
+    }
+    for (i = 0; i < EDGE_COLUMN_COUNT; i++) {
+        PyMem_Free(cols.edges[i].data);
     }
+    for (i = 0; i < HIST_COLUMN_COUNT; i++) {
+        PyMem_Free(cols.hists[i].data);
+    }
+    Py_XDECREF(cols.strings);
+    Py_XDECREF(cols.string_ids);
+    if (cols.indexes) {
+        htdestroy(cols.indexes);
+    }
+    return result;
+}
 
-    Py_DECREF(exc);
-    Py_XDECREF(children);
+static double
+_topvalue(_topargs *top, _topfunc *tf)
+{
+    double value;
 
-    return 0;
+    switch (top->sort_type) {
+    case TOP_NCALL:
+        value = (double)tf->callcount;
+        break;
+    case TOP_TTOT:
+        value = (double)tf->ttotal;
+        break;
+    case TOP_TSUB:
+        value = (double)tf->tsubtotal;
+        break;
+    case TOP_TAVG:
+        value = tf->callcount ? (double)tf->ttotal / tf->callcount : 0;
+        break;
+    case TOP_TTOT_CPU:
+        value = (double)tf->cpu_ttotal;
+        break;
+    case TOP_TSUB_CPU:
+        value = (double)tf->cpu_tsubtotal;
+        break;
+    default:
+        value = (double)tf->tmax;
+        break;
+    }
+    return top->ascending ? -value : value;
 }
 
+// a min-heap of the top functions seen so far, the one to be replaced first
+// is at the root.
+typedef struct {
+    _topargs *top;
+    _topfunc **items;
+    int size;
+    int limit;
+} _topheap;
+
+// returns 1 if a is to be replaced before b. The ties are broken like the
+// stable sort of yappi.py, the function enumerated first wins.
 static int
-_tagenumstat(_hitem *item, void *arg)
+_topworse(_topfunc *a, _topfunc *b)
 {
-    _htab *pits;
-    uintptr_t current_tag;
-    _ctxfuncenumarg *eargs;
-    _fast_func_stat_filter filter;
+    if (a->value != b->value) {
+        return a->value < b->value;
+    }
+    return a->order > b->order;
+}
 
-    current_tag = item->key;
-    eargs = (_ctxfuncenumarg *)arg;
-    filter = eargs->enum_args->func_filter;
-    eargs->tag = current_tag;
+static void
+_siftdown(_topheap *heap, int i)
+{
+    int child;
+    _topfunc *tmp;
 
-    if (filter.tag) {
-        if (current_tag != PyLong_AsVoidPtr(filter.tag)) {
-            return 0;
+    for (;;) {
+        child = 2 * i + 1;
+        if (child >= heap->size) {
+            return;
         }
+        if (child + 1 < heap->size &&
+                _topworse(heap->items[child + 1], heap->items[child])) {
+            child++;
+        }
+        if (!_topworse(heap->items[child], heap->items[i])) {
+            return;
+        }
+        tmp = heap->items[i];
+        heap->items[i] = heap->items[child];
+        heap->items[child] = tmp;
+        i = child;
     }
-
-    pits =  (_htab *)item->val;
-    henum(pits, _pitenumstat, arg);
-
-    return 0;
 }
 
-static int 
-_ctxfuncenumstat(_hitem *item, void *arg)
+static int
+_topheapadd(_hitem *item, void *arg)
 {
-    _ctxfuncenumarg ext_args;
-    PyObject *filtered_ctx_id;
-
-    ext_args.ctx = (_ctx *)item->val; 
-    ext_args.enum_args = (_ctxenumarg *)arg;
-    ext_args.tag = 0; // default
+    _topheap *heap;
+    _topfunc *tf, *tmp;
+    int i;
 
-    filtered_ctx_id = ext_args.enum_args->func_filter.ctx_id;
-    if (filtered_ctx_id) {
-        if (ext_args.ctx->id != PyLong_AsVoidPtr(filtered_ctx_id)) {
-            return 0;
+    heap = (_topheap *)arg;
+    for (tf = (_topfunc *)item->val; tf; tf = tf->next) {
+        tf->value = _topvalue(heap->top, tf);
+        if (heap->size < heap->limit) {
+            // sift up
+            i = heap->size++;
+            heap->items[i] = tf;
+            while (i > 0 && _topworse(heap->items[i], heap->items[(i - 1) / 2])) {
+                tmp = heap->items[i];
+                heap->items[i] = heap->items[(i - 1) / 2];
+                heap->items[(i - 1) / 2] = tmp;
+                i = (i - 1) / 2;
+            }
+        } else if (_topworse(heap->items[0], tf)) {
+            heap->items[0] = tf;
+            _siftdown(heap, 0);
         }
     }
-
-    henum(ext_args.ctx->tags, _tagenumstat, &ext_args);
-
     return 0;
 }
 
-static PyObject*
-start(PyObject *self, PyObject *args)
+static int
+_topfuncdel(_hitem *item, void *arg)
 {
-    if (yapprunning)
-        Py_RETURN_NONE;
-
-    if (!PyArg_ParseTuple(args, "ii", &flags.builtins, &flags.multicontext))
-        return NULL;
+    _topfunc *tf, *next;
 
-    if (!_start())
-        // error
-        return NULL;
-
-    Py_RETURN_NONE;
+    for (tf = (_topfunc *)item->val; tf; tf = next) {
+        next = tf->next;
+        yfree(tf);
+    }
+    return 0;
 }
 
-static PyObject*
-stop(PyObject *self, PyObject *args)
+// adds the key to the set unless it is there already, returns 0 on error.
+static int
+_topsetadd(_htab *set, uintptr_t key)
 {
-    _stop();
-    Py_RETURN_NONE;
+    return hfind(set, key) || hadd(set, key, 1);
 }
 
-int
-_filterdict_to_statfilter(PyObject *filter_dict, _fast_func_stat_filter* filter)
+// adds the functions of the children of the pit to selected if it belongs to
+// a top function.
+static int
+_topselectchildren(_hitem *item, void *arg)
 {
-    // we use a _statfilter struct to hold the struct and not to always 
-    // as the filter_dict to get its values for each pit enumerated. This
-    // is for performance
-    PyObject *fv;
+    _topargs *top;
+    _hitem *it;
+    _pit *pt;
+    _pit_children_info *pci;
 
-    fv = PyDict_GetItemString(filter_dict, "tag");
-    if (fv) {
-        PyLong_AsVoidPtr(fv);
-        if (PyErr_Occurred()) {
-            PyErr_Clear();
-            yerr("invalid tag passed to get_func_stats.");
-            PyErr_SetString(YappiProfileError, "invalid tag passed to get_func_stats");
-            filter->tag = NULL;
-            return 0;
-        }
-        filter->tag = fv;
+    top = (_topargs *)arg;
+    pt = (_pit *)item->val;
+    it = hfind(top->pitfuncs, pt->index);
+    if (!hfind(top->top, it->val)) {
+        return 0;
     }
-    fv = PyDict_GetItemString(filter_dict, "ctx_id");
-    if (fv) {
-        PyLong_AsVoidPtr(fv);
-        if (PyErr_Occurred()) {
-            PyErr_Clear();
-            yerr("invalid ctx_id passed to get_func_stats.");
-            PyErr_SetString(YappiProfileError, "invalid ctx_id passed to get_func_stats");
-            filter->ctx_id = NULL;
-            return 0;
+    for (pci = pt->children; pci; pci = (_pit_children_info *)pci->next) {
+        it = hfind(top->pitfuncs, pci->index);
+        if (it && !_topsetadd(top->selected, it->val)) {
+            PyErr_NoMemory();
+            return 1;
         }
-        filter->ctx_id = fv;
-    }
-
-    fv = PyDict_GetItemString(filter_dict, "name");
-    if (fv) {
-        filter->name = fv;
-    }
-    fv = PyDict_GetItemString(filter_dict, "module");
-    if (fv) {
-        filter->modname = fv;
     }
-
-    return 1;
+    return 0;
 }
 
-static PyObject*
-enum_func_stats(PyObject *self, PyObject *args)
+// enumerates the pits of the limit functions with the largest (or smallest
+// if ascending) sort_type value, summed over the contexts and tags, and
+// those of their children. Returns the indexes of the pits of the top
+// functions.
+static PyObject *
+enum_top_func_stats(PyObject *self, PyObject *args)
 {
-    PyObject *filter_dict;
+    static const char *sort_types[] = {
+        "ncall", "ttot", "tsub", "tavg", "ttot_cpu", "tsub_cpu", "tmax", NULL
+    };
+    PyObject *filter_dict, *result;
+    const char *sort_type;
     _ctxenumarg ext_args;
-
-    filter_dict = NULL;
-    memset(&ext_args, 0, sizeof(_ctxenumarg)); // make sure everything is NULLed
-
-    if (!yapphavestats) {
-        Py_RETURN_NONE;
-    }
-
-    if (!PyArg_ParseTuple(args, "OO", &ext_args.enumfn, &filter_dict)) {
-        PyErr_SetString(YappiProfileError, "invalid param to enum_func_stats");
+    _topargs top;
+    _topheap heap;
+    int limit, i;
+
+    memset(&ext_args, 0, sizeof(_ctxenumarg));
+    memset(&top, 0, sizeof(_topargs));
+    if (!PyArg_ParseTuple(args, "OO!sii", &ext_args.enumfn, &PyDict_Type,
+            &filter_dict, &sort_type, &top.ascending, &limit))
         return NULL;
-    }
 
-    if (!PyDict_Check(filter_dict)) {
-        PyErr_SetString(YappiProfileError, "filter param should be a dict");
+    for (i = 0; sort_types[i]; i++) {
+        if (strcmp(sort_type, sort_types[i]) == 0) {
+            break;
+        }
+    }
+    if (!sort_types[i]) {
+        PyErr_SetString(YappiProfileError, "invalid sort type.");
         return NULL;
     }
+    top.sort_type = (_topsort_t)i;
 
     if (!PyCallable_Check(ext_args.enumfn)) {
         PyErr_SetString(YappiProfileError, "enum function must be callable");
         return NULL;
     }
-
     if (!_filterdict_to_statfilter(filter_dict, &ext_args.func_filter)) {
         return NULL;
     }
 
+    top.indexes = PyList_New(0);
+    if (!top.indexes || !yapphavestats || limit <= 0) {
+        return top.indexes;
+    }
+
+    result = NULL;
+    heap.items = NULL;
+    top.funcs = htcreate(HT_TOP_SIZE);
+    top.pits = htcreate(HT_TOP_SIZE);
+    top.pitfuncs = htcreate(HT_TOP_SIZE);
+    if (!top.funcs || !top.pits || !top.pitfuncs) {
+        PyErr_NoMemory();
+        goto finally;
+    }
+
+    // sum the stats of the functions, the pits are enumerated only once
+    // selected is set
+    ext_args.top = &top;
+    henum(contexts, _ctxfuncenumstat, &ext_args);
+    if (PyErr_Occurred()) {
+        goto finally;
+    }
+    top.top = htcreate(HT_TOP_SIZE);
+    top.selected = htcreate(HT_TOP_SIZE);
+    if (!top.top || !top.selected) {
+        PyErr_NoMemory();
+        goto finally;
+    }
+
+    // select the top functions
+    heap.top = &top;
+    heap.size = 0;
+    heap.limit = (unsigned long)limit < top.nfuncs ? limit : (int)top.nfuncs;
+    heap.items = (_topfunc **)ymalloc(sizeof(_topfunc *) * (heap.limit + 1));
+    if (!heap.items) {
+        PyErr_NoMemory();
+        goto finally;
+    }
+    henum(top.funcs, _topheapadd, &heap);
+    for (i = 0; i < heap.size; i++) {
+        if (!_topsetadd(top.top, (uintptr_t)heap.items[i]) ||
+                !_topsetadd(top.selected, (uintptr_t)heap.items[i])) {
+            PyErr_NoMemory();
+            goto finally;
+        }
+    }
+    // and their children, in a single pass over the pits
+    henum(top.pits, _topselectchildren, &top);
+    if (PyErr_Occurred()) {
+        goto finally;
+    }
+
+    // enumerate their pits
     henum(contexts, _ctxfuncenumstat, &ext_args);
+    if (PyErr_Occurred()) {
+        goto finally;
+    }
 
-    Py_RETURN_NONE;
+    result = top.indexes;
+    Py_INCREF(result);
+
+finally:
+    if (heap.items) {
+        yfree(heap.items);
+    }
+    if (top.funcs) {
+        henum(top.funcs, _topfuncdel, NULL);
+        htdestroy(top.funcs);
+    }
+    if (top.pits) {
+        htdestroy(top.pits);
+    }
+    if (top.pitfuncs) {
+        htdestroy(top.pitfuncs);
+    }
+    if (top.top) {
+        htdestroy(top.top);
+    }
+    if (top.selected) {
+        htdestroy(top.selected);
+    }
+    Py_DECREF(top.indexes);
+    return result;
 }
 
 static PyObject *
@@ -1955,6 +4750,31 @@ set_tag_callback(PyObject *self, PyObject *args)
     Py_XDECREF(tag_callback);
     Py_INCREF(new_callback);
     tag_callback = new_callback;
+    Py_CLEAR(tag_contextvar);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+set_tag_contextvar(PyObject *self, PyObject *args)
+{
+    PyObject* new_var;
+
+    if (!PyArg_ParseTuple(args, "O", &new_var)) {
+        return NULL;
+    }
+
+    if (new_var == Py_None) {
+        Py_CLEAR(tag_contextvar);
+        Py_RETURN_NONE;
+    } else if (!PyContextVar_CheckExact(new_var)) {
+        PyErr_SetString(PyExc_TypeError, "var should be a contextvars.ContextVar.");
+        return NULL;
+    }
+    Py_XDECREF(tag_contextvar);
+    Py_INCREF(new_var);
+    tag_contextvar = new_var;
+    Py_CLEAR(tag_callback);
 
     Py_RETURN_NONE;
 }
@@ -2053,14 +4873,14 @@ set_test_timings(PyObject *self, PyObject *args)
 static PyObject *
 set_clock_type(PyObject *self, PyObject *args)
 {
-    clock_type_t clock_type;
+    int clock_type;
     
     if (!PyArg_ParseTuple(args, "i", &clock_type)) {
         return NULL;
     }
     
     // return silently if same clock_type
-    if (clock_type == get_timing_clock_type())
+    if (clock_type == (int)get_timing_clock_type())
     {
         Py_RETURN_NONE;
     }
@@ -2070,10 +4890,15 @@ set_clock_type(PyObject *self, PyObject *args)
         return NULL;
     }
     
-    if (!set_timing_clock_type(clock_type)) {
+    if (clock_type < 0 || clock_type >= CLOCK_TYPE_COUNT) {
         PyErr_SetString(YappiProfileError, "Invalid clock type.");
         return NULL;
-    }   
+    }
+
+    if (!set_timing_clock_type((clock_type_t)clock_type)) {
+        PyErr_SetString(YappiProfileError, "clock type is not available on this platform.");
+        return NULL;
+    }
     
     Py_RETURN_NONE;
 }
@@ -2097,44 +4922,37 @@ get_clock_time(PyObject *self, PyObject *args)
 static PyObject *
 get_clock_info(PyObject *self, PyObject *args)
 {
-    PyObject *api = NULL;
-    PyObject *result = NULL;
-    PyObject *resolution = NULL;
-    clock_type_t clk_type;
+    char resolution[32];
+    double ns;
 
-    result = PyDict_New();
-    
-    clk_type = get_timing_clock_type();
-    if (clk_type == WALL_CLOCK) {
-#if defined(_WINDOWS)
-        api = Py_BuildValue("s", "queryperformancecounter");
-        resolution = Py_BuildValue("s", "100ns");    
-#else
-        api = Py_BuildValue("s", "gettimeofday");
-        resolution = Py_BuildValue("s", "100ns");
-#endif
-    }  else {
-#if defined(USE_CLOCK_TYPE_GETTHREADTIMES)
-        api = Py_BuildValue("s", "getthreadtimes");
-        resolution = Py_BuildValue("s", "100ns");
-#elif defined(USE_CLOCK_TYPE_THREADINFO)
-        api = Py_BuildValue("s", "threadinfo");
-        resolution = Py_BuildValue("s", "1000ns");
-#elif defined(USE_CLOCK_TYPE_CLOCKGETTIME)
-        api = Py_BuildValue("s", "clockgettime");
-        resolution = Py_BuildValue("s", "1ns");
-#elif defined(USE_CLOCK_TYPE_RUSAGE)
-        api = Py_BuildValue("s", "getrusage");
-        resolution = Py_BuildValue("s", "1000ns");
-#endif
+    ns = clockresolution() * 1000000000;
+    if (ns >= 1) {
+        snprintf(resolution, sizeof(resolution), "%.0fns", ns);
+    } else {
+        snprintf(resolution, sizeof(resolution), "%.2fns", ns);
     }
 
-    PyDict_SetItemString(result, "api", api);
-    PyDict_SetItemString(result, "resolution", resolution);
+    return Py_BuildValue("{ssss}", "api", clockapi(), "resolution", resolution);
+}
+
+static PyObject *
+get_clock_overhead(PyObject *self, PyObject *args)
+{
+    _overhead *ov;
 
-    Py_XDECREF(api);
-    Py_XDECREF(resolution);
-    return result;
+    if (!calibrated[get_timing_clock_type()]) {
+        // the calibration context is allocated from the pools of the
+        // profiler, which are freed by clear_stats()
+        if (!_init_profiler()) {
+            PyErr_SetString(YappiProfileError, "profiler cannot be initialized.");
+            return NULL;
+        }
+        _calibrate();
+    }
+    ov = call_overhead[get_timing_clock_type()];
+
+    return Py_BuildValue("{sdsd}", "function", ov[0].total * tickfactor(),
+        "builtin", ov[1].total * tickfactor());
 }
 
 static PyObject *
@@ -2143,9 +4961,16 @@ get_clock_type(PyObject *self, PyObject *args)
     clock_type_t clk_type;
     
     clk_type = get_timing_clock_type();
-    if (clk_type == WALL_CLOCK) {
+    switch (clk_type) {
+    case WALL_CLOCK:
         return Py_BuildValue("s", "wall");
-    }  else {
+    case MONOTONIC_CLOCK:
+        return Py_BuildValue("s", "monotonic");
+    case TSC_CLOCK:
+        return Py_BuildValue("s", "tsc");
+    case DUAL_CLOCK:
+        return Py_BuildValue("s", "dual");
+    default:
         return Py_BuildValue("s", "cpu");
     }
 }
@@ -2157,6 +4982,8 @@ get_start_flags(PyObject *self, PyObject *args)
     PyObject *result = NULL;
     PyObject *profile_builtins = NULL;
     PyObject *profile_multicontext = NULL;
+    PyObject *engine = NULL;
+    PyObject *histograms = NULL;
     
     if (!yapphavestats) {
         Py_RETURN_NONE;
@@ -2164,12 +4991,18 @@ get_start_flags(PyObject *self, PyObject *args)
 
     profile_builtins = Py_BuildValue("i", flags.builtins);
     profile_multicontext = Py_BuildValue("i", flags.multicontext);
+    engine = Py_BuildValue("i", flags.engine);
+    histograms = Py_BuildValue("i", flags.histograms);
     result = PyDict_New();
     PyDict_SetItemString(result, "profile_builtins", profile_builtins);
     PyDict_SetItemString(result, "profile_multicontext", profile_multicontext);
+    PyDict_SetItemString(result, "engine", engine);
+    PyDict_SetItemString(result, "histograms", histograms);
     
     Py_XDECREF(profile_builtins);
     Py_XDECREF(profile_multicontext);
+    Py_XDECREF(engine);
+    Py_XDECREF(histograms);
     return result;
 }
 
@@ -2211,6 +5044,7 @@ _wait_for_callbacks(PyObject *self, PyObject *args)
 static PyMethodDef yappi_methods[] = {
     {"start", start, METH_VARARGS, NULL},
     {"stop", stop, METH_NOARGS, NULL},
+    {"sample", sample, METH_VARARGS, NULL},
     {"enum_func_stats", enum_func_stats, METH_VARARGS, NULL},
     {"enum_context_stats", enum_context_stats, METH_VARARGS, NULL},
     {"enum_thread_stats", enum_context_stats, METH_VARARGS, NULL},
@@ -2220,9 +5054,16 @@ static PyMethodDef yappi_methods[] = {
     {"set_clock_type", set_clock_type, METH_VARARGS, NULL},
     {"get_clock_time", get_clock_time, METH_VARARGS, NULL},
     {"get_clock_info", get_clock_info, METH_VARARGS, NULL},
+    {"get_clock_overhead", get_clock_overhead, METH_VARARGS, NULL},
     {"get_mem_usage", get_mem_usage, METH_VARARGS, NULL},
+    {"get_trace", get_trace, METH_VARARGS, NULL},
+    {"take_trace", take_trace, METH_VARARGS, NULL},
+    {"get_call_paths", get_call_paths, METH_VARARGS, NULL},
+    {"get_func_stats_arrays", get_func_stats_arrays, METH_VARARGS, NULL},
+    {"enum_top_func_stats", enum_top_func_stats, METH_VARARGS, NULL},
     {"set_context_id_callback", set_context_id_callback, METH_VARARGS, NULL},
     {"set_tag_callback", set_tag_callback, METH_VARARGS, NULL},
+    {"set_tag_contextvar", set_tag_contextvar, METH_VARARGS, NULL},
     {"set_context_name_callback", set_context_name_callback, METH_VARARGS, NULL},
     {"set_context_backend", set_context_backend, METH_VARARGS, NULL},
     {"get_context_backend", get_context_backend, METH_VARARGS, NULL},
@@ -2255,6 +5096,9 @@ PyInit__yappi(void)
     m = PyModule_Create(&_yappi_module);
     if (m == NULL)
         return NULL;
+#ifdef Py_GIL_DISABLED
+    PyUnstable_Module_SetGIL(m, Py_MOD_GIL_NOT_USED);
+#endif
 
     d = PyModule_GetDict(m);
     YappiProfileError = PyErr_NewException("_yappi.error", NULL, NULL);
@@ -2267,11 +5111,18 @@ PyInit__yappi(void)
     paused = 0;
     flags.builtins = 0;
     flags.multicontext = 0;
+    flags.engine = SETPROFILE_ENGINE;
+    flags.histograms = 0;
+    flags.trace_buffer = 0;
+    flags.trace_stream = 0;
+    flags.call_paths = 0;
     test_timings = NULL;
 
     SUPPRESS_WARNING(_DebugPrintObjects);
     SUPPRESS_WARNING(_print_coros);
 
+    code_extra_index = PyUnstable_Eval_RequestCodeExtraIndex(_free_code_extra);
+
     if (!_init_profiler()) {
         PyErr_SetString(YappiProfileError, "profiler cannot be initialized.");
         return NULL;
@@ -13,7 +13,6 @@ slen(_cstack *cs)
 _cstack *
 screate(int size)
 {
-    int i;
     _cstack *cs;
 
     cs = (_cstack *)ymalloc(sizeof(_cstack));
@@ -25,10 +24,8 @@ screate(int size)
         return NULL;
     }
 
-    for(i=0; i<size; i++) {
-        cs->_items[i].ckey = 0;
-        cs->_items[i].t0 = 0;
-    }
+    // the fields not touched by spush/spop are zeroed too
+    memset(cs->_items, 0, size * sizeof(_cstackitem));
 
     cs->size = size;
     cs->head = -1;
@@ -46,8 +43,7 @@ _sgrow(_cstack * cs)
         return 0;
 
     for(i=0; i<cs->size; i++) {
-        dummy->_items[i].ckey = cs->_items[i].ckey;
-        dummy->_items[i].t0 = cs->_items[i].t0;
+        dummy->_items[i] = cs->_items[i];
     }
     yfree(cs->_items);
     cs->_items = dummy->_items;
@@ -6,6 +6,11 @@
 typedef struct {
     long long t0;
     void *ckey;
+    void *cinfo; // extra info about the item, not touched by spush/spop
+    void *frame; // the frame a sampled item is seen with, not touched by spush/spop
+    double overhead; // the profiler overhead seen when pushed, not touched by spush/spop
+    long long cpu_t0; // cputickcount() when pushed with the dual clock, not touched by spush/spop
+    void *node; // the calling context tree node with call_paths, not touched by spush/spop
 } _cstackitem;
 
 typedef struct {
@@ -15,14 +15,45 @@
 #include "stdint.h"
 #endif
 
-// static pool sizes
-#define FL_PIT_SIZE 1000
+// free-threaded builds (PEP 703) run the profile events of different threads
+// in parallel. The few tables shared between the threads are guarded with the
+// locks below which are no-ops when the GIL serializes the events.
+#ifdef Py_GIL_DISABLED
+#ifdef _MSC_VER
+#define YTHREAD_LOCAL __declspec(thread)
+#else
+#define YTHREAD_LOCAL _Thread_local
+#endif
+typedef PyMutex ymutex_t;
+#define ylock(m) PyMutex_Lock(m)
+#define yunlock(m) PyMutex_Unlock(m)
+#else
+#define YTHREAD_LOCAL
+typedef int ymutex_t;
+#define ylock(m) ((void)(m))
+#define yunlock(m) ((void)(m))
+#endif
+
+// static pool sizes. pits, children, coroutines and call path nodes are pooled per context,
+// their first slab is allocated when the context needs one.
+#define FL_PIT_SIZE 64
 #define FL_CTX_SIZE 100
+#define FL_CHILDREN_SIZE 64
+#define FL_CORO_SIZE 16
+#define FL_CCT_SIZE 64
 #define HT_PIT_SIZE 10
-#define HT_TAG_SIZE 10
+#define HT_TAG_SIZE 4
 #define HT_TAGGED_PIT_SIZE 4
 #define HT_CTX_SIZE 10
-#define HT_RLEVEL_SIZE 10
+#define HT_MODULE_FILTER_SIZE 10
+#define HT_CHILDREN_INDEX_SIZE 5
+#define HT_TOP_SIZE 8
+#define CHILDREN_INDEX_THRESHOLD 8 // children are found by walking the list below this
+#define PIT_PAGE_SIZE 256 // must be a power of 2
+#define FID_STACK_SIZE 100
+#define FRAME_BUFFER_SIZE 64
 #define DEFAULT_TEST_ELAPSED_TIME 3
+#define CALIBRATION_ROUNDS 10
+#define CALIBRATION_CALLS 200 // calls per calibration round
 
 #endif
@@ -1,99 +1,87 @@
 #include "freelist.h"
 #include "mem.h"
 
+// keep items aligned for any member type
+#define FLALIGN(n) (((n) + sizeof(long long) - 1) & ~(sizeof(long long) - 1))
+
 static int
-_flgrow(_freelist *flp)
+_flgrow(_freelist *flp, int size)
 {
-    int i, newsize;
-    void **old;
+    _flslab *slab;
 
-    old = flp->items;
-    newsize = flp->size * 2;
-    flp->items = ymalloc(newsize * sizeof(void *));
-    if (!flp->items)
+    slab = ymalloc(FLALIGN(sizeof(_flslab)) + (size_t)size * flp->chunksize);
+    if (!slab)
         return 0;
 
-    // init new list
-    for(i=0; i<flp->size; i++) {
-        flp->items[i] = ymalloc(flp->chunksize);
-        if (!flp->items[i]) {
-            yfree(flp->items);
-            return 0;
-        }
-    }
-    // copy old list
-    for(i=flp->size; i<newsize; i++)
-        flp->items[i] = old[i-flp->size];
-
-    yfree(old);
-    flp->head = flp->size-1;
-    flp->size = newsize;
+    slab->next = flp->slabs;
+    flp->slabs = slab;
+    flp->bump = (char *)slab + FLALIGN(sizeof(_flslab));
+    flp->end = flp->bump + (size_t)size * flp->chunksize;
+    flp->size += size;
     return 1;
 }
 
 _freelist *
 flcreate(int chunksize, int size)
 {
-    int i;
     _freelist *flp;
 
     flp = (_freelist *)ymalloc(sizeof(_freelist));
     if (!flp)
         return NULL;
-    flp->items = ymalloc(size * sizeof(void *));
-    if (!flp->items) {
-        yfree(flp);
-        return NULL;
-    }
 
-    for (i=0; i<size; i++) {
-        flp->items[i] = ymalloc(chunksize);
-        if (!flp->items[i]) {
-            yfree(flp->items);
-            yfree(flp);
-            return NULL;
-        }
-    }
-    flp->size = size;
-    flp->chunksize = chunksize;
-    flp->head = size-1;
+    // freed items hold the link to the next free item
+    if (chunksize < (int)sizeof(void *))
+        chunksize = sizeof(void *);
+    flp->chunksize = FLALIGN(chunksize);
+    flp->size = 0;
+    flp->free = NULL;
+    flp->bump = flp->end = NULL;
+    flp->slabs = NULL;
+    flp->initsize = size > 0 ? size : 1;
     return flp;
 }
 
+// releases all the items at once.
 void
 fldestroy(_freelist *flp)
 {
-    int i;
+    _flslab *slab, *next;
 
-    for (i=0; i<flp->size; i++) {
-        yfree(flp->items[i]);
+    slab = flp->slabs;
+    while(slab) {
+        next = slab->next;
+        yfree(slab);
+        slab = next;
     }
-    yfree(flp->items);
     yfree(flp);
 }
 
 void *
 flget(_freelist *flp)
 {
-    if (flp->head < 0) {
-        if (!_flgrow(flp))
+    void *p;
+
+    if (flp->free) {
+        p = flp->free;
+        flp->free = *(void **)p;
+        return p;
+    }
+
+    if (flp->bump == flp->end) {
+        // double the capacity with each new slab
+        if (!_flgrow(flp, flp->size ? flp->size : flp->initsize))
             return NULL;
     }
-    return flp->items[flp->head--];
+    p = flp->bump;
+    flp->bump += flp->chunksize;
+    return p;
 }
 
 int
 flput(_freelist *flp, void *p)
 {
-    if (flp->head > flp->size-2)
-        return 0;
-
-    flp->items[++flp->head] = p;
+    *(void **)p = flp->free;
+    flp->free = p;
     return 1;
 }
-
-unsigned int
-flcount(_freelist *flp)
-{
-    return flp->size - flp->head + 1;
-}
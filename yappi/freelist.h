@@ -1,21 +1,26 @@
 #ifndef YFREELIST_H
 #define YFREELIST_H
 
+// items are carved out of large slabs. Freed items are linked through their
+// own memory and reused, the slabs are only released by fldestroy().
+struct _flslab {
+    struct _flslab *next;
+};
+typedef struct _flslab _flslab;
+
 typedef struct {
-    int head;
-    int size;
+    int size; // items available in all the slabs
     int chunksize;
-    void **items;
+    int initsize; // items in the first slab, allocated by the first flget()
+    void *free; // list of the items returned by flput()
+    char *bump; // next never used item of the last slab
+    char *end;
+    _flslab *slabs;
 } _freelist;
 
 _freelist * flcreate(int chunksize, int size);
 void fldestroy(_freelist *flp);
 void *flget(_freelist *flp);
 int flput(_freelist *flp, void *p);
-unsigned int flcount(_freelist *flp);
-void fldisp(_freelist *flp);
 
 #endif
-
-
-
@@ -1,79 +1,152 @@
 /*
 *    Hash Table
 *    Sumer Cip 2012
+*
+*    Open addressing with linear probing. Items are stored inline in the
+*    table and deleted items are marked so that probe sequences are kept
+*    intact until the next resize. When the table grows, the items are moved
+*    to the new table a few slots at a time by the subsequent hadd() calls
+*    instead of rehashing all of them at once.
 */
 
 #include "hashtab.h"
 #include "mem.h"
 
+// Fibonacci hashing: the high bits of the product are well mixed even for
+// aligned pointers, so they are used as the slot index.
 static unsigned int
-HHASH(_htab *ht, uintptr_t a)
+HHASH(uintptr_t a, int logsize)
 {
-    a = (a ^ 61) ^ (a >> 16);
-    a = a + (a << 3);
-    a = a ^ (a >> 4);
-    a = a * 0x27d4eb2d;
-    a = a ^ (a >> 15);
-    return (a & ht->mask);
+#if UINTPTR_MAX > 0xFFFFFFFF
+    return (unsigned int)((a * 11400714819323198485ULL) >> (64 - logsize));
+#else
+    return (unsigned int)((a * 2654435769U) >> (32 - logsize));
+#endif
+}
+
+static _hitem *
+_htalloc(int realsize)
+{
+    return (_hitem *)ycalloc(realsize * sizeof(_hitem)); // all HSLOT_EMPTY
+}
+
+// returns the used slot holding the key or NULL.
+static _hitem *
+_hlookup(_hitem *table, int logsize, uintptr_t key)
+{
+    unsigned int i, mask;
+    _hitem *p;
+
+    mask = HMASK(logsize);
+    i = HHASH(key, logsize);
+    while(1) {
+        p = &table[i];
+        if (p->state == HSLOT_EMPTY)
+            return NULL;
+        if ((p->state == HSLOT_USED) && (p->key == key))
+            return p;
+        i = (i+1) & mask;
+    }
+}
+
+// puts a key that is known to be missing to the first available slot.
+static void
+_hinsert(_htab *ht, uintptr_t key, uintptr_t val)
+{
+    unsigned int i;
+    _hitem *p;
+
+    i = HHASH(key, ht->logsize);
+    while(1) {
+        p = &ht->_table[i];
+        if (p->state != HSLOT_USED)
+            break;
+        i = (i+1) & ht->mask;
+    }
+    if (p->state == HSLOT_EMPTY)
+        ht->filled++;
+    p->key = key;
+    p->val = val;
+    p->state = HSLOT_USED;
+}
+
+// moves at most nslots slots of the old table to the current one.
+static void
+_hmigrate(_htab *ht, int nslots)
+{
+    _hitem *p;
+
+    while(ht->_old && nslots-- > 0) {
+        p = &ht->_old[ht->_migrated++];
+        if (p->state == HSLOT_USED)
+            _hinsert(ht, p->key, p->val);
+        if (ht->_migrated == ht->_oldsize) {
+            yfree(ht->_old);
+            ht->_old = NULL;
+        }
+    }
 }
 
 static int
 _hgrow(_htab *ht)
 {
-    int i;
-    _htab *dummy;
-    _hitem *p, *next, *it;
+    int logsize;
+    _hitem *table;
+
+    // the previous resize is finished long before the table is full again,
+    // this is just for safety.
+    _hmigrate(ht, ht->_oldsize);
+
+    // if most of the filled slots are deleted items, a new table of the
+    // same size is enough to get rid of them.
+    logsize = ht->logsize;
+    if ((ht->count+1)*2 > ht->realsize)
+        logsize++;
 
-    dummy = htcreate(ht->logsize+1);
-    if (!dummy)
+    table = _htalloc(HSIZE(logsize));
+    if (!table)
         return 0;
-    for(i=0; i<ht->realsize; i++) {
-        p = ht->_table[i];
-        while(p) {
-            next = p->next;
-            if (!hadd(dummy, p->key, p->val))
-                return 0;
-            it = hfind(dummy, p->key);
-            if (!it)
-                return 0;
-            it->free = p->free;
-            yfree(p);
-            p = next;
-        }
-    }
 
-    yfree(ht->_table);
-    ht->_table = dummy->_table;
-    ht->logsize = dummy->logsize;
-    ht->realsize = dummy->realsize;
-    ht->mask = dummy->mask;
-    yfree(dummy);
+    ht->_old = ht->_table;
+    ht->_oldsize = ht->realsize;
+    ht->_oldlogsize = ht->logsize;
+    ht->_migrated = 0;
+
+    ht->_table = table;
+    ht->logsize = logsize;
+    ht->realsize = HSIZE(logsize);
+    ht->mask = HMASK(logsize);
+    ht->maxfilled = (int)(ht->realsize * HLOADFACTOR);
+    ht->filled = 0;
     return 1;
 }
 
 _htab *
 htcreate(int logsize)
 {
-    int i;
     _htab *ht;
 
     ht = (_htab *)ymalloc(sizeof(_htab));
     if (!ht)
         return NULL;
+    if (logsize < 1)
+        logsize = 1;
     ht->logsize = logsize;
     ht->realsize = HSIZE(logsize);
     ht->mask = HMASK(logsize);
+    ht->maxfilled = (int)(ht->realsize * HLOADFACTOR);
     ht->count = 0;
-    ht->freecount = 0;
-    ht->_table = (_hitem **)ymalloc(ht->realsize * sizeof(_hitem *));
+    ht->filled = 0;
+    ht->_old = NULL;
+    ht->_oldsize = 0;
+    ht->_oldlogsize = 0;
+    ht->_migrated = 0;
+    ht->_table = _htalloc(ht->realsize);
     if (!ht->_table) {
         yfree(ht);
         return NULL;
     }
 
-    for(i=0; i<ht->realsize; i++)
-        ht->_table[i] = NULL;
-
     return ht;
 }
 
@@ -81,18 +154,8 @@ htcreate(int logsize)
 void
 htdestroy(_htab *ht)
 {
-    int i;
-    _hitem *p, *next;
-
-    for(i=0; i<ht->realsize; i++) {
-        p = ht->_table[i];
-        while(p) {
-            next = p->next;
-            yfree(p);
-            p = next;
-        }
-    }
-
+    if (ht->_old)
+        yfree(ht->_old);
     yfree(ht->_table);
     yfree(ht);
 }
@@ -101,43 +164,55 @@ htdestroy(_htab *ht)
 int
 hadd(_htab *ht, uintptr_t key, uintptr_t val)
 {
-    unsigned int h;
-    _hitem *new, *p;
-
-    h = HHASH(ht, key);
-    p = ht->_table[h];
-    new = NULL;
-    while(p) {
-        if ((p->key == key) && (!p->free))
-            return 0;
-        if (p->free)
-            new = p;
-        p = p->next;
+    unsigned int i;
+    _hitem *p, *slot;
+
+    // look for the key and the first available slot at once
+    slot = NULL;
+    i = HHASH(key, ht->logsize);
+    while(1) {
+        p = &ht->_table[i];
+        if (p->state == HSLOT_EMPTY) {
+            if (!slot)
+                slot = p;
+            break;
+        }
+        if (p->state == HSLOT_USED) {
+            if (p->key == key)
+                return 0;
+        } else if (!slot) {
+            slot = p;
+        }
+        i = (i+1) & ht->mask;
     }
-    // have a free slot?
-    if (new) {
-        new->key = key;
-        new->val = val;
-        new->free = 0;
-        ht->freecount--;
-    } else {
-        new = (_hitem *)ymalloc(sizeof(_hitem));
-        if (!new)
+
+    if (ht->_old) {
+        p = _hlookup(ht->_old, ht->_oldlogsize, key);
+        if (p && (p - ht->_old) >= ht->_migrated)
             return 0;
-        new->key = key;
-        new->val = val;
-        new->next = ht->_table[h]; // add to front
-        new->free = 0;
-        ht->_table[h] = new;
+    } else if ((slot->state == HSLOT_DELETED) || (ht->filled+1 < ht->maxfilled)) {
+        // fast path: no migration in progress and no resize needed
+        if (slot->state == HSLOT_EMPTY)
+            ht->filled++;
+        slot->key = key;
+        slot->val = val;
+        slot->state = HSLOT_USED;
         ht->count++;
+        return 1;
     }
+
+    _hmigrate(ht, HMIGRATE_STEP);
+
     // need resizing?
-    if (((ht->count - ht->freecount) / (double)ht->realsize) >= HLOADFACTOR) {
+    if (ht->filled+1 >= ht->maxfilled) {
         ydprintf("hashtab resize.(%p)", ht);
         if (!_hgrow(ht)) {
             return 0;
         }
     }
+
+    _hinsert(ht, key, val);
+    ht->count++;
     return 1;
 }
 
@@ -145,15 +220,16 @@ _hitem *
 hfind(_htab *ht, uintptr_t key)
 {
     _hitem *p;
-    unsigned int h;
 
-    h = HHASH(ht, key);
-    p = ht->_table[h];
-    while(p) {
-        if ((p->key == key) && (!p->free)) {
+    p = _hlookup(ht->_table, ht->logsize, key);
+    if (p)
+        return p;
+
+    // slots of the old table that are already migrated are stale
+    if (ht->_old) {
+        p = _hlookup(ht->_old, ht->_oldlogsize, key);
+        if (p && (p - ht->_old) >= ht->_migrated)
             return p;
-        }
-        p = p->next;
     }
     return NULL;
 }
@@ -163,18 +239,25 @@ void
 henum(_htab *ht, int (*enumfn)(_hitem *item, void *arg), void *arg)
 {
     int rc, i;
-    _hitem *p, *next;
+    _hitem *p;
 
     for(i=0; i<ht->realsize; i++) {
-        p = ht->_table[i];
-        while(p) {
-            next = p->next;
-            if (!p->free) {
+        p = &ht->_table[i];
+        if (p->state == HSLOT_USED) {
+            rc = enumfn(p, arg); // item may be freed.
+            if(rc)
+                return;
+        }
+    }
+
+    if (ht->_old) {
+        for(i=ht->_migrated; i<ht->_oldsize; i++) {
+            p = &ht->_old[i];
+            if (p->state == HSLOT_USED) {
                 rc = enumfn(p, arg); // item may be freed.
                 if(rc)
                     return;
             }
-            p = next;
         }
     }
 }
@@ -182,14 +265,14 @@ henum(_htab *ht, int (*enumfn)(_hitem *item, void *arg), void *arg)
 int
 hcount(_htab *ht)
 {
-    return (ht->count - ht->freecount);
+    return ht->count;
 }
 
 void
 hfree(_htab *ht, _hitem *item)
 {
-    if (!item->free) {
-        item->free = 1;
-        ht->freecount++;
+    if (item->state == HSLOT_USED) {
+        item->state = HSLOT_DELETED;
+        ht->count--;
     }
 }
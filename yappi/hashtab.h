@@ -10,23 +10,38 @@
 
 #define HSIZE(n) (1<<n)
 #define HMASK(n) (HSIZE(n)-1)
-#define HLOADFACTOR 0.75
+#define HLOADFACTOR 0.5
+#define HMIGRATE_STEP 16 // slots moved to the new table per hadd() while growing
 
+// slot states
+#define HSLOT_EMPTY 0
+#define HSLOT_USED 1
+#define HSLOT_DELETED 2
+
+// items are stored inline in the table. An item returned by hfind() is only
+// valid until the next hadd() on the same table.
 struct _hitem {
     uintptr_t key;
     uintptr_t val;
-    int free; // for recycling.
-    struct _hitem *next;
+    int state;
 };
 typedef struct _hitem _hitem;
 
 typedef struct {
     int realsize;
     int logsize;
-    int count;
+    int count; // used slots
+    int filled; // used+deleted slots of _table
+    int maxfilled; // the table is resized when filled reaches this
     int mask;
-    int freecount;
-    _hitem ** _table;
+    _hitem *_table;
+
+    // the table being migrated to _table incrementally after a resize. Slots
+    // before _migrated are already moved.
+    _hitem *_old;
+    int _oldsize;
+    int _oldlogsize;
+    int _migrated;
 } _htab;
 
 _htab *htcreate(int logsize);
@@ -0,0 +1,82 @@
+/*
+*    Log-linear histogram of the call latencies
+*
+*    The bucket of a value is found from its most significant bit and the
+*    HIST_SUB_BITS bits following it, so recording a value is a few shifts
+*    and an increment.
+*/
+
+#include "histogram.h"
+#include "mem.h"
+
+static int
+_msb(unsigned long long v)
+{
+#if defined(__GNUC__)
+    return 63 - __builtin_clzll(v);
+#else
+    int r;
+
+    r = 0;
+    while (v >>= 1) {
+        r++;
+    }
+    return r;
+#endif
+}
+
+static int
+_histindex(long long value)
+{
+    int p;
+
+    if (value < HIST_SUB_BUCKETS) {
+        return value < 0 ? 0 : (int)value;
+    }
+
+    p = _msb((unsigned long long)value);
+    if (p >= HIST_MAX_BITS) {
+        return HIST_BUCKETS - 1;
+    }
+    return (p - HIST_SUB_BITS + 1) * HIST_SUB_BUCKETS +
+        (int)(value >> (p - HIST_SUB_BITS)) - HIST_SUB_BUCKETS;
+}
+
+_hist *
+histcreate(void)
+{
+    _hist *h;
+
+    h = (_hist *)ycalloc(sizeof(_hist));
+    return h;
+}
+
+void
+histdestroy(_hist *h)
+{
+    yfree(h);
+}
+
+void
+histadd(_hist *h, long long value)
+{
+    h->buckets[_histindex(value)]++;
+    if (value > h->max) {
+        h->max = value;
+    }
+}
+
+long long
+histhigh(int bucket)
+{
+    int p;
+    long long low;
+
+    if (bucket < HIST_SUB_BUCKETS) {
+        return bucket;
+    }
+
+    p = bucket / HIST_SUB_BUCKETS + HIST_SUB_BITS - 1;
+    low = (long long)(bucket % HIST_SUB_BUCKETS + HIST_SUB_BUCKETS) << (p - HIST_SUB_BITS);
+    return low + (1LL << (p - HIST_SUB_BITS)) - 1;
+}
@@ -0,0 +1,27 @@
+#ifndef YHISTOGRAM_H
+#define YHISTOGRAM_H
+
+#include "config.h"
+
+// A log-linear histogram, similar to HdrHistogram: the values below
+// HIST_SUB_BUCKETS are recorded exactly and every power of two range above
+// is split into HIST_SUB_BUCKETS buckets, so the relative error of a value
+// is at most 1/HIST_SUB_BUCKETS. Values of HIST_MAX_BITS bits or more are
+// recorded in the last bucket.
+#define HIST_SUB_BITS 4
+#define HIST_SUB_BUCKETS (1 << HIST_SUB_BITS)
+#define HIST_MAX_BITS 48
+#define HIST_BUCKETS ((HIST_MAX_BITS - HIST_SUB_BITS + 1) * HIST_SUB_BUCKETS)
+
+typedef struct {
+    long long max;
+    unsigned int buckets[HIST_BUCKETS];
+} _hist;
+
+_hist *histcreate(void);
+void histdestroy(_hist *h);
+void histadd(_hist *h, long long value);
+// the largest value recorded in the bucket
+long long histhigh(int bucket);
+
+#endif
@@ -2,6 +2,13 @@
 
 static size_t memused = 0;
 
+// the threads allocate in parallel in free-threaded builds
+#ifdef Py_GIL_DISABLED
+#define MEMUSED_ADD(n) _Py_atomic_add_ssize((Py_ssize_t *)&memused, (Py_ssize_t)(n))
+#else
+#define MEMUSED_ADD(n) (memused += (n))
+#endif
+
 #ifdef DEBUG_MEM
 
 static dnode_t *dhead;
@@ -38,20 +45,23 @@ ymemusage(void)
     return memused;
 }
 
-void *
-ymalloc(size_t size)
+static void *
+_yalloc(size_t size, int zeroed)
 {
     void *p;
 #ifdef DEBUG_MEM
     dnode_t *v;
 #endif
 
-    p = PyMem_Malloc(size+sizeof(size_t));
+    if (zeroed)
+        p = PyMem_Calloc(1, size+sizeof(size_t));
+    else
+        p = PyMem_Malloc(size+sizeof(size_t));
     if (!p) {
         yerr("malloc(%u) failed. No memory?", (unsigned int)size);
         return NULL;
     }
-    memused += size;
+    MEMUSED_ADD(size);
     *(size_t *)p = size;
 #ifdef DEBUG_MEM
     if (dhead)
@@ -68,6 +78,20 @@ ymalloc(size_t size)
     return (char *)p+sizeof(size_t);
 }
 
+void *
+ymalloc(size_t size)
+{
+    return _yalloc(size, 0);
+}
+
+// large zeroed blocks are usually mapped lazily by the OS, so the cost of
+// clearing them is not paid upfront.
+void *
+ycalloc(size_t size)
+{
+    return _yalloc(size, 1);
+}
+
 void
 yfree(void *p)
 {
@@ -76,7 +100,7 @@ yfree(void *p)
     dnode_t *prev;
 #endif
     p = (char *)p - sizeof(size_t);
-    memused -= *(size_t *)p;
+    MEMUSED_ADD(-(Py_ssize_t)*(size_t *)p);
 #ifdef DEBUG_MEM
     v = dhead;
     prev = NULL;
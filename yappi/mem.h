@@ -12,6 +12,7 @@ struct dnode {
 typedef struct dnode dnode_t;
 
 void *ymalloc(size_t size);
+void *ycalloc(size_t size);
 void yfree(void *p);
 size_t ymemusage(void);
 void YMEMLEAKCHECK(void);
@@ -1,19 +1,25 @@
 #include "timing.h"
 
-static clock_type_t g_clock_type = CPU_CLOCK;
+#if defined(TSC_AVAILABLE)
+#if defined(_MSC_VER)
+#include <intrin.h>
+#else
+#include <x86intrin.h>
+#include <cpuid.h>
+#endif
+#endif
 
-int set_timing_clock_type(clock_type_t type)
-{
-    // validate
-    if ((type != WALL_CLOCK) && (type != CPU_CLOCK))
-    {
-        return 0;
-    }
+#if defined(_WINDOWS) || defined(_MACH) || defined(CLOCK_MONOTONIC)
+#define MONOTONIC_AVAILABLE
+#endif
 
-    g_clock_type = type;
+#define TSC_CALIBRATION_TIME 0.02 // seconds
 
-    return 1;
-}
+static clock_type_t g_clock_type = CPU_CLOCK;
+
+#if defined(TSC_AVAILABLE)
+static double tsc_factor = 0; // seconds per TSC tick, set by _calibrate_tsc()
+#endif
 
 clock_type_t get_timing_clock_type(void)
 {
@@ -38,96 +44,307 @@ static long long gettimeofday_usec(void)
 
 #if defined(_WINDOWS)
 
-long long
-tickcount(void)
+static long long
+_thread_cputime(HANDLE thread)
 {
     LARGE_INTEGER li;
     FILETIME ftCreate, ftExit, ftKernel, ftUser;
 
-    if (g_clock_type == CPU_CLOCK) {
-        GetThreadTimes(GetCurrentThread(), &ftCreate, &ftExit, &ftKernel, &ftUser);
-        li.LowPart = ftKernel.dwLowDateTime+ftUser.dwLowDateTime;
-        li.HighPart = ftKernel.dwHighDateTime+ftUser.dwHighDateTime;
-    } else if (g_clock_type == WALL_CLOCK) {
-        QueryPerformanceCounter(&li);
+    if (!GetThreadTimes(thread, &ftCreate, &ftExit, &ftKernel, &ftUser)) {
+        return -1;
     }
+    li.LowPart = ftKernel.dwLowDateTime+ftUser.dwLowDateTime;
+    li.HighPart = ftKernel.dwHighDateTime+ftUser.dwHighDateTime;
     return li.QuadPart;
 }
 
-double
-tickfactor(void)
+// QueryPerformanceCounter() is monotonic, it is used for both wall clocks.
+static long long
+_monotonic_ticks(void)
 {
     LARGE_INTEGER li;
 
-    if (g_clock_type == WALL_CLOCK) {
-        if (QueryPerformanceFrequency(&li)) {
-            return 1.0 / li.QuadPart;
-        } else {
-            return 0.000001;
-        }
-    } else if (g_clock_type == CPU_CLOCK) {
-        return 0.0000001;
+    QueryPerformanceCounter(&li);
+    return li.QuadPart;
+}
+
+static double
+_monotonic_factor(void)
+{
+    LARGE_INTEGER li;
+
+    if (QueryPerformanceFrequency(&li)) {
+        return 1.0 / li.QuadPart;
     }
+    return 0.000001;
+}
 
-    return 0.0000001; // for suppressing warning: all paths must return a value
+long long
+cputickcount(void)
+{
+    return _thread_cputime(GetCurrentThread());
 }
 
-#elif defined(_MACH)
+double
+cputickfactor(void)
+{
+    return 0.0000001;
+}
 
 long long
 tickcount(void)
+{
+    switch (g_clock_type) {
+    case CPU_CLOCK:
+        return cputickcount();
+#if defined(TSC_AVAILABLE)
+    case TSC_CLOCK:
+        return (long long)__rdtsc();
+#endif
+    default:
+        return _monotonic_ticks();
+    }
+}
+
+long long
+threadtickcount(unsigned long thread_id)
+{
+    HANDLE thread;
+    long long rc;
+
+    if (IS_WALL_CLOCK(g_clock_type)) {
+        return tickcount();
+    }
+
+    thread = OpenThread(THREAD_QUERY_LIMITED_INFORMATION, FALSE, (DWORD)thread_id);
+    if (!thread) {
+        return -1;
+    }
+    rc = _thread_cputime(thread);
+    CloseHandle(thread);
+    return rc;
+}
+
+double
+tickfactor(void)
+{
+    switch (g_clock_type) {
+    case CPU_CLOCK:
+        return cputickfactor();
+#if defined(TSC_AVAILABLE)
+    case TSC_CLOCK:
+        return tsc_factor;
+#endif
+    default:
+        return _monotonic_factor();
+    }
+}
+
+const char *
+clockapi(void)
+{
+    switch (g_clock_type) {
+    case CPU_CLOCK:
+        return "getthreadtimes";
+    case TSC_CLOCK:
+        return "rdtsc";
+    default:
+        return "queryperformancecounter";
+    }
+}
+
+double
+clockresolution(void)
+{
+    return tickfactor();
+}
+
+#elif defined(_MACH)
+
+#include <mach/mach_time.h>
+
+static long long
+_thread_cputime(thread_act_t thread)
 {
     long long rc;
+    thread_basic_info_t tinfo_b;
+    thread_info_data_t tinfo_d;
+    mach_msg_type_number_t tinfo_cnt;
 
     rc = 0;
-    if (g_clock_type == CPU_CLOCK) {
-        thread_basic_info_t tinfo_b;
-        thread_info_data_t tinfo_d;
-        mach_msg_type_number_t tinfo_cnt;
-
-        tinfo_cnt = THREAD_INFO_MAX;
-        thread_info(mach_thread_self(), THREAD_BASIC_INFO, (thread_info_t)tinfo_d, &tinfo_cnt);
-        tinfo_b = (thread_basic_info_t)tinfo_d;
-
-        if (!(tinfo_b->flags & TH_FLAGS_IDLE))
-        {
-            rc = (tinfo_b->user_time.seconds + tinfo_b->system_time.seconds);
-            rc = (rc * 1000000) + (tinfo_b->user_time.microseconds + tinfo_b->system_time.microseconds);
-        }
-    } else if (g_clock_type == WALL_CLOCK) {
-        rc = gettimeofday_usec();
+    tinfo_cnt = THREAD_INFO_MAX;
+    thread_info(thread, THREAD_BASIC_INFO, (thread_info_t)tinfo_d, &tinfo_cnt);
+    tinfo_b = (thread_basic_info_t)tinfo_d;
+
+    if (!(tinfo_b->flags & TH_FLAGS_IDLE))
+    {
+        rc = (tinfo_b->user_time.seconds + tinfo_b->system_time.seconds);
+        rc = (rc * 1000000) + (tinfo_b->user_time.microseconds + tinfo_b->system_time.microseconds);
     }
     return rc;
 }
 
+static long long
+_monotonic_ticks(void)
+{
+    return (long long)mach_absolute_time();
+}
+
+static double
+_monotonic_factor(void)
+{
+    mach_timebase_info_data_t tb;
+
+    mach_timebase_info(&tb);
+    return (double)tb.numer / tb.denom * 0.000000001;
+}
+
+long long
+cputickcount(void)
+{
+    return _thread_cputime(mach_thread_self());
+}
+
+double
+cputickfactor(void)
+{
+    return 0.000001;
+}
+
+long long
+tickcount(void)
+{
+    switch (g_clock_type) {
+    case CPU_CLOCK:
+        return cputickcount();
+    case MONOTONIC_CLOCK:
+    case DUAL_CLOCK:
+        return _monotonic_ticks();
+#if defined(TSC_AVAILABLE)
+    case TSC_CLOCK:
+        return (long long)__rdtsc();
+#endif
+    default:
+        return gettimeofday_usec();
+    }
+}
+
+long long
+threadtickcount(unsigned long thread_id)
+{
+    if (g_clock_type == CPU_CLOCK) {
+        return _thread_cputime(pthread_mach_thread_np((pthread_t)thread_id));
+    }
+    return tickcount();
+}
+
 double
 tickfactor(void)
 {
-     return 0.000001;
+    switch (g_clock_type) {
+    case MONOTONIC_CLOCK:
+    case DUAL_CLOCK:
+        return _monotonic_factor();
+#if defined(TSC_AVAILABLE)
+    case TSC_CLOCK:
+        return tsc_factor;
+#endif
+    default:
+        return 0.000001;
+    }
+}
+
+const char *
+clockapi(void)
+{
+    switch (g_clock_type) {
+    case CPU_CLOCK:
+        return "threadinfo";
+    case MONOTONIC_CLOCK:
+    case DUAL_CLOCK:
+        return "machabsolutetime";
+    case TSC_CLOCK:
+        return "rdtsc";
+    default:
+        return "gettimeofday";
+    }
+}
+
+double
+clockresolution(void)
+{
+    return tickfactor();
 }
 
 #elif defined(_UNIX)
 
+#if defined(MONOTONIC_AVAILABLE)
+static long long
+_monotonic_ticks(void)
+{
+    struct timespec tp;
+    long long rc;
+
+    clock_gettime(CLOCK_MONOTONIC, &tp);
+    rc = tp.tv_sec;
+    rc = rc * 1000000000 + (tp.tv_nsec);
+    return rc;
+}
+
+static double
+_monotonic_factor(void)
+{
+    return 0.000000001;
+}
+#endif
+
 long long
-tickcount(void)
+cputickcount(void)
 {
     long long rc;
 
     rc = 0; // suppress "may be uninitialized" warning
-    if (g_clock_type == CPU_CLOCK) {
 #if defined(USE_CLOCK_TYPE_CLOCKGETTIME)
-        struct timespec tp;
+    struct timespec tp;
 
-        clock_gettime(CLOCK_THREAD_CPUTIME_ID, &tp);
-        rc = tp.tv_sec;
-        rc = rc * 1000000000 + (tp.tv_nsec);
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &tp);
+    rc = tp.tv_sec;
+    rc = rc * 1000000000 + (tp.tv_nsec);
 #elif (defined(USE_CLOCK_TYPE_RUSAGE) && defined(RUSAGE_WHO))
-        struct timeval tv;
-        struct rusage usage;
+    struct rusage usage;
 
-        getrusage(RUSAGE_WHO, &usage);
-        rc = (usage.ru_utime.tv_sec + usage.ru_stime.tv_sec);
-        rc = (rc * 1000000) + (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec);
+    getrusage(RUSAGE_WHO, &usage);
+    rc = (usage.ru_utime.tv_sec + usage.ru_stime.tv_sec);
+    rc = (rc * 1000000) + (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec);
+#endif
+    return rc;
+}
+
+double
+cputickfactor(void)
+{
+#if defined(USE_CLOCK_TYPE_CLOCKGETTIME)
+    return 0.000000001;
+#else
+    return 0.000001;
+#endif
+}
+
+long long
+tickcount(void)
+{
+    long long rc;
+
+    rc = 0; // suppress "may be uninitialized" warning
+    if (g_clock_type == CPU_CLOCK) {
+        rc = cputickcount();
+#if defined(MONOTONIC_AVAILABLE)
+    } else if (g_clock_type == MONOTONIC_CLOCK || g_clock_type == DUAL_CLOCK) {
+        rc = _monotonic_ticks();
+#endif
+#if defined(TSC_AVAILABLE)
+    } else if (g_clock_type == TSC_CLOCK) {
+        rc = (long long)__rdtsc();
 #endif
     } else if (g_clock_type == WALL_CLOCK) {
         rc = gettimeofday_usec();
@@ -135,14 +352,44 @@ tickcount(void)
     return rc;
 }
 
+long long
+threadtickcount(unsigned long thread_id)
+{
+    long long rc;
+
+    if (IS_WALL_CLOCK(g_clock_type)) {
+        return tickcount();
+    }
+
+#if defined(USE_CLOCK_TYPE_CLOCKGETTIME)
+    clockid_t cid;
+    struct timespec tp;
+
+    if (pthread_getcpuclockid((pthread_t)thread_id, &cid) != 0) {
+        return -1;
+    }
+    clock_gettime(cid, &tp);
+    rc = tp.tv_sec;
+    rc = rc * 1000000000 + (tp.tv_nsec);
+#else
+    // getrusage() can only query the calling thread
+    rc = -1;
+#endif
+    return rc;
+}
+
 double
 tickfactor(void)
 {
     if (g_clock_type == CPU_CLOCK) {
-#if defined(USE_CLOCK_TYPE_CLOCKGETTIME)
-            return 0.000000001;
-#elif defined(USE_CLOCK_TYPE_RUSAGE)
-            return 0.000001;
+        return cputickfactor();
+#if defined(MONOTONIC_AVAILABLE)
+    } else if (g_clock_type == MONOTONIC_CLOCK || g_clock_type == DUAL_CLOCK) {
+        return _monotonic_factor();
+#endif
+#if defined(TSC_AVAILABLE)
+    } else if (g_clock_type == TSC_CLOCK) {
+        return tsc_factor;
 #endif
     } else if (g_clock_type == WALL_CLOCK) {
         return 0.000001;
@@ -151,4 +398,132 @@ tickfactor(void)
     return 1.0; // suppress "reached end of non-void function" warning
 }
 
+const char *
+clockapi(void)
+{
+    switch (g_clock_type) {
+    case CPU_CLOCK:
+#if defined(USE_CLOCK_TYPE_CLOCKGETTIME)
+        return "clockgettime";
+#else
+        return "getrusage";
+#endif
+    case MONOTONIC_CLOCK:
+    case DUAL_CLOCK:
+        return "clockgettime";
+    case TSC_CLOCK:
+        return "rdtsc";
+    default:
+        return "gettimeofday";
+    }
+}
+
+double
+clockresolution(void)
+{
+#if defined(USE_CLOCK_TYPE_CLOCKGETTIME) || defined(MONOTONIC_AVAILABLE)
+    struct timespec tp;
+    clockid_t cid;
+
+    cid = (clockid_t)-1;
+#if defined(USE_CLOCK_TYPE_CLOCKGETTIME)
+    if (g_clock_type == CPU_CLOCK) {
+        cid = CLOCK_THREAD_CPUTIME_ID;
+    }
+#endif
+#if defined(MONOTONIC_AVAILABLE)
+    if (g_clock_type == MONOTONIC_CLOCK || g_clock_type == DUAL_CLOCK) {
+        cid = CLOCK_MONOTONIC;
+    }
+#endif
+    if (cid != (clockid_t)-1 && clock_getres(cid, &tp) == 0) {
+        return tp.tv_sec + tp.tv_nsec * 0.000000001;
+    }
+#endif
+    return tickfactor();
+}
+
 #endif /* *nix */
+
+#if defined(TSC_AVAILABLE)
+// the TSC ticks at a constant rate regardless of the frequency scaling and
+// the sleep states of the CPU only if it is invariant.
+static int
+_tsc_invariant(void)
+{
+#if defined(_MSC_VER)
+    int regs[4];
+
+    __cpuid(regs, 0x80000000);
+    if ((unsigned int)regs[0] < 0x80000007) {
+        return 0;
+    }
+    __cpuid(regs, 0x80000007);
+    return (regs[3] >> 8) & 1;
+#else
+    unsigned int eax, ebx, ecx, edx;
+
+    if (__get_cpuid_max(0x80000000, NULL) < 0x80000007 ||
+        !__get_cpuid(0x80000007, &eax, &ebx, &ecx, &edx)) {
+        return 0;
+    }
+    return (edx >> 8) & 1;
+#endif
+}
+
+// the frequency of the TSC is measured against the monotonic clock.
+static int
+_calibrate_tsc(void)
+{
+    long long t0, t1, c0, c1;
+    double factor;
+
+    if (!_tsc_invariant()) {
+        return 0;
+    }
+
+    factor = _monotonic_factor();
+    t0 = _monotonic_ticks();
+    c0 = (long long)__rdtsc();
+    do {
+        t1 = _monotonic_ticks();
+    } while ((t1 - t0) * factor < TSC_CALIBRATION_TIME);
+    c1 = (long long)__rdtsc();
+    if (c1 <= c0) {
+        return 0;
+    }
+
+    tsc_factor = (t1 - t0) * factor / (c1 - c0);
+    return 1;
+}
+#endif
+
+int set_timing_clock_type(clock_type_t type)
+{
+    switch (type) {
+    case WALL_CLOCK:
+    case CPU_CLOCK:
+        break;
+    case MONOTONIC_CLOCK:
+    case DUAL_CLOCK:
+#if !defined(MONOTONIC_AVAILABLE)
+        return 0;
+#endif
+        break;
+    case TSC_CLOCK:
+#if defined(TSC_AVAILABLE)
+        if (!tsc_factor && !_calibrate_tsc()) {
+            return 0;
+        }
+        break;
+#else
+        return 0;
+#endif
+    default:
+        return 0;
+    }
+
+    g_clock_type = type;
+
+    return 1;
+}
@@ -12,6 +12,7 @@
 
 #include <mach/mach.h>
 #include <mach/thread_info.h>
+#include <pthread.h>
 #include <sys/time.h>
 
 #define USE_CLOCK_TYPE_THREADINFO
@@ -20,6 +21,7 @@
 
 #include <time.h>
 #include <unistd.h>
+#include <pthread.h>
 #include <sys/time.h>
 #include <sys/resource.h>
 
@@ -44,14 +46,40 @@
 #endif
 #endif
 
+#if defined(__x86_64__) || defined(__i386__) || defined(_M_X64) || defined(_M_IX86)
+#define TSC_AVAILABLE
+#endif
+
 typedef enum
 {
     WALL_CLOCK = 0x00,
     CPU_CLOCK = 0x01,
+    MONOTONIC_CLOCK = 0x02, // a wall clock that never goes back, in ns
+    TSC_CLOCK = 0x03, // the invariant time stamp counter of x86 CPUs
+    DUAL_CLOCK = 0x04, // the monotonic clock along with cputickcount()
 }clock_type_t;
 
+#define CLOCK_TYPE_COUNT 5
+
+// the clock measures the elapsed real time, rather than the CPU time
+#define IS_WALL_CLOCK(type) ((type) != CPU_CLOCK)
+
+// the CPU time of the current thread is measured, by tickcount() or by
+// cputickcount() along with the wall time.
+#define HAS_CPU_CLOCK(type) ((type) == CPU_CLOCK || (type) == DUAL_CLOCK)
+
 long long tickcount(void);
+// tickcount() of another thread given its PyThreadState.thread_id, or -1 if
+// it cannot be queried.
+long long threadtickcount(unsigned long thread_id);
 double tickfactor(void);
+// the CPU time of the current thread regardless of the clock type
+long long cputickcount(void);
+double cputickfactor(void);
+// the OS API and the resolution (in seconds) of the current clock type
+const char *clockapi(void);
+double clockresolution(void);
+// returns 0 if the clock type is invalid or not available on this platform.
 int set_timing_clock_type(clock_type_t type);
 clock_type_t get_timing_clock_type(void);
 
@@ -0,0 +1,58 @@
+#include "tracebuf.h"
+#include "mem.h"
+
+_tracebuf *
+tbcreate(int size)
+{
+    _tracebuf *tb;
+
+    tb = (_tracebuf *)ymalloc(sizeof(_tracebuf));
+    if (!tb)
+        return NULL;
+    tb->events = (_traceevent *)ymalloc(size * sizeof(_traceevent));
+    if (!tb->events) {
+        yfree(tb);
+        return NULL;
+    }
+
+    tb->size = size;
+    tb->head = 0;
+    tb->count = 0;
+    return tb;
+}
+
+void
+tbdestroy(_tracebuf *tb)
+{
+    yfree(tb->events);
+    yfree(tb);
+}
+
+void
+tbadd(_tracebuf *tb, long long t, void *ckey, int what)
+{
+    _traceevent *ev;
+
+    ev = &tb->events[tb->head];
+    ev->t = t;
+    ev->ckey = ckey;
+    ev->what = what;
+
+    tb->head++;
+    if (tb->head == tb->size) {
+        tb->head = 0;
+    }
+    if (tb->count < tb->size) {
+        tb->count++;
+    }
+}
+
+_traceevent *
+tbget(_tracebuf *tb, int i)
+{
+    i += tb->head - tb->count;
+    if (i < 0) {
+        i += tb->size;
+    }
+    return &tb->events[i];
+}
@@ -0,0 +1,48 @@
+#ifndef YTRACEBUF_H
+#define YTRACEBUF_H
+
+#include "config.h"
+
+#define TRACE_CALL 0
+#define TRACE_RETURN 1
+
+typedef struct {
+    long long t;
+    void *ckey; // the _pit of the function
+    int what; // TRACE_CALL or TRACE_RETURN
+} _traceevent;
+
+// a fixed size ring buffer of the call events of a context. Once it is full,
+// the oldest event is overwritten by the next one.
+typedef struct {
+    int size;
+    int head; // the slot of the next event
+    int count; // events in the buffer, at most size
+    _traceevent *events;
+} _tracebuf;
+
+_tracebuf *tbcreate(int size);
+void tbdestroy(_tracebuf *tb);
+void tbadd(_tracebuf *tb, long long t, void *ckey, int what);
+// the i-th oldest event in the buffer, i < tb->count
+_traceevent *tbget(_tracebuf *tb, int i);
+
+// the number of events of a _streamchunk
+#define STREAM_CHUNK_SIZE 4096
+
+typedef struct {
+    long long t;
+    unsigned int index; // of the _pit
+    int what; // TRACE_CALL or TRACE_RETURN
+} _streamevent;
+
+// the call events of a context streamed to a trace file. A context fills its
+// own chunk and then queues it to be written by the trace writer thread.
+typedef struct _streamchunk {
+    uintptr_t ctx_id;
+    int count;
+    struct _streamchunk *next; // in the write queue
+    _streamevent events[STREAM_CHUNK_SIZE];
+} _streamchunk;
+
+#endif
@@ -5,11 +5,18 @@ import os
 import sys
 import _yappi
 import pickle
+import copyreg
 import threading
 import warnings
 import types
 import inspect
 import itertools
+import fnmatch
+import json
+import struct
+import gzip
+import array
+import mmap
 try:
     from thread import get_ident  # Python 2
 except ImportError:
@@ -25,7 +32,9 @@ class YappiError(Exception):
 __all__ = [
     'start', 'stop', 'get_func_stats', 'get_thread_stats', 'clear_stats',
     'is_running', 'get_clock_time', 'get_clock_type', 'set_clock_type',
-    'get_clock_info', 'get_mem_usage', 'set_context_backend'
+    'get_clock_info', 'get_clock_overhead', 'get_mem_usage',
+    'set_context_backend', 'get_trace', 'save_trace', 'load_trace',
+    'get_call_paths', 'save_call_paths', 'get_func_stats_arrays'
 ]
 
 LINESEP = os.linesep
@@ -40,7 +49,10 @@ YPICKLE_PROTOCOL = 2
 # will have this value only optionally because of unpickling problems of CodeObjects.
 _fn_descriptor_dict = {}
 
-COLUMNS_FUNCSTATS = ["name", "ncall", "ttot", "tsub", "tavg"]
+COLUMNS_FUNCSTATS = [
+    "name", "ncall", "ttot", "tsub", "tavg", "ttot_cpu", "tsub_cpu", "tsub_off",
+    "tmax", "p50", "p90", "p99"
+]
 SORT_TYPES_FUNCSTATS = {
     "name": 0,
     "callcount": 3,
@@ -50,7 +62,25 @@ SORT_TYPES_FUNCSTATS = {
     "ncall": 3,
     "ttot": 6,
     "tsub": 7,
-    "tavg": 14
+    "tavg": 14,
+    "ttot_cpu": 16,
+    "tsub_cpu": 17,
+    "tsub_off": 18,
+    "tmax": 20,
+    "p50": 21,
+    "p90": 22,
+    "p99": 23
+}
+# the sort types of get_func_stats(limit=...) that are selected in C, by their
+# YFuncStat index
+_C_TOP_SORT_TYPES = {
+    3: "ncall",
+    6: "ttot",
+    7: "tsub",
+    14: "tavg",
+    16: "ttot_cpu",
+    17: "tsub_cpu",
+    20: "tmax"
 }
 SORT_TYPES_CHILDFUNCSTATS = {
     "name": 10,
@@ -61,17 +91,64 @@ SORT_TYPES_CHILDFUNCSTATS = {
     "ncall": 1,
     "ttot": 3,
     "tsub": 4,
-    "tavg": 5
+    "tavg": 5,
+    "ttot_cpu": 11,
+    "tsub_cpu": 12,
+    "tsub_off": 13
 }
 
 SORT_ORDERS = {"ascending": 0, "asc": 0, "descending": 1, "desc": 1}
 DEFAULT_SORT_TYPE = "totaltime"
 DEFAULT_SORT_ORDER = "desc"
 
-CLOCK_TYPES = {"WALL": 0, "CPU": 1}
+CLOCK_TYPES = {"WALL": 0, "CPU": 1, "MONOTONIC": 2, "TSC": 3, "DUAL": 4}
+DUAL_CLOCK = "dual"
 NATIVE_THREAD = "NATIVE_THREAD"
 GREENLET = "GREENLET"
 BACKEND_TYPES = {NATIVE_THREAD: 0, GREENLET: 1}
+SETPROFILE = "SETPROFILE"
+MONITORING = "MONITORING"
+ENGINE_TYPES = {SETPROFILE: 0, MONITORING: 1}
+DETERMINISTIC = "DETERMINISTIC"
+SAMPLING = "SAMPLING"
+MODE_TYPES = (DETERMINISTIC, SAMPLING)
+SAMPLING_ENGINE = 2  # the engine of _yappi in sampling mode
+DEFAULT_SAMPLING_INTERVAL = 0.01
+TRACE_FILE_MAGIC = b"YTRC"
+TRACE_FILE_VERSION = 1
+TRACE_FLUSH_INTERVAL = 0.1
+# the records of a trace file, in native byte order: a chunk of events of a
+# context is a (kind, count, ctx_id) header followed by count (t, index, what)
+# events, the footer is a (kind, length) header followed by a JSON document.
+_TRACE_CHUNK = 1
+_TRACE_FOOTER = 2
+_TRACE_CHUNK_HEADER = struct.Struct("=IIQ")
+_TRACE_EVENT = struct.Struct("=dII")
+_TRACE_FOOTER_HEADER = struct.Struct("=II")
+YBIN_FILE_MAGIC = b"YBIN"
+YBIN_FILE_VERSION = 1
+# the header of a ybin file: magic, version, whether the columns are big
+# endian, the string ids of the clock type and of None (or _YBIN_NO_STRING)
+# and the function, edge, histogram bucket and string counts. It is followed
+# by the string offsets and data, then the FUNC_ARRAY_COLUMNS,
+# EDGE_ARRAY_COLUMNS and HIST_ARRAY_COLUMNS columns, every section aligned to
+# 8 bytes so that the columns can be used in place from a memory map.
+_YBIN_HEADER = struct.Struct("<4sIIIIQQQQ")
+_YBIN_NO_STRING = 0xFFFFFFFF
+# the columns returned by get_func_stats_arrays() with their array typecodes,
+# in the order they are filled by _yappi.
+FUNC_ARRAY_COLUMNS = (
+    ("index", "I"), ("name", "I"), ("module", "I"), ("lineno", "I"),
+    ("builtin", "B"), ("ctx_id", "Q"), ("tag", "Q"), ("ncall", "Q"),
+    ("nactualcall", "Q"), ("ttot", "d"), ("tsub", "d"), ("ttot_cpu", "d"),
+    ("tsub_cpu", "d"), ("tmax", "d"), ("ctx_name", "I")
+)
+EDGE_ARRAY_COLUMNS = (
+    ("parent", "I"), ("child", "I"), ("ncall", "Q"), ("nactualcall", "Q"),
+    ("ttot", "d"), ("tsub", "d"), ("ttot_cpu", "d"), ("tsub_cpu", "d")
+)
+# the non-empty histogram buckets of the functions, by function index
+HIST_ARRAY_COLUMNS = (("index", "I"), ("high", "d"), ("count", "I"))
 
 try:
     GREENLET_COUNTER = itertools.count(start=1).next
@@ -113,6 +190,101 @@ def _ctx_name_callback():
         return None
 
 
+def _sampled_thread_name(tid):
+    """
+    Returns the name of a thread sampled by the sampler thread.
+    """
+    thread = threading._active.get(tid)
+    if thread is None:
+        return None
+    return thread.__class__.__name__
+
+
+# (thread, stop event) of the running sampler thread in sampling mode
+_sampler = None
+
+
+def _start_sampler(interval):
+    global _sampler
+
+    stopped = threading.Event()
+
+    def _run():
+        while not stopped.wait(interval):
+            _yappi.sample(_sampled_thread_name)
+
+    thread = threading.Thread(target=_run, name="YappiSampler", daemon=True)
+    _sampler = (thread, stopped)
+    thread.start()
+
+
+def _stop_sampler():
+    global _sampler
+
+    if _sampler is None:
+        return
+    thread, stopped = _sampler
+    _sampler = None
+    stopped.set()
+    if thread is not threading.current_thread():
+        thread.join()
+
+
+# (thread, stop event, file) of the running trace writer thread
+_trace_writer = None
+
+
+def _start_trace_writer(path):
+    global _trace_writer
+
+    f = open(path, "wb")
+    f.write(TRACE_FILE_MAGIC + struct.pack("=I", TRACE_FILE_VERSION))
+    stopped = threading.Event()
+
+    def _run():
+        # the chunks are serialized by take_trace() holding the GIL, it is
+        # only released while the file is written
+        while not stopped.wait(TRACE_FLUSH_INTERVAL):
+            f.write(_yappi.take_trace())
+
+    thread = threading.Thread(target=_run, name="YappiTraceWriter", daemon=True)
+    _trace_writer = (thread, stopped, f)
+    thread.start()
+
+
+def _stop_trace_writer():
+    global _trace_writer
+
+    if _trace_writer is None:
+        return
+    thread, stopped, f = _trace_writer
+    _trace_writer = None
+    stopped.set()
+    if thread is not threading.current_thread():
+        thread.join()
+
+    functions = []
+
+    def _enumerator(stat_entry):
+        name, module, lineno, _, _, builtin, _, _, index, _, ctx_id, \
+            ctx_name, tag = stat_entry[:13]
+        functions.append(
+            (index, name, module, lineno, builtin, ctx_id, ctx_name, tag)
+        )
+
+    try:
+        f.write(_yappi.take_trace(True))
+        _yappi.enum_func_stats(_enumerator, {})
+        footer = json.dumps({
+            "clock_type": _yappi.get_clock_type(),
+            "functions": functions
+        }).encode()
+        f.write(_TRACE_FOOTER_HEADER.pack(_TRACE_FOOTER, len(footer)))
+        f.write(footer)
+    finally:
+        f.close()
+
+
 def _profile_thread_callback(frame, event, arg):
     """
     _profile_thread_callback will only be called once per-thread. _yappi will detect
@@ -164,6 +336,47 @@ def _fft(x, COL_SIZE=8):
     return s
 
 
+def _percentile(hist, tmax, q):
+    """
+    Returns the q-th percentile of the call latencies in a histogram of
+    {the largest latency in the bucket: count}.
+    """
+    total = sum(hist.values())
+    if not total:
+        return 0.0
+    rank = q * total / 100
+    seen = 0
+    for high in sorted(hist):
+        seen += hist[high]
+        if seen >= rank:
+            return min(high, tmax)
+    return tmax
+
+
+# a minimal protobuf encoder for the pprof format, see _save_as_PPROF().
+def _pb_varint(value):
+    if value < 0:  # int64 is encoded in two's complement
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _pb_int(field, value):
+    return _pb_varint(field << 3) + _pb_varint(value)
+
+
+def _pb_bytes(field, data):
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(data)) + data
+
+
+def _pb_packed(field, values):
+    return _pb_bytes(field, b"".join(_pb_varint(v) for v in values))
+
+
 def _func_fullname(builtin, module, lineno, name):
     if builtin:
         return f"{module}.{name}"
@@ -407,22 +620,68 @@ class StatString:
         return self._trim(length, self._RIGHT)
 
 
-class YStat(dict):
+class YStat:
     """
-    Class to hold a profile result line in a dict object, which all items can also be accessed as
-    instance attributes where their attribute name is the given key. Mimicked NamedTuples.
+    Class to hold a profile result line in slots, which all items can be accessed as
+    instance attributes where their attribute name is the given key or by their index
+    in _KEYS. Mimicked NamedTuples.
     """
+    __slots__ = ()
     _KEYS = {}
+    # the factories of the items that the stats saved by the older versions
+    # might not have
+    _DEFAULTS = {}
 
-    def __init__(self, values):
-        super().__init__()
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._NAMES = {i: name for name, i in cls._KEYS.items()}
 
+    def __init__(self, values):
         for key, i in self._KEYS.items():
             setattr(self, key, values[i])
 
-    def __setattr__(self, name, value):
-        self[self._KEYS[name]] = value
-        super().__setattr__(name, value)
+    def __getitem__(self, index):
+        return getattr(self, self._NAMES[index])
+
+    def __setitem__(self, index, value):
+        # the stats saved by other versions might have other items
+        if index in self._NAMES:
+            setattr(self, self._NAMES[index], value)
+
+    def __eq__(self, other):
+        if not isinstance(other, YStat):
+            return NotImplemented
+        return self._asdict() == other._asdict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__, ", ".join(
+                "%s=%r" % (name, getattr(self, name, None))
+                for name in self._KEYS
+            )
+        )
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self._KEYS}
+
+    def __reduce_ex__(self, protocol):
+        # pickled like the dict based stats of the older versions, so that the
+        # saved stats can be loaded by both
+        state = self._asdict()
+        return (
+            copyreg.__newobj__, (type(self), ), state, None,
+            iter([(self._KEYS[name], value) for name, value in state.items()])
+        )
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if name in self._KEYS:
+                setattr(self, name, value)
+        for name, default in self._DEFAULTS.items():
+            if name in self._KEYS and not hasattr(self, name):
+                setattr(self, name, default())
 
 
 class YFuncStat(YStat):
@@ -444,7 +703,26 @@ class YFuncStat(YStat):
         'ctx_name': 11,
         'tag': 12,
         'tavg': 14,
-        'full_name': 15
+        'full_name': 15,
+        'ttot_cpu': 16,
+        'tsub_cpu': 17,
+        'tsub_off': 18,
+        'hist': 19,
+        'tmax': 20,
+        'p50': 21,
+        'p90': 22,
+        'p99': 23
+    }
+    __slots__ = tuple(_KEYS)
+    _DEFAULTS = {
+        'ttot_cpu': float,
+        'tsub_cpu': float,
+        'tsub_off': float,
+        'hist': dict,
+        'tmax': float,
+        'p50': float,
+        'p90': float,
+        'p99': float
     }
 
     def __eq__(self, other):
@@ -466,6 +744,16 @@ class YFuncStat(YStat):
         self.ttot += other.ttot
         self.tsub += other.tsub
         self.tavg = self.ttot / self.ncall
+        self.ttot_cpu += other.ttot_cpu
+        self.tsub_cpu += other.tsub_cpu
+        self.tsub_off += other.tsub_off
+
+        hist = dict(self.hist)
+        for high, count in other.hist.items():
+            hist[high] = hist.get(high, 0) + count
+        self.hist = hist
+        self.tmax = max(self.tmax, other.tmax)
+        self._update_percentiles()
 
         for other_child_stat in other.children:
             # all children point to a valid entry, and we shall have merged previous entries by here.
@@ -475,6 +763,11 @@ class YFuncStat(YStat):
     def __hash__(self):
         return hash(self.full_name)
 
+    def _update_percentiles(self):
+        self.p50 = _percentile(self.hist, self.tmax, 50)
+        self.p90 = _percentile(self.hist, self.tmax, 90)
+        self.p99 = _percentile(self.hist, self.tmax, 99)
+
     def is_recursive(self):
         # we have a known bug where call_leave not called for some thread functions(run() especially)
         # in that case ncalls will be updated in call_enter, however nactualcall will not. This is for
@@ -513,6 +806,14 @@ class YFuncStat(YStat):
                 out.write(" " * COLUMN_GAP)
             elif title == "tavg":
                 out.write(StatString(_fft(self.tavg, size)).rtrim(size))
+                out.write(" " * COLUMN_GAP)
+            elif title in (
+                "ttot_cpu", "tsub_cpu", "tsub_off", "tmax", "p50", "p90", "p99"
+            ):
+                out.write(
+                    StatString(_fft(getattr(self, title), size)).rtrim(size)
+                )
+                out.write(" " * COLUMN_GAP)
         out.write(LINESEP)
 
 
@@ -531,8 +832,13 @@ class YChildFuncStat(YFuncStat):
         'full_name': 7,
         'module': 8,
         'lineno': 9,
-        'name': 10
+        'name': 10,
+        'ttot_cpu': 11,
+        'tsub_cpu': 12,
+        'tsub_off': 13
     }
+    # the keys are a subset of YFuncStat._KEYS
+    __slots__ = ()
 
     def __add__(self, other):
         if other is None:
@@ -542,6 +848,9 @@ class YChildFuncStat(YFuncStat):
         self.ttot += other.ttot
         self.tsub += other.tsub
         self.tavg = self.ttot / self.ncall
+        self.ttot_cpu += other.ttot_cpu
+        self.tsub_cpu += other.tsub_cpu
+        self.tsub_off += other.tsub_off
         return self
 
 
@@ -556,6 +865,7 @@ class YThreadStat(YStat):
         'ttot': 3,
         'sched_count': 4,
     }
+    __slots__ = tuple(_KEYS)
 
     def __eq__(self, other):
         if other is None:
@@ -598,6 +908,7 @@ class YGreenletStat(YStat):
         'ttot': 3,
         'sched_count': 4,
     }
+    __slots__ = tuple(_KEYS)
 
     def __eq__(self, other):
         if other is None:
@@ -627,6 +938,42 @@ class YGreenletStat(YStat):
         out.write(LINESEP)
 
 
+class YTraceEvent(YStat):
+    """
+    Class holding a call event recorded in the trace buffer of a context.
+    """
+    _KEYS = {
+        'ctx_id': 0,
+        'timestamp': 1,
+        'event': 2,
+        'name': 3,
+        'module': 4,
+        'lineno': 5,
+        'builtin': 6,
+        'full_name': 7,
+    }
+    __slots__ = tuple(_KEYS)
+
+
+class YCallPath(YStat):
+    """
+    Class holding the stats of a function called through a specific call path.
+    """
+    _KEYS = {
+        'ctx_id': 0,
+        'path': 1,
+        'name': 2,
+        'module': 3,
+        'lineno': 4,
+        'builtin': 5,
+        'ncall': 6,
+        'ttot': 7,
+        'tsub': 8,
+        'full_name': 9,
+    }
+    __slots__ = tuple(_KEYS)
+
+
 class YStats:
     """
     Main Stats class where we collect the information from _yappi and apply the user filters.
@@ -792,8 +1139,24 @@ class YFuncStats(YStatsIndexable):
     _idx_max = 0
     _sort_type = None
     _sort_order = None
-    _SUPPORTED_LOAD_FORMATS = ['YSTAT']
-    _SUPPORTED_SAVE_FORMATS = ['YSTAT', 'CALLGRIND', 'PSTAT']
+    _SUPPORTED_LOAD_FORMATS = ['YSTAT', 'YBIN']
+    _SUPPORTED_SAVE_FORMATS = ['YSTAT', 'CALLGRIND', 'PSTAT', 'PPROF', 'YBIN']
+    _DEFAULT_PRINT_COLUMNS = {
+        0: ("name", 36),
+        1: ("ncall", 5),
+        2: ("tsub", 8),
+        3: ("ttot", 8),
+        4: ("tavg", 8)
+    }
+    _DUAL_PRINT_COLUMNS = {
+        0: ("name", 36),
+        1: ("ncall", 5),
+        2: ("tsub", 8),
+        3: ("ttot", 8),
+        4: ("tsub_cpu", 8),
+        5: ("ttot_cpu", 8),
+        6: ("tsub_off", 8)
+    }
 
     def __init__(self, files=[]):
         super().__init__()
@@ -807,54 +1170,123 @@ class YFuncStats(YStatsIndexable):
             stat.children.strip_dirs()
         return self
 
-    def get(self, filter={}, filter_callback=None):
+    def get(
+        self,
+        filter={},
+        filter_callback=None,
+        sort_type=None,
+        sort_order=DEFAULT_SORT_ORDER,
+        limit=None
+    ):
+        if sort_type is not None:
+            sort_type = _validate_sorttype(sort_type, SORT_TYPES_FUNCSTATS)
+        sort_order = _validate_sortorder(sort_order)
+
+        # the top functions are selected in C if possible, so only they and
+        # their children are created here.
+        c_sort_type = _C_TOP_SORT_TYPES.get(
+            SORT_TYPES_FUNCSTATS[sort_type or DEFAULT_SORT_TYPE]
+        )
+        top = None
+
         _yappi._pause()
         self.clear()
         try:
             self._filter_callback = filter_callback
-            _yappi.enum_func_stats(self._enumerator, filter)
-            self._filter_callback = None
-
-            # convert the children info from tuple to YChildFuncStat
-            for stat in self:
-                _childs = YChildFuncStats()
-                for child_tpl in stat.children:
-                    rstat = self[child_tpl[0]]
-
-                    # sometimes even the profile results does not contain the result because of filtering
-                    # or timing(call_leave called but call_enter is not), with this we ensure that the children
-                    # index always point to a valid stat.
-                    if rstat is None:
-                        continue
-
-                    tavg = rstat.ttot / rstat.ncall
-                    cfstat = YChildFuncStat(
-                        child_tpl + (
-                            tavg,
-                            rstat.builtin,
-                            rstat.full_name,
-                            rstat.module,
-                            rstat.lineno,
-                            rstat.name,
-                        )
+            self._clock_type = _yappi.get_clock_type()
+            if limit is not None and c_sort_type and not filter_callback:
+                top = set(
+                    _yappi.enum_top_func_stats(
+                        self._enumerator, filter, c_sort_type,
+                        SORT_ORDERS[sort_order] == SORT_ORDERS["asc"], limit
                     )
-                    _childs.append(cfstat)
-                stat.children = _childs
-            result = super().get()
+                )
+            else:
+                _yappi.enum_func_stats(self._enumerator, filter)
+            self._filter_callback = None
+            self._convert_children()
+            if top is not None:
+                self._keep(top)
+            if sort_type is None:
+                result = super().get()
+            else:
+                result = self.sort(sort_type, sort_order)
+            while limit is not None and len(self) > max(limit, 0):
+                self.pop()
         finally:
             _yappi._resume()
         return result
 
+    def _keep(self, indexes):
+        """
+        Removes the stats whose index is not in indexes.
+        """
+        stats = [stat for stat in self if stat.index in indexes]
+        self.clear()
+        for stat in stats:
+            self.append(stat)
+
+    def _convert_children(self):
+        """
+        Converts the children info of the stats from tuple to YChildFuncStat.
+        """
+        for stat in self:
+            _childs = YChildFuncStats()
+            for child_tpl in stat.children:
+                rstat = self[child_tpl[0]]
+
+                # sometimes even the profile results does not contain the result because of filtering
+                # or timing(call_leave called but call_enter is not), with this we ensure that the children
+                # index always point to a valid stat.
+                if rstat is None:
+                    continue
+
+                tavg = rstat.ttot / rstat.ncall
+                cfstat = YChildFuncStat(
+                    child_tpl[:5] + (
+                        tavg,
+                        rstat.builtin,
+                        rstat.full_name,
+                        rstat.module,
+                        rstat.lineno,
+                        rstat.name,
+                    ) + child_tpl[5:] + (
+                        self._off_cpu(child_tpl[4], child_tpl[6]),
+                    )
+                )
+                _childs.append(cfstat)
+            stat.children = _childs
+
+    def _off_cpu(self, tsub, tsub_cpu):
+        """
+        Returns the time a function spent off-CPU, e.g. waiting for I/O or a
+        lock. It is only known with the dual clock.
+        """
+        if self._clock_type != DUAL_CLOCK:
+            return 0.0
+        return max(tsub - tsub_cpu, 0.0)
+
     def _enumerator(self, stat_entry):
         global _fn_descriptor_dict
         fname, fmodule, flineno, fncall, fnactualcall, fbuiltin, fttot, ftsub, \
-            findex, fchildren, fctxid, fctxname, ftag, ffn_descriptor = stat_entry
+            findex, fchildren, fctxid, fctxname, ftag, ffn_descriptor, \
+            fttot_cpu, ftsub_cpu, fhist, ftmax = stat_entry
 
         # builtin function?
         ffull_name = _func_fullname(bool(fbuiltin), fmodule, flineno, fname)
         ftavg = fttot / fncall
-        fstat = YFuncStat(stat_entry + (ftavg, ffull_name))
-        _fn_descriptor_dict[ffull_name] = ffn_descriptor
+        fhist = dict(fhist)
+        fstat = YFuncStat(
+            stat_entry[:14] + (
+                ftavg, ffull_name, fttot_cpu, ftsub_cpu,
+                self._off_cpu(ftsub, ftsub_cpu), fhist, ftmax,
+                _percentile(fhist, ftmax, 50), _percentile(fhist, ftmax, 90),
+                _percentile(fhist, ftmax, 99)
+            )
+        )
+        # the stats replayed from a trace file have no descriptors
+        if ffn_descriptor is not None:
+            _fn_descriptor_dict[ffull_name] = ffn_descriptor
 
         # do not show profile stats of yappi itself.
         if os.path.basename(
@@ -882,7 +1314,19 @@ class YFuncStats(YStatsIndexable):
             raise YappiError(
                 f"Unable to load the saved profile information from {file.name}."
             )
+        self._merge(saved_stats, saved_clock_type)
+
+    def _add_from_YBIN(self, file):
+        saved_clock_type, *snapshot = _load_ybin(file)
+        saved_stats = YFuncStatsView()
+        saved_stats._clock_type = saved_clock_type
+        saved_stats._load(*snapshot)
+        self._merge(list(saved_stats), saved_clock_type)
 
+    def _merge(self, saved_stats, saved_clock_type):
+        """
+        Merges the stats loaded from a file.
+        """
         # check if we really have some stats to be merged?
         if not self.empty():
             if self._clock_type != saved_clock_type and self._clock_type is not None:
@@ -915,6 +1359,48 @@ class YFuncStats(YStatsIndexable):
         with open(path, "wb") as f:
             pickle.dump((self, self._clock_type), f, YPICKLE_PROTOCOL)
 
+    def _save_as_YBIN(self, path):
+        _save_ybin(path, self._clock_type, *self._columns())
+
+    def _columns(self):
+        """
+        Returns the stats as (functions, edges, strings, hists) columns like
+        _yappi.get_func_stats_arrays(), a row per YFuncStat.
+        """
+        functions = [array.array(tc) for _, tc in FUNC_ARRAY_COLUMNS]
+        edges = [array.array(tc) for _, tc in EDGE_ARRAY_COLUMNS]
+        hists = [array.array(tc) for _, tc in HIST_ARRAY_COLUMNS]
+        string_ids = {}
+
+        def _id(s):
+            return string_ids.setdefault(s, len(string_ids))
+
+        for stat in self:
+            values = (
+                stat.index, _id(stat.name), _id(stat.module), stat.lineno,
+                stat.builtin, stat.ctx_id, stat.tag, stat.ncall,
+                stat.nactualcall, stat.ttot, stat.tsub, stat.ttot_cpu,
+                stat.tsub_cpu, stat.tmax, _id(stat.ctx_name)
+            )
+            for column, value in zip(functions, values):
+                column.append(value)
+            for child in stat.children:
+                # the index of a child might be of a merged row
+                child_stat = self[child.full_name]
+                if child_stat is None:
+                    continue
+                values = (
+                    stat.index, child_stat.index, child.ncall,
+                    child.nactualcall, child.ttot, child.tsub, child.ttot_cpu,
+                    child.tsub_cpu
+                )
+                for column, value in zip(edges, values):
+                    column.append(value)
+            for high, count in stat.hist.items():
+                for column, value in zip(hists, (stat.index, high, count)):
+                    column.append(value)
+        return functions, edges, list(string_ids), hists
+
     def _save_as_PSTAT(self, path):
         """
         Save the profiling information as PSTAT.
@@ -930,6 +1416,11 @@ class YFuncStats(YStatsIndexable):
         header = """version: 1\ncreator: %s\npid: %d\ncmd:  %s\npart: 1\n\nevents: Ticks""" % \
             ('yappi', os.getpid(), ' '.join(sys.argv))
 
+        # the CPU time is a second event with the dual clock
+        dual = self._clock_type == DUAL_CLOCK
+        if dual:
+            header += " CpuTicks"
+
         lines = [header]
 
         # add function definitions
@@ -968,23 +1459,104 @@ class YFuncStats(YStatsIndexable):
                 'fl=(%d)' % func_stat.index,
                 'fn=(%d)' % func_stat.index
             ]
-            func_stats += [
-                f'{func_stat.lineno} {int(func_stat.tsub * 1e6)}'
-            ]
+            cost = f'{func_stat.lineno} {int(func_stat.tsub * 1e6)}'
+            if dual:
+                cost += f' {int(func_stat.tsub_cpu * 1e6)}'
+            func_stats += [cost]
 
             # children functions stats
             for child in func_stat.children:
+                cost = '0 %d' % int(child.ttot * 1e6)
+                if dual:
+                    cost += ' %d' % int(child.ttot_cpu * 1e6)
                 func_stats += [
                     'cfl=(%d)' % child.index,
                     'cfn=(%d)' % child.index,
                     'calls=%d 0' % child.ncall,
-                    '0 %d' % int(child.ttot * 1e6)
+                    cost
                 ]
             lines += func_stats
 
         with open(path, "w") as f:
             f.write('\n'.join(lines))
 
+    def _save_as_PPROF(self, path):
+        """
+        Writes the function stats as a gzip compressed profile.proto of pprof.
+        A caller -> callee pair is a sample of two locations with the time
+        the callee spent in itself when called from the caller, the rest of
+        the time of a function is a sample of its own location.
+        """
+        strings = {"": 0}
+
+        def _str(s):
+            return strings.setdefault(s, len(strings))
+
+        # the CPU time is a third value with the dual clock
+        dual = self._clock_type == DUAL_CLOCK
+        clock = "cpu" if self._clock_type == "cpu" else "wall"
+        sample_types = [("calls", "count"), (clock, "nanoseconds")]
+        if dual:
+            sample_types.append(("cpu", "nanoseconds"))
+
+        def _sample(locations, ncall, tsub, tsub_cpu):
+            values = [ncall, round(tsub * 1e9)]
+            if dual:
+                values.append(round(tsub_cpu * 1e9))
+            if not any(values):
+                return b""
+            return _pb_bytes(
+                2, _pb_packed(1, locations) + _pb_packed(2, values)
+            )
+
+        profile = bytearray()
+        for type, unit in sample_types:
+            profile += _pb_bytes(1, _pb_int(1, _str(type)) + _pb_int(2, _str(unit)))
+
+        # location and function ids must be non-zero
+        called = {}  # index: [ncall, tsub, tsub_cpu] of the calls from the stats
+        for func_stat in self:
+            for child in func_stat.children:
+                # the index of a child might be of a merged row
+                child_stat = self[child.full_name]
+                if child_stat is None:
+                    continue
+                profile += _sample(
+                    [child_stat.index + 1, func_stat.index + 1], child.ncall,
+                    child.tsub, child.tsub_cpu
+                )
+                totals = called.setdefault(child_stat.index, [0, 0.0, 0.0])
+                totals[0] += child.ncall
+                totals[1] += child.tsub
+                totals[2] += child.tsub_cpu
+
+        for func_stat in self:
+            ncall, tsub, tsub_cpu = called.get(func_stat.index, (0, 0.0, 0.0))
+            profile += _sample(
+                [func_stat.index + 1], max(func_stat.ncall - ncall, 0),
+                max(func_stat.tsub - tsub, 0.0),
+                max(func_stat.tsub_cpu - tsub_cpu, 0.0)
+            )
+
+        for func_stat in self:
+            id = func_stat.index + 1
+            line = _pb_int(1, id) + _pb_int(2, func_stat.lineno)
+            profile += _pb_bytes(4, _pb_int(1, id) + _pb_bytes(4, line))
+            profile += _pb_bytes(
+                5,
+                _pb_int(1, id) + _pb_int(2, _str(func_stat.name)) +
+                _pb_int(3, _str(func_stat.full_name)) +
+                _pb_int(4, _str(func_stat.module)) +
+                _pb_int(5, func_stat.lineno)
+            )
+
+        profile += _pb_int(14, _str(clock))
+        for s in strings:
+            profile += _pb_bytes(6, s.encode("utf-8"))
+
+        with gzip.open(path, "wb") as f:
+            f.write(profile)
+
     def add(self, files, type="ystat"):
         type = type.upper()
         if type not in self._SUPPORTED_LOAD_FORMATS:
@@ -1012,24 +1584,19 @@ class YFuncStats(YStatsIndexable):
         save_func = getattr(self, f"_save_as_{type}")
         save_func(path=path)
 
-    def print_all(
-        self,
-        out=sys.stdout,
-        columns={
-            0: ("name", 36),
-            1: ("ncall", 5),
-            2: ("tsub", 8),
-            3: ("ttot", 8),
-            4: ("tavg", 8)
-        },
-        limit=None
-    ):
+    def print_all(self, out=sys.stdout, columns=None, limit=None):
         """
         Prints all of the function profiler results to a given file. (stdout by default)
         """
         if self.empty():
             return
 
+        if columns is None:
+            if self._clock_type == DUAL_CLOCK:
+                columns = self._DUAL_PRINT_COLUMNS
+            else:
+                columns = self._DEFAULT_PRINT_COLUMNS
+
         for _, col in columns.items():
             _validate_columns(col[0], COLUMNS_FUNCSTATS)
 
@@ -1041,9 +1608,7 @@ class YFuncStats(YStatsIndexable):
         out.write(LINESEP)
 
         self._print_header(out, columns)
-        for i, stat in enumerate(self):
-            if limit is not None and i >= limit:
-                break
+        for stat in itertools.islice(self, limit):
             stat._print(out, columns)
 
     def sort(self, sort_type, sort_order="desc"):
@@ -1098,6 +1663,510 @@ class YFuncStats(YStatsIndexable):
             console.write(LINESEP)
 
 
+class YFuncStatsView(YFuncStats):
+    """
+    YFuncStats backed by a snapshot of the stat columns of _yappi (see
+    get_func_stats_arrays()) instead of a YFuncStat per function. The YFuncStat
+    of a function and its children are only created when it is accessed, so
+    printing or looking up a few functions of a large profile is cheap.
+    sort() and pop() work on the snapshot, any other change creates all the
+    YFuncStat objects first.
+    """
+
+    def __init__(self):
+        # the columns of the snapshot, None once the stats are materialized
+        self._funcs = None
+        super().__init__()
+
+    def get(
+        self,
+        filter={},
+        sort_type=None,
+        sort_order=DEFAULT_SORT_ORDER,
+        limit=None
+    ):
+        _yappi._pause()
+        self.clear()
+        try:
+            self._clock_type = _yappi.get_clock_type()
+            self._load(*_yappi.get_func_stats_arrays(filter))
+        finally:
+            _yappi._resume()
+
+        self.sort(sort_type or DEFAULT_SORT_TYPE, sort_order)
+        if limit is not None:
+            self._removed.update(self._order[max(limit, 0):])
+            del self._order[max(limit, 0):]
+        return self
+
+    def _load(self, functions, edges, strings, hists):
+        """
+        Loads a snapshot returned by _yappi.get_func_stats_arrays(). The
+        columns might be any buffer, e.g. a slice of a memory mapped file.
+        """
+        self._funcs = _column_views(functions, FUNC_ARRAY_COLUMNS)
+        self._edges = _column_views(edges, EDGE_ARRAY_COLUMNS)
+        self._hists = _column_views(hists, HIST_ARRAY_COLUMNS)
+        self._strings = strings
+
+        # the rows of the same full_name are merged like in YStats.append(),
+        # the functions of yappi itself are not shown.
+        excluded = {
+            i
+            for i, s in enumerate(strings)
+            if isinstance(s, str) and _is_yappi_module(s)
+        }
+        groups = {}
+        f = self._funcs
+        for row, (name, module, lineno, builtin) in enumerate(
+            zip(f["name"], f["module"], f["lineno"], f["builtin"])
+        ):
+            if module in excluded:
+                continue
+            key = (name, module, -1 if builtin else lineno)
+            rows = groups.get(key)
+            if rows is None:
+                groups[key] = rows = []
+            rows.append(row)
+
+        self._groups = list(groups.values())
+        self._order = list(range(len(self._groups)))
+        self._row_of = {
+            f["index"][row]: row for rows in self._groups for row in rows
+        }
+        self._group_of = {
+            f["index"][row]: group
+            for group, rows in enumerate(self._groups) for row in rows
+        }
+        self._idx_max = max(self._group_of, default=0)
+        self._removed = set()
+        self._rows = {}
+        self._summaries = {}
+        self._full_names = None
+        self._edge_rows = None
+        self._hist_rows = None
+
+    def _materialize(self):
+        """
+        Creates the YFuncStat of every function, after which this behaves
+        exactly like YFuncStats.
+        """
+        if self._funcs is None:
+            return
+
+        stats = [self._row(group) for group in self._order]
+        self._funcs = None
+        self._edges = self._hists = self._strings = None
+        self._groups = self._order = self._rows = None
+        self._row_of = self._group_of = None
+        for stat in stats:
+            super().append(stat)
+
+    def _sum(self, column, group):
+        col = self._funcs[column]
+        return sum(col[row] for row in self._groups[group])
+
+    def _summary(self, group):
+        """
+        Returns (ncall, ttot, builtin, full_name, module, lineno, name) of the
+        function without creating its YFuncStat.
+        """
+        summary = self._summaries.get(group)
+        if summary is None:
+            f = self._funcs
+            row = self._groups[group][0]
+            builtin = bool(f["builtin"][row])
+            module = self._strings[f["module"][row]]
+            lineno = f["lineno"][row]
+            name = self._strings[f["name"][row]]
+            summary = self._summaries[group] = (
+                self._sum("ncall", group), self._sum("ttot", group), builtin,
+                _func_fullname(builtin, module, lineno, name), module,
+                lineno, name
+            )
+        return summary
+
+    def _row(self, group):
+        stat = self._rows.get(group)
+        if stat is None:
+            for row in self._groups[group]:
+                if stat is None:
+                    stat = self._func_stat(row)
+                else:
+                    stat += self._func_stat(row)
+            stat.children = self._child_stats(group)
+            self._rows[group] = stat
+        return stat
+
+    def _func_stat(self, row):
+        f = self._funcs
+        ncall, ttot, tsub = f["ncall"][row], f["ttot"][row], f["tsub"][row]
+        tsub_cpu, tmax = f["tsub_cpu"][row], f["tmax"][row]
+        hist = self._hist(f["index"][row])
+        return YFuncStat((
+            self._strings[f["name"][row]],
+            self._strings[f["module"][row]],
+            f["lineno"][row],
+            ncall,
+            f["nactualcall"][row],
+            bool(f["builtin"][row]),
+            ttot,
+            tsub,
+            f["index"][row],
+            [],
+            f["ctx_id"][row],
+            self._strings[f["ctx_name"][row]],
+            f["tag"][row],
+            None,
+            ttot / ncall if ncall else 0.0,
+            _func_fullname(
+                f["builtin"][row], self._strings[f["module"][row]],
+                f["lineno"][row], self._strings[f["name"][row]]
+            ),
+            f["ttot_cpu"][row],
+            tsub_cpu,
+            self._off_cpu(tsub, tsub_cpu),
+            hist,
+            tmax,
+            _percentile(hist, tmax, 50),
+            _percentile(hist, tmax, 90),
+            _percentile(hist, tmax, 99),
+        ))
+
+    def _hist(self, index):
+        if self._hist_rows is None:
+            self._hist_rows = {}
+            for i, hist_index in enumerate(self._hists["index"]):
+                self._hist_rows.setdefault(hist_index, []).append(i)
+        return {
+            self._hists["high"][i]: self._hists["count"][i]
+            for i in self._hist_rows.get(index, ())
+        }
+
+    def _child_stats(self, group):
+        if self._edge_rows is None:
+            self._edge_rows = {}
+            for i, parent in enumerate(self._edges["parent"]):
+                self._edge_rows.setdefault(parent, []).append(i)
+
+        e = self._edges
+        children = YChildFuncStats()
+        for row in self._groups[group]:
+            for i in self._edge_rows.get(self._funcs["index"][row], ()):
+                # the edges might point to a function filtered out
+                child = self._group_of.get(e["child"][i])
+                if child is None:
+                    continue
+
+                ncall, ttot, builtin, full_name, module, lineno, name = \
+                    self._summary(child)
+                # like YFuncStats, tavg is of the merged function only for
+                # its first row
+                child_row = self._row_of[e["child"][i]]
+                if child_row != self._groups[child][0]:
+                    ncall = self._funcs["ncall"][child_row]
+                    ttot = self._funcs["ttot"][child_row]
+                children.append(
+                    YChildFuncStat((
+                        e["child"][i], e["ncall"][i], e["nactualcall"][i],
+                        e["ttot"][i], e["tsub"][i], ttot / ncall if ncall else
+                        0.0, builtin, full_name, module, lineno, name,
+                        e["ttot_cpu"][i], e["tsub_cpu"][i],
+                        self._off_cpu(e["tsub"][i], e["tsub_cpu"][i])
+                    ))
+                )
+        return children
+
+    def _sort_values(self, index):
+        """
+        Returns the value of the YFuncStat index of every function or None if
+        it needs the YFuncStat objects.
+        """
+        groups = range(len(self._groups))
+        if index == 0:
+            return [self._summary(group)[6].lower() for group in groups]
+        if index == 14:
+            return [
+                summary[1] / summary[0] if summary[0] else 0.0
+                for summary in map(self._summary, groups)
+            ]
+        if index == 18:
+            f = self._funcs
+            return [
+                sum(
+                    self._off_cpu(f["tsub"][row], f["tsub_cpu"][row])
+                    for row in rows
+                ) for rows in self._groups
+            ]
+        if index == 20:
+            col = self._funcs["tmax"]
+            return [max(col[row] for row in rows) for rows in self._groups]
+
+        columns = {3: "ncall", 6: "ttot", 7: "tsub", 16: "ttot_cpu", 17: "tsub_cpu"}
+        if index in columns:
+            return [self._sum(columns[index], group) for group in groups]
+        return None
+
+    def sort(self, sort_type, sort_order="desc"):
+        if self._funcs is None:
+            return super().sort(sort_type, sort_order)
+
+        sort_type = _validate_sorttype(sort_type, SORT_TYPES_FUNCSTATS)
+        sort_order = _validate_sortorder(sort_order)
+        values = self._sort_values(SORT_TYPES_FUNCSTATS[sort_type])
+        if values is None:
+            self._materialize()
+            return super().sort(sort_type, sort_order)
+
+        self._sort_type = sort_type
+        self._sort_order = sort_order
+        self._order.sort(
+            key=values.__getitem__,
+            reverse=(SORT_ORDERS[sort_order] == SORT_ORDERS["desc"])
+        )
+        return self
+
+    def clear(self):
+        super().clear()
+        self._funcs = None
+
+    def empty(self):
+        return len(self) == 0
+
+    def __iter__(self):
+        if self._funcs is None:
+            return super().__iter__()
+        return (self._row(group) for group in list(self._order))
+
+    def __len__(self):
+        if self._funcs is None:
+            return super().__len__()
+        return len(self._order)
+
+    def __getitem__(self, key):
+        if self._funcs is None:
+            return super().__getitem__(key)
+
+        if isinstance(key, (YFuncStat, YChildFuncStat)):
+            key = key.index
+        if isinstance(key, int):
+            group = self._group_of.get(key)
+        elif isinstance(key, str):
+            if self._full_names is None:
+                self._full_names = {}
+                for group in range(len(self._groups)):
+                    self._full_names.setdefault(self._summary(group)[3], group)
+            group = self._full_names.get(key)
+        else:
+            self._materialize()
+            return super().__getitem__(key)
+
+        if group is None or group in self._removed:
+            return None
+        return self._row(group)
+
+    def pop(self):
+        if self._funcs is None:
+            return super().pop()
+        group = self._order.pop()
+        self._removed.add(group)
+        return self._row(group)
+
+    def append(self, item):
+        self._materialize()
+        super().append(item)
+
+    def count(self, item):
+        self._materialize()
+        return super().count(item)
+
+    def add(self, files, type="ystat"):
+        if type.upper() != "YBIN" or (self._funcs is None and not self.empty()):
+            self._materialize()
+            return super().add(files, type)
+
+        # the ybin files are merged into the snapshot in a single pass,
+        # mapping them one at a time
+        if isinstance(files, str):
+            files = [
+                files,
+            ]
+        clock_types = set() if self.empty() else {self._clock_type}
+
+        def _snapshots():
+            for path in files:
+                with open(path, "rb") as f:
+                    clock_type, *snapshot = _load_ybin(f)
+                clock_types.add(clock_type)
+                if len(clock_types) > 1:
+                    raise YappiError("Clock type mismatch between current and saved profiler sessions.[%s,%s]" % \
+                        (self._clock_type, clock_type))
+                self._clock_type = clock_type
+                yield snapshot
+
+        if self.empty() and len(files) == 1:
+            # used in place
+            self._load(*next(_snapshots()))
+        elif files:
+            self._load(*self._merged_columns(_snapshots()))
+        return self.sort(DEFAULT_SORT_TYPE, DEFAULT_SORT_ORDER)
+
+    def strip_dirs(self):
+        self._materialize()
+        return super().strip_dirs()
+
+    def close(self):
+        """
+        Releases the memory mapped ybin file used in place (see add()). The
+        columns are copied into memory first.
+        """
+        if self._funcs is None:
+            return
+        mappings = {
+            id(view.obj): view.obj
+            for columns in (self._funcs, self._edges, self._hists)
+            for view in columns.values()
+            if isinstance(view, memoryview) and isinstance(view.obj, mmap.mmap)
+        }
+        if not mappings:
+            return
+        self._funcs, self._edges, self._hists = (
+            _column_views([columns[name].tobytes() for name, _ in spec], spec)
+            for columns, spec in (
+                (self._funcs, FUNC_ARRAY_COLUMNS),
+                (self._edges, EDGE_ARRAY_COLUMNS),
+                (self._hists, HIST_ARRAY_COLUMNS),
+            )
+        )
+        for mapping in mappings.values():
+            mapping.close()
+
+    def _columns(self):
+        if self._funcs is None:
+            return super()._columns()
+        return self._merged_columns()
+
+    def _merged_columns(self, snapshots=()):
+        """
+        Returns the columns of the snapshot merged with the given ones (see
+        _load()), a row per function and an edge per (parent, child) pair
+        like YFuncStats. The new functions of the given snapshots get new
+        indexes like in YFuncStats.add().
+        """
+        functions = {name: array.array(tc) for name, tc in FUNC_ARRAY_COLUMNS}
+        edges = {name: array.array(tc) for name, tc in EDGE_ARRAY_COLUMNS}
+        hists = {name: array.array(tc) for name, tc in HIST_ARRAY_COLUMNS}
+        string_ids = {}
+        func_rows = {}
+        edge_rows = {}
+        hist_rows = {}
+        idx_max = self._idx_max
+        summed = ("ncall", "nactualcall", "ttot", "tsub", "ttot_cpu", "tsub_cpu")
+
+        def _sources():
+            if self._funcs is not None:
+                yield (
+                    self._funcs, self._edges, self._strings, self._hists, [
+                        row for group, rows in enumerate(self._groups)
+                        if group not in self._removed for row in rows
+                    ]
+                )
+            for functions_, edges_, strings_, hists_ in snapshots:
+                f = _column_views(functions_, FUNC_ARRAY_COLUMNS)
+                yield (
+                    f, _column_views(edges_, EDGE_ARRAY_COLUMNS), strings_,
+                    _column_views(hists_, HIST_ARRAY_COLUMNS), [
+                        row for row, module in enumerate(f["module"])
+                        if not _is_yappi_module(strings_[module])
+                    ]
+                )
+
+        for source, (f, e, strings, h, rows) in enumerate(_sources()):
+            out_rows = {}
+            for row in rows:
+                name = strings[f["name"][row]]
+                module = strings[f["module"][row]]
+                lineno, builtin = f["lineno"][row], f["builtin"][row]
+                key = (name, module, -1 if builtin else lineno)
+                out = func_rows.get(key)
+                if out is None:
+                    out = func_rows[key] = len(functions["index"])
+                    index = f["index"][row]
+                    if source:
+                        idx_max += 1
+                        index = idx_max
+                    else:
+                        idx_max = max(idx_max, index)
+                    for column, value in (
+                        ("index", index),
+                        ("name", string_ids.setdefault(name, len(string_ids))),
+                        ("module", string_ids.setdefault(module, len(string_ids))),
+                        ("lineno", lineno),
+                        ("builtin", builtin),
+                        ("ctx_id", f["ctx_id"][row]),
+                        ("tag", f["tag"][row]),
+                        ("tmax", f["tmax"][row]),
+                        ("ctx_name", string_ids.setdefault(
+                            strings[f["ctx_name"][row]], len(string_ids)
+                        )),
+                    ):
+                        functions[column].append(value)
+                    for column in summed:
+                        functions[column].append(f[column][row])
+                else:
+                    for column in summed:
+                        functions[column][out] += f[column][row]
+                    functions["tmax"][out] = max(
+                        functions["tmax"][out], f["tmax"][row]
+                    )
+                out_rows[f["index"][row]] = out
+
+            # the edges of the functions filtered out are dropped
+            for i in range(len(e["parent"])):
+                parent = out_rows.get(e["parent"][i])
+                child = out_rows.get(e["child"][i])
+                if parent is None or child is None:
+                    continue
+                out = edge_rows.get((parent, child))
+                if out is None:
+                    out = edge_rows[(parent, child)] = len(edges["parent"])
+                    edges["parent"].append(functions["index"][parent])
+                    edges["child"].append(functions["index"][child])
+                    for column in summed:
+                        edges[column].append(e[column][i])
+                else:
+                    for column in summed:
+                        edges[column][out] += e[column][i]
+
+            for i in range(len(h["index"])):
+                parent = out_rows.get(h["index"][i])
+                if parent is None:
+                    continue
+                out = hist_rows.get((parent, h["high"][i]))
+                if out is None:
+                    out = hist_rows[(parent, h["high"][i])] = len(hists["index"])
+                    hists["index"].append(functions["index"][parent])
+                    hists["high"].append(h["high"][i])
+                    hists["count"].append(h["count"][i])
+                else:
+                    hists["count"][out] += h["count"][i]
+
+        return (
+            [functions[name] for name, _ in FUNC_ARRAY_COLUMNS],
+            [edges[name] for name, _ in EDGE_ARRAY_COLUMNS],
+            list(string_ids),
+            [hists[name] for name, _ in HIST_ARRAY_COLUMNS],
+        )
+
+    def _save_as_YSTAT(self, path):
+        # saved as a plain YFuncStats, which does not need a snapshot
+        stats = YFuncStats()
+        stats._clock_type = self._clock_type
+        for stat in self:
+            stats.append(stat)
+        stats._save_as_YSTAT(path)
+
+
 class _YContextStats(YStats):
 
     _BACKEND = None
@@ -1203,6 +2272,186 @@ class YGreenletStats(_YContextStats):
     _ALL_COLUMNS = ["name", "id", "ttot", "scnt"]
 
 
+class YTraceFile:
+    """
+    A trace file written by start(trace_file=...). The stats are rebuilt by
+    replaying the recorded call events, so they can be computed for any time
+    window, tag or context after the fact.
+    """
+
+    def __init__(self, path):
+        self.clock_type = None
+        self._functions = {}  # index: (name, module, lineno, builtin, ctx_id, ctx_name, tag)
+        self._events = {}  # ctx_id: [(timestamp, index, what)]
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        header_size = len(TRACE_FILE_MAGIC) + 4
+        if data[:len(TRACE_FILE_MAGIC)] != TRACE_FILE_MAGIC:
+            raise YappiError(f"{path} is not a yappi trace file.")
+        version, = struct.unpack_from("=I", data, len(TRACE_FILE_MAGIC))
+        if version != TRACE_FILE_VERSION:
+            raise YappiError(f"Unsupported trace file version {version}.")
+
+        offset = header_size
+        footer = None
+        while offset < len(data):
+            kind, = struct.unpack_from("=I", data, offset)
+            if kind == _TRACE_CHUNK:
+                _, count, ctx_id = _TRACE_CHUNK_HEADER.unpack_from(data, offset)
+                offset += _TRACE_CHUNK_HEADER.size
+                end = offset + count * _TRACE_EVENT.size
+                self._events.setdefault(ctx_id, []).extend(
+                    _TRACE_EVENT.iter_unpack(data[offset:end])
+                )
+                offset = end
+            elif kind == _TRACE_FOOTER:
+                _, length = _TRACE_FOOTER_HEADER.unpack_from(data, offset)
+                offset += _TRACE_FOOTER_HEADER.size
+                footer = json.loads(data[offset:offset + length])
+                offset += length
+            else:
+                raise YappiError(f"Corrupted trace file {path}.")
+
+        # the footer is written when the profiler is stopped
+        if footer is None:
+            raise YappiError(f"Incomplete trace file {path}.")
+        self.clock_type = footer["clock_type"]
+        for index, *function in footer["functions"]:
+            self._functions[index] = tuple(function)
+
+    def get_events(self, start=None, end=None, ctx_id=None):
+        """
+        Returns the recorded call events as a list of YTraceEvent, in order per
+        context. start and end limit the events to a time window.
+        """
+        result = []
+        for ev_ctx_id, events in self._events.items():
+            if ctx_id is not None and ev_ctx_id != ctx_id:
+                continue
+            for timestamp, index, what in events:
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    continue
+                function = self._functions.get(index)
+                if function is None:  # a hidden builtin function
+                    continue
+                name, module, lineno, builtin = function[:4]
+                full_name = _func_fullname(bool(builtin), module, lineno, name)
+                result.append(
+                    YTraceEvent((
+                        ev_ctx_id, timestamp, "return" if what else "call",
+                        name, module, lineno, bool(builtin), full_name
+                    ))
+                )
+        return result
+
+    def get_func_stats(self, start=None, end=None, tag=None, ctx_id=None):
+        """
+        Returns the YFuncStats of the calls made between start and end, which
+        are timestamps as in YTraceEvent. The calls that were not finished
+        when the profiler was stopped are not included.
+        """
+        # index: [ncall, nactualcall, ttot, tsub, {child index: [ncall, nactualcall, ttot, tsub]}]
+        totals = {}
+        for ev_ctx_id, events in self._events.items():
+            if ctx_id is not None and ev_ctx_id != ctx_id:
+                continue
+            self._replay(events, totals, start, end)
+
+        stats = YFuncStats()
+        stats._clock_type = self.clock_type
+        for index, (ncall, nactualcall, ttot, tsub, children) in totals.items():
+            # the builtin functions are not in the file if they were hidden
+            if index not in self._functions:
+                continue
+            name, module, lineno, builtin, fctx_id, ctx_name, ftag = \
+                self._functions[index]
+            # the function only has children that returned in the window
+            if not ncall or (tag is not None and ftag != tag):
+                continue
+            stats._enumerator((
+                name, module, lineno, ncall, nactualcall, builtin, ttot, tsub,
+                index, [(cindex, ) + tuple(child) + (0.0, 0.0)
+                        for cindex, child in children.items()], fctx_id,
+                ctx_name, ftag, None, 0.0, 0.0, [], 0.0
+            ))
+        stats._convert_children()
+        return stats.sort(DEFAULT_SORT_TYPE, DEFAULT_SORT_ORDER)
+
+    def save(self, path, start=None, end=None, ctx_id=None):
+        """
+        Saves the call events in Chrome Trace Event format, see save_trace().
+        """
+        _save_chrome_trace(self.get_events(start, end, ctx_id), path)
+
+    @staticmethod
+    def _replay(events, totals, start, end):
+        # [index, t0, time spent in the children]
+        stack = []
+        # the number of calls of a function or a (parent, child) pair on the
+        # stack, a recursive call is only accounted once in ttot
+        active = {}
+        for timestamp, index, what in events:
+            if not what:
+                stack.append([index, timestamp, 0.0])
+                active[index] = active.get(index, 0) + 1
+                if len(stack) > 1:
+                    pair = (stack[-2][0], index)
+                    active[pair] = active.get(pair, 0) + 1
+                continue
+
+            # the call of a return may be made before the profiler is started
+            if not active.get(index):
+                continue
+            while stack[-1][0] != index:
+                YTraceFile._leave(stack.pop(), stack, active)
+            call = stack.pop()
+            parent = YTraceFile._leave(call, stack, active)
+
+            _, t0, child_time = call
+            elapsed = timestamp - t0
+            if stack:
+                stack[-1][2] += elapsed
+            if (start is not None and t0 < start) or \
+                    (end is not None and timestamp > end):
+                continue
+
+            recursive = active.get(index)
+            total = totals.setdefault(index, [0, 0, 0.0, 0.0, {}])
+            total[0] += 1
+            total[3] += elapsed - child_time
+            if not recursive:
+                total[1] += 1
+                total[2] += elapsed
+
+            if parent is not None:
+                ptotal = totals.setdefault(parent, [0, 0, 0.0, 0.0, {}])
+                child = ptotal[4].setdefault(index, [0, 0, 0.0, 0.0])
+                child[0] += 1
+                child[3] += elapsed - child_time
+                if not recursive:
+                    child[1] += 1
+                if not active.get((parent, index)):
+                    child[2] += elapsed
+
+    @staticmethod
+    def _leave(call, stack, active):
+        """
+        Removes a call popped from the stack from the active calls and returns
+        the index of its parent, if any.
+        """
+        index = call[0]
+        active[index] -= 1
+        if not stack:
+            return None
+        parent = stack[-1][0]
+        active[(parent, index)] -= 1
+        return parent
+
+
 def is_running():
     """
     Returns true if the profiler is running, false otherwise.
@@ -1210,7 +2459,91 @@ def is_running():
     return bool(_yappi.is_running())
 
 
-def start(builtins=False, profile_threads=True, profile_greenlets=True):
+def _validate_engine(engine):
+    engine = engine.upper()
+    if engine not in ENGINE_TYPES:
+        raise YappiError(f"Invalid engine type: {engine}")
+    if engine == MONITORING and sys.version_info < (3, 12):
+        raise YappiError("'monitoring' engine requires Python 3.12 or later.")
+    return engine
+
+
+def _validate_mode(mode, interval):
+    mode = mode.upper()
+    if mode not in MODE_TYPES:
+        raise YappiError(f"Invalid mode: {mode}")
+    if mode == SAMPLING:
+        if _yappi.get_clock_type() == DUAL_CLOCK:
+            raise YappiError("'sampling' mode does not support the 'dual' clock.")
+        if interval <= 0:
+            raise YappiError(f"Invalid sampling interval: {interval}")
+        if _yappi.get_context_backend() != NATIVE_THREAD:
+            raise YappiError(
+                "'sampling' mode only supports the 'native_thread' context backend."
+            )
+    return mode
+
+
+def _module_pattern(module):
+    """
+    Returns the pattern that matches the functions of the given module. The
+    pattern is matched against the `module` field of the stats: the filename
+    for Python functions and the module name for builtins.
+    """
+    if isinstance(module, str):
+        return module
+    if isinstance(module, types.ModuleType):
+        filename = getattr(module, "__file__", None)
+        if not filename:
+            return module.__name__
+        # match all the modules of a package
+        if os.path.basename(filename).startswith("__init__."):
+            return os.path.dirname(filename) + os.sep
+        return filename
+    raise YappiError(f"Invalid module: {module!r}")
+
+
+def _create_module_filter(include_modules, exclude_modules):
+    """
+    Returns a callable that returns True if the functions of the given module
+    shall be profiled or None if there is nothing to filter.
+
+    A module matches a pattern if it starts with the pattern or if it matches
+    the pattern as a glob.
+    """
+    include = [_module_pattern(m) for m in include_modules or ()]
+    exclude = [_module_pattern(m) for m in exclude_modules or ()]
+    if not include and not exclude:
+        return None
+
+    def _match(module, patterns):
+        return any(
+            module.startswith(p) or fnmatch.fnmatchcase(module, p)
+            for p in patterns
+        )
+
+    def _filter(module):
+        if include and not _match(module, include):
+            return False
+        return not _match(module, exclude)
+
+    return _filter
+
+
+def start(
+    builtins=False,
+    profile_threads=True,
+    profile_greenlets=True,
+    engine="setprofile",
+    include_modules=None,
+    exclude_modules=None,
+    mode="deterministic",
+    interval=DEFAULT_SAMPLING_INTERVAL,
+    histograms=False,
+    trace_buffer=0,
+    trace_file=None,
+    call_paths=False
+):
     """
     Start profiler.
 
@@ -1221,21 +2554,94 @@ def start(builtins=False, profile_threads=True, profile_greenlets=True):
     profile_greenlets: Set to True to to profile multiple greenlets. Set to
     False to profile only the invoking greenlet. This argument is only respected
     when context backend is 'greenlet' and ignored otherwise.
+
+    engine: 'setprofile' uses the legacy profile hook of the interpreter.
+    'monitoring' registers yappi as a sys.monitoring (PEP 669) tool and only
+    subscribes to the events needed. Requires Python 3.12+.
+
+    include_modules, exclude_modules: Lists of modules or module patterns.
+    When given, only the functions of the included modules that are not
+    excluded are profiled. The decision is made once per function when it is
+    first seen, and the time spent in excluded functions is accounted to their
+    nearest profiled caller.
+
+    mode: 'deterministic' hooks every function call. 'sampling' captures the
+    call stacks of the threads every `interval` seconds instead. The stats
+    are estimated from the samples, so the overhead is low and does not
+    depend on how many calls are made. `engine` and `builtins` are ignored
+    in sampling mode.
+
+    histograms: Set to True to record the latency of every call in a
+    histogram per function, from which the `p50`, `p90` and `p99` stats are
+    computed. It is ignored in sampling mode.
+
+    trace_buffer: The number of call events kept per context. When non-zero,
+    every call and return is recorded in a preallocated ring buffer of the
+    context so that the last events can be retrieved with get_trace() or
+    saved with save_trace(). It is ignored in sampling mode.
+
+    trace_file: A path to stream every call and return to. The events are
+    written in compact binary chunks by a background thread and the file is
+    completed by stop(). Use load_trace() to rebuild the stats of any time
+    window, tag or context from it. It is ignored in sampling mode.
+
+    call_paths: Set to True to also build a calling context tree per context,
+    which keeps the stats of a function separately for every call path it is
+    called through. See get_call_paths(). It is ignored in sampling mode.
     """
+    engine = _validate_engine(engine)
+    mode = _validate_mode(mode, interval)
+    module_filter = _create_module_filter(include_modules, exclude_modules)
     backend = _yappi.get_context_backend()
     profile_contexts = (
         (profile_threads and backend == NATIVE_THREAD)
         or (profile_greenlets and backend == GREENLET)
     )
-    if profile_contexts:
+    if mode == SAMPLING:
+        if is_running():
+            return
+        _yappi.start(False, profile_contexts, SAMPLING_ENGINE, module_filter)
+        _start_sampler(interval)
+        return
+    # the writer thread is started before the threads are hooked below, and
+    # is not profiled
+    trace_stream = trace_file is not None and not is_running()
+    writer_tid = 0
+    if trace_stream:
+        _start_trace_writer(trace_file)
+        writer_tid = _trace_writer[0].ident
+    # sys.monitoring events are global, new threads need no bootstrapping
+    if profile_contexts and engine == SETPROFILE:
         threading.setprofile(_profile_thread_callback)
-    _yappi.start(builtins, profile_contexts)
-
-
-def get_func_stats(tag=None, ctx_id=None, filter=None, filter_callback=None):
+    try:
+        _yappi.start(
+            builtins, profile_contexts, ENGINE_TYPES[engine], module_filter,
+            histograms, trace_buffer, trace_stream, call_paths, writer_tid
+        )
+    except:
+        _stop_trace_writer()
+        raise
+
+
+def get_func_stats(
+    tag=None,
+    ctx_id=None,
+    filter=None,
+    filter_callback=None,
+    sort_type=None,
+    sort_order=DEFAULT_SORT_ORDER,
+    limit=None,
+    lazy=False
+):
     """
     Gets the function profiler results with given filters and returns an iterable.
 
+    sort_type, sort_order, limit: returns only the limit functions sorted first.
+    For most sort types they are selected in C, so that the stats of the other
+    functions are never created.
+    lazy: returns a YFuncStatsView, which creates the stats of a function only
+    when it is accessed.
+
     filter: is here mainly for backward compat. we will not document it anymore.
     tag, ctx_id: select given tag and ctx_id related stats in C side.
     filter_callback: we could do it like: get_func_stats().filter(). The problem
@@ -1255,16 +2661,174 @@ def get_func_stats(tag=None, ctx_id=None, filter=None, filter_callback=None):
     if ctx_id:
         filter['ctx_id'] = ctx_id
 
+    if lazy:
+        if filter_callback:
+            raise YappiError("filter_callback cannot be used with lazy stats.")
+        return YFuncStatsView().get(
+            filter=filter,
+            sort_type=sort_type,
+            sort_order=sort_order,
+            limit=limit
+        )
+
     # multiple invocation pause/resume is allowed. This is needed because
     # not only get() is executed here.
     _yappi._pause()
     try:
-        stats = YFuncStats().get(filter=filter, filter_callback=filter_callback)
+        stats = YFuncStats().get(
+            filter=filter,
+            filter_callback=filter_callback,
+            sort_type=sort_type,
+            sort_order=sort_order,
+            limit=limit
+        )
     finally:
         _yappi._resume()
     return stats
 
 
+def get_func_stats_arrays(tag=None, ctx_id=None):
+    """
+    Returns the function stats as (functions, edges, strings) without creating
+    an object per function. functions has a row per function and edges a row
+    per (parent, child) pair, both are NumPy structured arrays if NumPy is
+    installed or dicts of array.array columns otherwise. The name, module and
+    ctx_name columns are indexes in the strings list, where the name of a
+    context without one is None.
+    """
+    filter = {}
+    if tag:
+        filter['tag'] = tag
+    if ctx_id:
+        filter['ctx_id'] = ctx_id
+
+    _yappi._pause()
+    try:
+        functions, edges, strings, _ = _yappi.get_func_stats_arrays(filter)
+    finally:
+        _yappi._resume()
+
+    return (
+        _columns_to_arrays(functions, FUNC_ARRAY_COLUMNS),
+        _columns_to_arrays(edges, EDGE_ARRAY_COLUMNS), strings
+    )
+
+
+def _columns_to_arrays(columns, spec):
+    try:
+        import numpy
+    except ImportError:
+        return {
+            name: array.array(typecode, data)
+            for (name, typecode), data in zip(spec, columns)
+        }
+
+    result = numpy.empty(
+        len(columns[0]) // numpy.dtype(spec[0][1]).itemsize, dtype=list(spec)
+    )
+    for (name, typecode), data in zip(spec, columns):
+        result[name] = numpy.frombuffer(data, dtype=typecode)
+    return result
+
+
+def _column_views(columns, spec):
+    """
+    Returns the columns of any buffer type as {name: typed memoryview}.
+    """
+    return {
+        name: memoryview(data).cast("B").cast(typecode)
+        for (name, typecode), data in zip(spec, columns)
+    }
+
+
+def _is_yappi_module(module):
+    return module == "_yappi" or os.path.basename(module) == "yappi.py"
+
+
+def _save_ybin(path, clock_type, functions, edges, strings, hists):
+    """
+    Writes the stat columns (see YFuncStatsView._load()) to a ybin file.
+    """
+    strings = list(strings) + [clock_type]
+    none_id = strings.index(None) if None in strings else _YBIN_NO_STRING
+    encoded = [b"" if s is None else s.encode("utf-8") for s in strings]
+    offsets = array.array("Q", [0])
+    offsets.extend(itertools.accumulate(map(len, encoded)))
+    header = _YBIN_HEADER.pack(
+        YBIN_FILE_MAGIC, YBIN_FILE_VERSION, sys.byteorder == "big",
+        len(strings) - 1, none_id, len(functions[0]), len(edges[0]),
+        len(hists[0]), len(strings)
+    )
+
+    # the file is replaced rather than rewritten, the views loaded from it
+    # might still be using it in place
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+
+            def _write(data):
+                f.write(b"\0" * (-f.tell() % 8))
+                f.write(data)
+
+            f.write(header)
+            _write(offsets)
+            _write(b"".join(encoded))
+            for column in itertools.chain(functions, edges, hists):
+                _write(column)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _load_ybin(file):
+    """
+    Maps a ybin file into memory and returns (clock_type, functions, edges,
+    strings, hists), where the columns are views of the mapped file.
+    """
+    try:
+        data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, big, clock_id, none_id, nfuncs, nedges, nhists, \
+            nstrings = _YBIN_HEADER.unpack_from(data)
+    except (ValueError, OSError, struct.error):
+        magic = version = None
+    if magic != YBIN_FILE_MAGIC or version != YBIN_FILE_VERSION:
+        raise YappiError(
+            f"Unable to load the saved profile information from {file.name}."
+        )
+
+    pos = _YBIN_HEADER.size
+
+    def _column(typecode, count):
+        nonlocal pos
+        pos += -pos % 8
+        size = array.array(typecode).itemsize * count
+        if pos + size > len(data):
+            raise YappiError(f"Truncated ybin file: {file.name}.")
+        column = data[pos:pos + size]
+        pos += size
+        if typecode == "B":
+            return column
+        if big == (sys.byteorder == "big"):
+            return column.cast(typecode)
+        # saved on a machine of the other byte order
+        column = array.array(typecode, column.tobytes())
+        column.byteswap()
+        return column
+
+    offsets = _column("Q", nstrings + 1)
+    blob = _column("B", offsets[-1])
+    strings = [
+        None if i == none_id else str(blob[offsets[i]:offsets[i + 1]], "utf-8")
+        for i in range(nstrings)
+    ]
+    functions = [_column(tc, nfuncs) for _, tc in FUNC_ARRAY_COLUMNS]
+    edges = [_column(tc, nedges) for _, tc in EDGE_ARRAY_COLUMNS]
+    hists = [_column(tc, nhists) for _, tc in HIST_ARRAY_COLUMNS]
+    return strings[clock_id], functions, edges, strings, hists
+
+
 def get_thread_stats():
     """
     Gets the thread profiler results with given filters and returns an iterable.
@@ -1279,16 +2843,204 @@ def get_greenlet_stats():
     return YGreenletStats().get()
 
 
+def get_trace():
+    """
+    Returns the call events in the trace buffers of the contexts as a list of
+    YTraceEvent, oldest first per context. See start(trace_buffer=...).
+    """
+    _yappi._pause()
+    try:
+        events = _yappi.get_trace()
+    finally:
+        _yappi._resume()
+
+    result = []
+    for ctx_id, timestamp, what, name, module, lineno, builtin in events:
+        full_name = _func_fullname(bool(builtin), module, lineno, name)
+        result.append(
+            YTraceEvent((
+                ctx_id, timestamp, "return" if what else "call", name, module,
+                lineno, bool(builtin), full_name
+            ))
+        )
+    return result
+
+
+def save_trace(path):
+    """
+    Saves the call events in the trace buffers in Chrome Trace Event format,
+    which can be opened in chrome://tracing or https://ui.perfetto.dev.
+    """
+    _save_chrome_trace(get_trace(), path)
+
+
+def load_trace(path):
+    """
+    Loads a trace file written by start(trace_file=...) and returns a
+    YTraceFile.
+    """
+    return YTraceFile(path)
+
+
+def _save_chrome_trace(events, path):
+    pid = os.getpid()
+    trace_events = []
+    open_calls = {}
+    for ev in events:
+        # the call of a return may be overwritten in the ring buffer
+        depth = open_calls.get(ev.ctx_id, 0)
+        if ev.event == "return":
+            if not depth:
+                continue
+            open_calls[ev.ctx_id] = depth - 1
+        else:
+            open_calls[ev.ctx_id] = depth + 1
+        trace_events.append({
+            "name": ev.full_name,
+            "cat": "builtin" if ev.builtin else "function",
+            "ph": "E" if ev.event == "return" else "B",
+            "ts": ev.timestamp * 1e6,
+            "pid": pid,
+            "tid": ev.ctx_id,
+        })
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+def get_call_paths():
+    """
+    Returns the nodes of the calling context trees of the contexts as a list of
+    YCallPath, callers first. See start(call_paths=...).
+    """
+    _yappi._pause()
+    try:
+        nodes = _yappi.get_call_paths()
+    finally:
+        _yappi._resume()
+
+    result = []
+    paths = {}  # (ctx_id, id): path
+    for ctx_id, id, parent_id, name, module, lineno, builtin, ncall, ttot, \
+            tsub in nodes:
+        parent_path = paths.get((ctx_id, parent_id), ())
+        if parent_path is None:
+            paths[(ctx_id, id)] = None
+            continue
+        # do not show profile stats of yappi itself.
+        if os.path.basename(module) == "yappi.py" or module == "_yappi":
+            paths[(ctx_id, id)] = None
+            continue
+        full_name = _func_fullname(bool(builtin), module, lineno, name)
+        path = parent_path + (full_name, )
+        paths[(ctx_id, id)] = path
+        result.append(
+            YCallPath((
+                ctx_id, path, name, module, lineno, bool(builtin), ncall, ttot,
+                tsub, full_name
+            ))
+        )
+    return result
+
+
+def save_call_paths(path, type="collapsed"):
+    """
+    Saves the call paths in the collapsed stack format of FlameGraph
+    ('collapsed') or in the format of https://www.speedscope.app
+    ('speedscope'). The weight of a path is the time spent in its last function.
+    """
+    type = type.lower()
+    if type not in ("collapsed", "speedscope"):
+        raise YappiError(
+            f"Invalid call paths format {type}. Supported formats are collapsed, speedscope."
+        )
+
+    call_paths = get_call_paths()
+    if type == "collapsed":
+        _save_collapsed(call_paths, path)
+    else:
+        _save_speedscope(call_paths, path)
+
+
+def _save_collapsed(call_paths, path):
+    # the same path of different contexts is merged
+    weights = {}
+    for call_path in call_paths:
+        weights[call_path.path] = weights.get(call_path.path, 0.0) + call_path.tsub
+
+    with open(path, "w") as f:
+        for stack, weight in weights.items():
+            weight = round(weight * 1e6)  # microseconds
+            if weight:
+                f.write(";".join(stack) + " " + str(weight) + "\n")
+
+
+def _save_speedscope(call_paths, path):
+    if _yappi.get_context_backend() == GREENLET:
+        ctx_names = {stat.id: stat.name for stat in get_greenlet_stats()}
+    else:
+        ctx_names = {stat.id: stat.name for stat in get_thread_stats()}
+
+    frames = []
+    frame_indexes = {}  # full_name: index in frames
+    profiles = {}  # ctx_id: (samples, weights)
+    for call_path in call_paths:
+        if call_path.full_name not in frame_indexes:
+            frame_indexes[call_path.full_name] = len(frames)
+            frames.append({
+                "name": call_path.name,
+                "file": call_path.module,
+                "line": call_path.lineno
+            })
+        if call_path.tsub <= 0:
+            continue
+        samples, weights = profiles.setdefault(call_path.ctx_id, ([], []))
+        samples.append([frame_indexes[name] for name in call_path.path])
+        weights.append(call_path.tsub)
+
+    with open(path, "w") as f:
+        json.dump({
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": str(ctx_names.get(ctx_id, ctx_id)),
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights
+            } for ctx_id, (samples, weights) in profiles.items()],
+            "name": "yappi",
+            "exporter": "yappi"
+        }, f)
+
+
 def stop():
     """
     Stop profiler.
     """
     _yappi.stop()
+    _stop_sampler()
+    _stop_trace_writer()
     threading.setprofile(None)
 
 
 @contextmanager
-def run(builtins=False, profile_threads=True, profile_greenlets=True):
+def run(
+    builtins=False,
+    profile_threads=True,
+    profile_greenlets=True,
+    engine="setprofile",
+    include_modules=None,
+    exclude_modules=None,
+    mode="deterministic",
+    interval=DEFAULT_SAMPLING_INTERVAL,
+    histograms=False,
+    trace_buffer=0,
+    trace_file=None,
+    call_paths=False
+):
     """
     Context manger for profiling block of code.
 
@@ -1311,7 +3063,16 @@ def run(builtins=False, profile_threads=True, profile_greenlets=True):
     start(
         builtins=builtins,
         profile_threads=profile_threads,
-        profile_greenlets=profile_greenlets
+        profile_greenlets=profile_greenlets,
+        engine=engine,
+        include_modules=include_modules,
+        exclude_modules=exclude_modules,
+        mode=mode,
+        interval=interval,
+        histograms=histograms,
+        trace_buffer=trace_buffer,
+        trace_file=trace_file,
+        call_paths=call_paths
     )
     try:
         yield
@@ -1353,6 +3114,15 @@ def get_clock_info():
     return _yappi.get_clock_info()
 
 
+def get_clock_overhead():
+    """
+    Returns the time the profiler adds to a call of a function and a builtin
+    with the current clock type, in seconds. It is measured the first time the
+    profiler is started with a clock type and subtracted from the timings.
+    """
+    return _yappi.get_clock_overhead()
+
+
 def set_clock_type(type):
     """
     Sets the internal clock type for timing. Profiler shall not have any previous stats.
@@ -1380,6 +3150,23 @@ def set_tag_callback(cbk):
     return _yappi.set_tag_callback(cbk)
 
 
+def set_tag_contextvar(var):
+    """
+    Use the value of a contextvars.ContextVar as the tag of the stat. entries.
+
+    The value is read directly by the profiler instead of calling a Python
+    callback on every profile event. The value must be an integer, if it is
+    not set in the current context the default tag is used. For example:
+
+    >>> request_id = contextvars.ContextVar('request_id')
+    >>> yappi.set_tag_contextvar(request_id)
+
+    Setting a tag contextvar replaces the tag callback and vice versa. Pass
+    None to stop using the contextvar.
+    """
+    return _yappi.set_tag_contextvar(var)
+
+
 def set_context_backend(type):
     """
     Sets the internal context backend used to track execution context.